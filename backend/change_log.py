@@ -0,0 +1,95 @@
+import threading
+from collections import deque
+
+"""
+Bounded log of the row level changes of the datasets of Unified_data_structure.data, so that a client can fetch what
+changed since the version it has instead of the whole dataset.
+
+The version of a dataset is its DataStore.key_version. Every incremental change (visits appended to customers, companies
+edited in dataset1.json) is recorded as a Change: the version it produced, the inserted and updated rows and the keys of
+the deleted rows. Rows are identified by the key columns of their dataset (e.g. company_id for companies), a dataset
+without key columns only ever gets rows appended at its end.
+For every dataset the log knows the version from which it is complete (base): since(dataset, version) returns the changes
+after version when version >= base, and None when the client has to fetch the dataset in full, because
+    - changes older than version were dropped to keep the log within max_rows rows per dataset
+    - the dataset was replaced by something that is not a row level change (e.g. the whole file ingested again), which
+      shows as a key_version that the log did not record
+"""
+
+
+class Change:
+    def __init__(self, version, inserted=None, updated=None, deleted=None):
+        self.version = version
+        self.inserted = inserted  # dataframe of the new rows
+        self.updated = updated  # dataframe of the new values of changed rows
+        self.deleted = deleted  # dataframe of the key columns of the deleted rows
+
+    @property
+    def rows(self):
+        return sum(len(frame) for frame in (self.inserted, self.updated, self.deleted) if frame is not None)
+
+
+class _DatasetLog:
+    def __init__(self, base):
+        self.base = base
+        self.changes = deque()
+        self.rows = 0
+
+    @property
+    def version(self):
+        return self.changes[-1].version if self.changes else self.base
+
+
+class ChangeLog:
+    def __init__(self, max_rows=100_000):
+        self.max_rows = max_rows
+        self._logs = {}  # dataset -> _DatasetLog
+        self._lock = threading.Lock()
+
+    def record(self, dataset, previous_version, change):
+        # change took dataset from previous_version to change.version
+        with self._lock:
+            log = self._logs.get(dataset)
+            if log is None or log.version != previous_version:
+                # the log starts over from the version the change was made on
+                log = self._logs[dataset] = _DatasetLog(previous_version)
+            log.changes.append(change)
+            log.rows += change.rows
+            while log.rows > self.max_rows and log.changes:
+                dropped = log.changes.popleft()
+                log.rows -= dropped.rows
+                log.base = dropped.version
+
+    def since(self, dataset, version, current_version):
+        # changes of dataset after version up to current_version, None when they are not all in the log
+        if version == current_version:
+            return []
+        with self._lock:
+            log = self._logs.get(dataset)
+            # a log behind current_version missed a change that was not recorded
+            if log is None or version < log.base or version > current_version or log.version < current_version:
+                return None
+            return [change for change in log.changes if version < change.version <= current_version]
+
+
+def diff_rows(old, new, key_columns):
+    # Change of the rows of new against the rows of old (without its version), rows matched on key_columns.
+    # None when the key columns do not identify the rows
+    if not key_columns or not set(key_columns) <= set(old.columns) & set(new.columns):
+        return None
+    old_rows, new_rows = old.set_index(key_columns), new.set_index(key_columns)
+    if not (old_rows.index.is_unique and new_rows.index.is_unique):
+        return None
+    deleted = old_rows.index.difference(new_rows.index)
+    inserted = new_rows.index.difference(old_rows.index)
+    common = new_rows.index.intersection(old_rows.index)
+    # compared as python objects, so that categoricals with different categories and mixed dtypes compare by value
+    before = old_rows.loc[common].reindex(columns=new_rows.columns).astype(object)
+    after = new_rows.loc[common].astype(object)
+    differs = ~((before == after) | (before.isna() & after.isna())).all(axis=1)
+    return Change(
+        None,
+        inserted=new_rows.loc[inserted].reset_index(),
+        updated=new_rows.loc[common[differs.to_numpy()]].reset_index(),
+        deleted=deleted.to_frame(index=False),
+    )
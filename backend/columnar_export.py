@@ -0,0 +1,125 @@
+import io
+import zipfile
+import pandas as pd
+
+import json_ingestion
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, the parquet and arrow exports are unavailable without it
+    pa = pq = None
+
+"""
+Columnar binary exports of Unified_data_structure.data (Parquet and Arrow IPC).
+Every dataset is converted to an arrow table straight from the buffers of its dataframe: numeric and date columns are
+shared as they are, categoricals (e.g. Location of customers) become dictionary arrays, so nothing goes through python
+objects or text like the json export does. A client loads the result with pd.read_parquet / pa.ipc.open_stream without
+parsing anything.
+    - employees is exported as the single flattened table of every employee with its company_id
+    - a dict dataset (e.g. key_highlights) is exported as a table of one row, like in the xlsx
+A single dataset is a .parquet file or an Arrow IPC stream (iter_arrow yields it one record batch at a time so it can be
+streamed to the client while the next batch is serialized, the column buffers are yielded as memoryviews, not copied). write_archive puts every dataset in a zip (one file per dataset).
+Compression is optional, see COMPRESSIONS (arrow buffers are compressed with lz4 or zstd, parquet pages with any codec).
+"""
+
+COMPRESSIONS = {
+    "parquet": ["snappy", "zstd", "gzip", "brotli", "lz4", "none"],
+    "arrow": ["none", "lz4", "zstd"],
+}
+BATCH_SIZE = 64 * 1024
+
+
+def available():
+    return pa is not None
+
+
+def frame(key, value):
+    # the dataframe a dataset is exported as
+    if key == "employees":
+        return json_ingestion.employees_frame(value)
+    if isinstance(value, dict):
+        return pd.DataFrame([value])
+    return value
+
+
+def to_arrow(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # object columns mixing types (e.g. numbers and text) are exported as text
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].map(lambda value: None if pd.isna(value) else str(value))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def normalize_compression(kind, compression):
+    # the codec to use, the first of COMPRESSIONS[kind] by default, raises ValueError for an unsupported one
+    compression = (compression or COMPRESSIONS[kind][0]).lower()
+    if compression not in COMPRESSIONS[kind]:
+        raise ValueError(f"unsupported {kind} compression '{compression}', expected one of {', '.join(COMPRESSIONS[kind])}")
+    return compression
+
+
+class _Chunks:
+    # file object collecting what the ipc writer writes, so that it can be yielded chunk by chunk. The writer hands the
+    # body buffers of a batch as pa.Buffer, pointing into the table (or into the compressed copy of a buffer): they are
+    # kept as memoryviews rather than copied. Message headers and padding come as small bytes, gathered into one chunk
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            if not self.chunks or not isinstance(self.chunks[-1], bytearray):
+                self.chunks.append(bytearray())
+            self.chunks[-1] += data
+        else:
+            self.chunks.append(memoryview(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return [bytes(chunk) if isinstance(chunk, bytearray) else chunk for chunk in chunks]
+
+
+def iter_arrow(df, compression=None, batch_size=BATCH_SIZE):
+    # yields df as an Arrow IPC stream, one record batch at a time (bytes and memoryviews of the table buffers)
+    compression = normalize_compression("arrow", compression)
+    table = to_arrow(df)
+    sink = _Chunks()
+    options = pa.ipc.IpcWriteOptions(compression=None if compression == "none" else compression)
+    with pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), table.schema, options=options) as writer:
+        yield from sink.take()
+        for batch in table.to_batches(max_chunksize=batch_size):
+            writer.write_batch(batch)
+            yield from sink.take()
+    yield from sink.take()
+
+
+def write_arrow(output, df, compression=None):
+    for chunk in iter_arrow(df, compression):
+        output.write(chunk)
+
+
+def write_parquet(output, df, compression=None):
+    compression = normalize_compression("parquet", compression)
+    pq.write_table(to_arrow(df), output, compression=compression)
+
+
+def write_archive(output, items, kind, compression=None):
+    # zip of one <dataset>.parquet / <dataset>.arrow per dataset, stored as is since the files are compressed already
+    write = write_parquet if kind == "parquet" else write_arrow
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED) as archive:
+        for key, value in items:
+            if isinstance(value, (pd.DataFrame, dict)):
+                buffer = io.BytesIO()
+                write(buffer, frame(key, value), compression)
+                archive.writestr(f"{key}.{kind}", buffer.getvalue())
@@ -0,0 +1,178 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+try:
+    import pyarrow
+except ImportError:  # pyarrow is optional, without it STRING_COLUMNS stay python strings
+    pyarrow = None
+
+"""
+Typed ingestion of the customers visit log (dataset2.csv).
+Instead of pandas' default type inference (strings for everything that is not a number), the customers table has an
+explicit schema:
+    Date                               parsed to datetime64
+    Membership_Type, Activity,         categoricals: every distinct value is stored once and rows only hold small integer codes,
+    Location                           so value_counts / groupby on them work on the codes
+    Membership_ID                      almost one distinct value per row, which a categorical would store twice, so Arrow
+                                       backed strings (string[pyarrow], one buffer for the whole column) when pyarrow
+                                       is installed and python strings otherwise
+    Duration (Minutes)                 downcast to the smallest integer type that holds every value
+    Revenue                            downcast to float32 only when that is lossless, amounts in cents usually are not
+                                       exactly representable in float32 so they stay float64
+Columns that are not part of the schema keep pandas' default inference.
+
+For multi-GB visit logs read_customers can read the file in chunks: every chunk is parsed and compacted on its own and the
+compact chunks are combined at the end (categoricals are merged with union_categoricals), so the memory used by the raw
+text of a chunk is bounded by chunksize_for_budget instead of by the size of the file.
+
+The visit log is append only: read_customers can stop at a byte offset (end) and read_appended parses the rows written
+after it, so that new visits are ingested without reading the file again (see source_watcher). Both only read complete
+lines (complete_size), a last line without its newline is read once it is finished.
+"""
+
+DATE_COLUMNS = ["Date"]
+CATEGORY_COLUMNS = ["Membership_Type", "Activity", "Location"]
+STRING_COLUMNS = ["Membership_ID"]
+INTEGER_COLUMNS = ["Duration (Minutes)"]
+FLOAT_COLUMNS = ["Revenue"]
+
+STRING_DTYPE = pd.StringDtype("pyarrow") if pyarrow is not None else object
+
+# rough number of bytes a parsed row takes per byte of csv text before it is compacted (python strings, parser buffers)
+_PARSE_OVERHEAD = 8
+_SAMPLE_SIZE = 1024 * 1024
+
+
+class _Head(io.RawIOBase):
+    # the first `end` bytes of a binary file
+    def __init__(self, raw, end):
+        self.raw = raw
+        self.remaining = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        read = self.raw.readinto(memoryview(buffer)[:size])
+        self.remaining -= read
+        return read
+
+
+def _dtypes(columns):
+    # dtypes the columns of the schema are parsed as
+    dtype = {column: "category" for column in CATEGORY_COLUMNS if column in columns}
+    dtype.update({column: STRING_DTYPE for column in STRING_COLUMNS if column in columns})
+    return dtype
+
+
+def read_customers(filename, chunksize=None, end=None):
+    # end: number of bytes of the file to read (everything by default), e.g. the size of a log that is still growing
+    header = pd.read_csv(filename, nrows=0).columns
+    dtype = _dtypes(header)
+    with open(filename, "rb") as csv_file:
+        source = csv_file if end is None else io.BufferedReader(_Head(csv_file, end))
+        if chunksize is None:
+            return compact(pd.read_csv(source, dtype=dtype))
+        chunks = [compact(chunk) for chunk in pd.read_csv(source, dtype=dtype, chunksize=chunksize)]
+    return concat_chunks(chunks, header)
+
+
+def complete_size(filename, size=None):
+    # number of bytes of the first size bytes of the file (all of them by default) up to the end of its last complete
+    # line, so that a line that is still being written is not read half
+    with open(filename, "rb") as csv_file:
+        end = os.fstat(csv_file.fileno()).st_size if size is None else size
+        while end > 0:
+            start = max(end - _SAMPLE_SIZE, 0)
+            csv_file.seek(start)
+            newline = csv_file.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def read_appended(filename, start):
+    # (rows written after byte offset start, offset up to which they were read): only complete lines are read, a line
+    # that is still being written is left for the next call
+    with open(filename, "rb") as csv_file:
+        header = csv_file.readline()
+        csv_file.seek(start)
+        appended = csv_file.read()
+    end = appended.rfind(b"\n") + 1
+    if end == 0:
+        return None, start
+    header_columns = pd.read_csv(io.BytesIO(header), nrows=0).columns
+    dtype = _dtypes(header_columns)
+    rows = pd.read_csv(io.BytesIO(header + appended[:end]), dtype=dtype)
+    return compact(rows), start + end
+
+
+def chunksize_for_budget(filename, memory_budget):
+    # number of rows per chunk so that parsing a chunk stays within memory_budget bytes, estimated from the start of the file
+    with open(filename, "rb") as csv_file:
+        sample = csv_file.read(_SAMPLE_SIZE)
+    lines = max(sample.count(b"\n"), 1)
+    bytes_per_row = max(len(sample) / lines, 1)
+    return max(int(memory_budget / (bytes_per_row * _PARSE_OVERHEAD)), 1000)
+
+
+def compact(df):
+    for column in DATE_COLUMNS:
+        if column in df:
+            df[column] = pd.to_datetime(df[column], format="ISO8601", errors="coerce")
+    for column in CATEGORY_COLUMNS:
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    for column in STRING_COLUMNS:
+        if column in df and df[column].dtype != STRING_DTYPE:
+            df[column] = df[column].astype(STRING_DTYPE)
+    for column in INTEGER_COLUMNS:
+        if column in df:
+            df[column] = downcast_integer(df[column])
+    for column in FLOAT_COLUMNS:
+        if column in df:
+            df[column] = downcast_float(df[column])
+    return df
+
+
+def downcast_integer(series):
+    if series.isna().any():
+        # nullable integer so that missing values do not turn the column into floats
+        values = pd.to_numeric(series, errors="coerce")
+        if (values.dropna() % 1 != 0).any():
+            return values
+        for dtype in ("Int8", "Int16", "Int32", "Int64"):
+            info = np.iinfo(dtype.lower())
+            if values.min() >= info.min and values.max() <= info.max:
+                return values.astype(dtype)
+        return values
+    return pd.to_numeric(series, downcast="integer")
+
+
+def downcast_float(series):
+    values = pd.to_numeric(series, errors="coerce")
+    downcast = values.astype(np.float32)
+    if np.array_equal(downcast.to_numpy(np.float64), values.to_numpy(np.float64), equal_nan=True):
+        return downcast
+    return values
+
+
+def concat_chunks(chunks, columns):
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    combined = {}
+    for column in chunks[0].columns:
+        parts = [chunk[column] for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            # concatenating categoricals with different categories would fall back to python strings
+            combined[column] = pd.Series(union_categoricals(parts), name=column)
+        else:
+            combined[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(combined)
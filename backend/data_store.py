@@ -0,0 +1,280 @@
+import threading
+import time
+import uuid
+
+"""
+DataStore is the dictionary that backs Unified_data_structure.data.
+It behaves like a normal dict (key = string description of the dataset, value = pandas dataframe or dictionary),
+but an entry can also be registered together with the loader that ingests it. Registered entries are only
+ingested the first time they are accessed, after which the loaded value is cached in the dict like any other value.
+    - keys(), `in` and len() never trigger a load, so the set of datasets is known without reading any file
+    - a single loader usually populates several keys (read_json populates 3 of them), so every key of a source
+      shares the same loader and the same lock, and a source is loaded at most once even with concurrent readers
+    - version is incremented every time a loaded value is replaced or deleted (filling a registered key by its loader does not
+      count as a change), so anything derived from the data can be cached for as long as version stays the same.
+      A dataframe that is modified in place does not go through __setitem__, call touch() after doing that.
+      key_version(key) is the version at which that key last changed, for caches that only depend on a single dataset
+    - a loaded key can be spilled: its value is dropped from memory and replaced by a function that reads it back (e.g.
+      from a file, see memory_budget). The key still counts as loaded and keeps its version, the next access pages the
+      value back in and keeps it, loaded_items() pages spilled values in one at a time, as it reaches them, without
+      keeping them
+    - replace_if(key, old, new) (like spill) only replaces the value of key while it is still old, so a value derived from
+      an older one (e.g. compacted) never overwrites a newer value written in the meantime
+    - a source whose loader fails is not tried again on every access: until its fingerprint (e.g. the stat of its file)
+      changes or retry_interval seconds have passed, accessing one of its keys raises SourceUnavailable straight away
+"""
+
+# placeholder value stored for a key that has been registered but not loaded yet
+_NOT_LOADED = object()
+
+
+class _Spilled:
+    # value stored for a spilled key, page_in() returns the value
+    def __init__(self, page_in):
+        self.page_in = page_in
+        self.lock = threading.Lock()
+
+
+class SourceUnavailable(Exception):
+    # a key of a source that failed to load was accessed
+    def __init__(self, source, reason):
+        super().__init__(source, reason)
+        self.source = source
+        self.reason = reason
+
+    def __str__(self):
+        return f"source '{self.source}' is not available: {self.reason}"
+
+
+class _Source:
+    def __init__(self, name, keys, loader, fingerprint=None):
+        self.name = name
+        self.keys = list(keys)
+        self.loader = loader
+        self.fingerprint = fingerprint  # changes when the source changes, a failed source is retried when it does
+        self.failure = None  # (reason, fingerprint, time.monotonic()) of the last failed load
+        self.lock = threading.Lock()
+
+
+class DataStore(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sources = {}  # key -> _Source that populates it
+        self.version = 0
+        self.retry_interval = 300  # seconds before a failed source whose fingerprint did not change is tried again
+        self._key_versions = {}  # key -> version at which it last changed
+        self._lock = threading.RLock()  # writes that check the current value first hold it
+        # versions are only comparable within the same DataStore, the token tells stores apart (e.g. across worker processes)
+        self.token = uuid.uuid4().hex
+
+    def register(self, name, keys, loader, fingerprint=None):
+        # register a source whose loader populates every key in keys (through __setitem__) when called
+        source = _Source(name, keys, loader, fingerprint)
+        for key in source.keys:
+            super().__setitem__(key, _NOT_LOADED)
+            self._sources[key] = source
+        return source
+
+    def is_loaded(self, key):
+        return super().__getitem__(key) is not _NOT_LOADED
+
+    def is_spilled(self, key):
+        return isinstance(super().__getitem__(key), _Spilled)
+
+    def spill(self, key, page_in, value):
+        # drops value, the value of key, from memory, page_in() returns it when the key is next accessed
+        # returns False (and keeps the key as it is) when key does not hold value anymore
+        with self._lock:
+            if super().__getitem__(key) is not value:
+                return False
+            super().__setitem__(key, _Spilled(page_in))
+        return True
+
+    def replace_if(self, key, old, new):
+        # sets key to new (as a change, like __setitem__) only if it still holds old, returns whether it did
+        with self._lock:
+            if key not in self or super().__getitem__(key) is not old:
+                return False
+            self[key] = new
+        return True
+
+    def spilled(self, key):
+        # the page_in function of a spilled key, None when the key is not spilled
+        value = super().__getitem__(key)
+        return value.page_in if isinstance(value, _Spilled) else None
+
+    def _page_in(self, key, spilled):
+        with spilled.lock:
+            # another thread could have paged it in (or replaced it) while we were waiting for the lock
+            if super().__getitem__(key) is spilled:
+                value = spilled.page_in()
+                with self._lock:
+                    if super().__getitem__(key) is spilled:
+                        super().__setitem__(key, value)
+        return self.load(key)
+
+    def load(self, key):
+        # ingest the source of key if it has not been loaded yet and return the value of key
+        value = super().__getitem__(key)
+        if isinstance(value, _Spilled):
+            return self._page_in(key, value)
+        if value is not _NOT_LOADED:
+            return value
+        source = self._sources.get(key)
+        if source is None:
+            # loaded by another thread in the meantime
+            return super().__getitem__(key)
+        with source.lock:
+            # another thread could have loaded this source while we were waiting for the lock
+            if super().__getitem__(key) is _NOT_LOADED:
+                self._run_loader(source)
+            value = super().__getitem__(key)
+        if value is _NOT_LOADED:
+            raise KeyError(f"loader for source '{source.name}' did not populate '{key}'")
+        return value
+
+    def _run_loader(self, source):
+        if not self._may_load(source):
+            raise SourceUnavailable(source.name, source.failure[0])
+        try:
+            source.loader()
+        except Exception as error:
+            reason = str(error) or type(error).__name__
+            source.failure = (reason, source.fingerprint() if source.fingerprint else None, time.monotonic())
+            raise SourceUnavailable(source.name, reason) from error
+        source.failure = None
+
+    def _may_load(self, source):
+        # False while a source that failed waits to be retried
+        if source.failure is None:
+            return True
+        _, fingerprint, failed_at = source.failure
+        if time.monotonic() - failed_at >= self.retry_interval:
+            return True
+        return source.fingerprint is not None and source.fingerprint() != fingerprint
+
+    def can_load(self, name):
+        # False when the source called name failed and may not be retried yet
+        return all(self._may_load(source) for source in self._sources.values() if source.name == name)
+
+    def load_all(self):
+        for key in list(self.keys()):
+            self.load(key)
+
+    def load_source(self, name):
+        # ingest every key of the source called name that is not loaded yet
+        for key in self._source_keys(name):
+            if key in self:
+                self.load(key)
+
+    def _source_keys(self, name):
+        return [key for key, source in list(self._sources.items()) if source.name == name]
+
+    def pending_sources(self):
+        # names of the sources that still have keys to load, in registration order
+        names = []
+        for key in self.unloaded_keys():
+            name = self._sources[key].name
+            if name not in names:
+                names.append(name)
+        return names
+
+    def unloaded_keys(self):
+        return [key for key in self.keys() if not self.is_loaded(key)]
+
+    def loaded_items(self, keys=None):
+        # iterator of the (key, value) of every loaded key (of keys, in that order, when given), without loading anything.
+        # The values, or for spilled keys the function that reads them, are taken when it is called, so the items stay
+        # those of that moment (taken under the lock of swap, so keys swapped together are all from before or all from after
+        # it). A spilled value is only read when the iteration reaches it and is not kept in memory
+        with self._lock:
+            values = [(key, super(DataStore, self).get(key, _NOT_LOADED)) for key in (self.keys() if keys is None else keys)]
+        return ((key, value.page_in() if isinstance(value, _Spilled) else value)
+                for key, value in values if value is not _NOT_LOADED)
+
+    def resident_items(self):
+        # (key, value) of every loaded key that is held in memory
+        return [(key, value) for key, value in super().items() if value is not _NOT_LOADED and not isinstance(value, _Spilled)]
+
+    @property
+    def version_tag(self):
+        # identifies the current content: the version and the number of keys that are loaded
+        loaded = sum(1 for value in super().values() if value is not _NOT_LOADED)
+        return f"{self.token}-{self.version}-{loaded}"
+
+    def key_version(self, key):
+        return self._key_versions.get(key, 0)
+
+    def touch(self, key=None):
+        self.version += 1
+        keys = [key] if key is not None else list(self.keys())
+        for key in keys:
+            self._key_versions[key] = self.version
+
+    def __getitem__(self, key):
+        return self.load(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            is_fill = key in self and super().__getitem__(key) is _NOT_LOADED
+            super().__setitem__(key, value)
+            self._sources.pop(key, None)
+            if not is_fill:
+                self.version += 1
+                self._key_versions[key] = self.version
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._sources.pop(key, None)
+            self.version += 1
+            self._key_versions[key] = self.version
+
+    def swap(self, entries, remove=()):
+        # sets every key of entries and deletes the keys in remove in one go (e.g. every key of a source that was ingested
+        # again). loaded_items() sees all of them before or all of them after the swap, reading a single key never waits
+        # (and gives it from before or after). Changed keys share a single new version
+        changed = []
+        with self._lock:
+            for key, value in entries.items():
+                if not (key in self and super().__getitem__(key) is _NOT_LOADED):
+                    changed.append(key)
+                super().__setitem__(key, value)
+                self._sources.pop(key, None)
+            for key in remove:
+                if key in self and key not in entries:
+                    super().__delitem__(key)
+                    self._sources.pop(key, None)
+                    changed.append(key)
+            if changed:
+                self.version += 1
+                for key in changed:
+                    self._key_versions[key] = self.version
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self.load(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self.load(key)
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def values(self):
+        return [self.load(key) for key in self.keys()]
+
+    def items(self):
+        return [(key, self.load(key)) for key in self.keys()]
+
+    def copy(self):
+        # copying is done on loaded values so that the copy never holds a placeholder
+        return dict(self.items())
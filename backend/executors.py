@@ -0,0 +1,72 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+"""
+The request handlers of DataAPIServer are async, so any blocking pandas / tabula / xlsxwriter / matplotlib call made
+directly in a handler blocks every other request of the worker. Executors moves that work off the event loop:
+    - run_io runs a function in a thread pool, for work that mostly waits (reading files, tabula's java subprocess)
+    - run_cpu runs a function in a process pool, for CPU heavy exports and renders, so that they do not hold the GIL of the
+      process that serves requests. Its arguments and result have to be picklable. It can be switched to a thread pool
+      (cpu_executor="thread") when pickling the data costs more than the work itself
+The pools are configured with the DATA_API_IO_WORKERS, DATA_API_CPU_WORKERS and DATA_API_CPU_EXECUTOR environment variables.
+
+SingleFlight coalesces identical concurrent work: while a computation for a key is in flight, every other caller asking for
+the same key awaits the same result instead of starting its own computation.
+"""
+
+
+class Executors:
+    def __init__(self, io_workers=None, cpu_workers=None, cpu_executor="process"):
+        self.io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="data-api-io")
+        if cpu_executor == "process":
+            # spawn rather than fork, forking a process that already runs threads (uvicorn, the io pool) is not safe
+            self.cpu_pool = ProcessPoolExecutor(max_workers=cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+        elif cpu_executor == "thread":
+            self.cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="data-api-cpu")
+        else:
+            raise ValueError(f"cpu_executor must be 'process' or 'thread', not '{cpu_executor}'")
+
+    @classmethod
+    def from_env(cls):
+        def workers(name):
+            value = os.environ.get(name)
+            return int(value) if value else None
+        return cls(
+            io_workers=workers("DATA_API_IO_WORKERS"),
+            cpu_workers=workers("DATA_API_CPU_WORKERS"),
+            cpu_executor=os.environ.get("DATA_API_CPU_EXECUTOR", "process"),
+        )
+
+    async def run_io(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, fn, *args)
+
+    async def run_cpu(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_pool, fn, *args)
+
+    def shutdown(self):
+        self.io_pool.shutdown(wait=False, cancel_futures=True)
+        self.cpu_pool.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._in_flight = {}  # key -> future of the computation currently running for that key
+
+    async def do(self, key, compute):
+        # compute is a coroutine function, it is only called when no computation for key is in flight
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(compute())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._forget(key, future))
+        # shield so that a caller that gets cancelled (e.g. client disconnected) does not cancel the shared computation
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    def in_flight(self):
+        return len(self._in_flight)
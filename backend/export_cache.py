@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+"""
+Exported artifacts (the consolidated json, the xlsx workbook and the visualisation png) only depend on self.data,
+so they are cached in memory keyed by (kind of artifact, data version) and only regenerated after the data changes.
+The cache holds at most max_entries artifacts and max_bytes bytes of them, the least recently used go first.
+Every artifact carries a strong ETag, which the server uses to answer If-None-Match with a 304. The ETag of a cached artifact
+comes from its cache key (key_etag: kind, data version tag and options) rather than from its bytes: renders of the same
+data are not byte for byte identical (creation time of the xlsx, date of the svg, timestamps in zips), and the ETag has to
+stay the same after an eviction and on every worker attached to the same snapshot.
+"""
+
+
+class ExportArtifact:
+    def __init__(self, body, media_type, filename, etag=None):
+        self.body = body
+        self.media_type = media_type
+        self.filename = filename
+        self.etag = etag or '"' + hashlib.sha256(body).hexdigest() + '"'
+
+
+class ExportCache:
+    def __init__(self, max_entries=16, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            artifact = self._entries.get(key)
+            if artifact is not None:
+                self._entries.move_to_end(key)
+            return artifact
+
+    def put(self, key, artifact):
+        if self.max_bytes is not None and len(artifact.body) > self.max_bytes:
+            return  # would push every other artifact out
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+            self._entries[key] = artifact
+            self._bytes += len(artifact.body)
+            # least recently used artifacts are dropped first
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, dropped = self._entries.popitem(last=False)
+                self._bytes -= len(dropped.body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+def key_etag(key):
+    # strong etag of the artifact cached under key (a tuple of strings, numbers and tuples of them)
+    return '"' + hashlib.sha256(repr(key).encode()).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match can be "*" or a comma separated list of (possibly weak) etags
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import pickle
+import threading
+
+"""
+A persistent cache for the parsed datasets, so that restarting the server does not re-parse source files that have not changed.
+    - every entry is the dictionary of self.data entries (key -> dataframe or dict) that a reader produced for a source file
+    - entries are pickled (highest protocol, which stores the numpy buffers of a dataframe as raw bytes) into cache_dir
+    - the key of an entry is built from the reader's namespace, the absolute path of the source file, its size, its mtime and
+      a hash of its content, so editing (or replacing) a source file always misses the cache (only the hash of the last
+      version of a file is kept in memory)
+    - the total size of cache_dir is bounded by max_bytes, the least recently used entries are evicted first
+"""
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class IngestionCache:
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # path -> (size, mtime, content hash) of its last version, so an unchanged file is only hashed once per process
+        self._content_hashes = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fingerprint(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stat_key = (path, stat.st_size, stat.st_mtime_ns)
+        cached = self._content_hashes.get(path)
+        content_hash = cached[2] if cached is not None and cached[:2] == stat_key[1:] else None
+        if content_hash is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as source_file:
+                for chunk in iter(lambda: source_file.read(_HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            content_hash = digest.hexdigest()
+            self._content_hashes[path] = stat_key[1:] + (content_hash,)
+        return stat_key + (content_hash,)
+
+    def _entry_path(self, namespace, path):
+        key = "|".join(str(part) for part in (namespace,) + self.fingerprint(path))
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".pkl")
+
+    def get(self, namespace, path):
+        # returns the cached value for the current version of path, or None on a miss
+        entry_path = self._entry_path(namespace, path)
+        try:
+            with open(entry_path, "rb") as entry_file:
+                value = pickle.load(entry_file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a corrupt or incompatible entry is treated as a miss and dropped
+            self._remove(entry_path)
+            return None
+        # mtime of an entry is used as its last access time for the LRU eviction
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, namespace, path, value):
+        entry_path = self._entry_path(namespace, path)
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as entry_file:
+            pickle.dump(value, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        # delete least recently used entries until the cache fits in max_bytes
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".pkl"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(os.path.join(self.cache_dir, name))
+                total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pkl"):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    def _remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,100 @@
+import datetime
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is used when it is not installed
+    orjson = None
+
+"""
+Streaming serializer for the consolidated json.
+Instead of converting every dataframe to a list of dicts, building one big nested dict and dumping it in one go,
+iter_json yields the document in small chunks of bytes: each dataframe is converted and encoded BATCH_SIZE rows at a time,
+so memory stays flat no matter how big the customer and employee tables are. The output is compact json, in the same
+layout as before: {"employees": {"<company index>": [records]}, "<dataset>": [records] or {dict}, ...}
+Null values are written as the string "null" (same as the previous fillna("null")).
+"""
+
+BATCH_SIZE = 1000
+
+
+def _default(value):
+    # values that neither encoder handles natively (timestamps, numpy scalars, categoricals...)
+    if isinstance(value, pd.Timestamp) and value == value.normalize():
+        # dates without a time are written as plain dates, like they are in the source files
+        return value.date().isoformat()
+    if isinstance(value, (pd.Timestamp, datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=_default, separators=(",", ":")).encode()
+
+
+def records(df):
+    # list of records of a (small) dataframe, with null values replaced by "null"
+    df = df.astype(object)
+    return df.where(df.notna(), "null").to_dict(orient="records")
+
+
+def iter_records(df, batch_size=BATCH_SIZE):
+    # yields a dataframe as a json list of records, batch_size rows at a time
+    yield b"["
+    for start in range(0, len(df), batch_size):
+        encoded = dumps(records(df.iloc[start:start + batch_size]))
+        # strip the brackets of the encoded batch so that the batches join into a single list
+        yield (b"," if start else b"") + encoded[1:-1]
+    yield b"]"
+
+
+def iter_json(items, batch_size=BATCH_SIZE):
+    # items are the (key, value) of Unified_data_structure.data with employees first (DataStore.loaded_items, whose items
+    # are those of the moment it was called, so that a dataset replaced while the document is streamed does not end up
+    # half old and half new). They are consumed one at a time, a spilled table is only in memory while it is encoded
+    yield b'{"employees":{'
+    employees = True
+    for key, value in items:
+        if key == "employees" and employees:
+            for n, (company, df) in enumerate(value.items()):
+                yield (b"," if n else b"") + dumps(str(company)) + b":"
+                yield from iter_records(df, batch_size)
+            continue
+        if employees:
+            yield b"}"
+            employees = False
+        yield b"," + dumps(key) + b":"
+        if isinstance(value, pd.DataFrame):
+            yield from iter_records(value, batch_size)
+        else:
+            yield dumps(value)
+    if employees:
+        yield b"}"
+    yield b"}"
+
+
+def iter_changes(result, batch_size=BATCH_SIZE):
+    # encodes the result of Unified_data_structure.changes_since: its fields, then either "data" (the whole dataset,
+    # streamed like iter_json does) or "changes" (the row level changes, which are small)
+    fields = {key: value for key, value in result.items() if key not in ("data", "changes")}
+    yield dumps(fields)[:-1]
+    if "data" in result:
+        yield b',"data":'
+        if isinstance(result["data"], pd.DataFrame):
+            yield from iter_records(result["data"], batch_size)
+        else:
+            yield dumps(result["data"])
+    else:
+        changes = [{
+            "version": change.version,
+            **{name: records(frame) for name, frame in
+               (("inserted", change.inserted), ("updated", change.updated), ("deleted", change.deleted)) if frame is not None},
+        } for change in result["changes"]]
+        yield b',"changes":' + dumps(changes)
+    yield b"}"
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library decoder is used when it is not installed
+    orjson = None
+
+"""
+Columnar ingestion of the companies feed (dataset1.json).
+Instead of building one small dataframe per company, every company is flattened into plain records which are turned into
+dataframes in bulk, BATCH_SIZE records at a time:
+    companies            one row per company (without its employees and performance), with a company_id column
+    employees            one row per employee of every company, with the company_id of its company
+    companies_performance one row per (company, quarter), with company_id, quarter and one column per metric
+                         e.g. {"2023_Q1": {"revenue": 1, "profit_margin": 2}} -> company_id, "2023_Q1", 1, 2
+The company_id of a company is its "id" (or its position in the feed when it has no id).
+
+iter_companies parses the feed incrementally, one company at a time, so the whole file never has to be loaded as python objects.
+EmployeesView keeps the old per-company view (company index -> dataframe of its employees) as a cheap grouped view over the
+single employees frame: only the row positions of every company are stored and a company's dataframe is built on access.
+
+When the feed is edited, diff_companies compares every company with a digest of its last ingested version and
+splice_companies replaces the rows of the companies that changed in the three frames, so only those companies are flattened
+again (see source_watcher).
+"""
+
+BATCH_SIZE = 100_000
+_CHUNK_SIZE = 1024 * 1024
+_WHITESPACE = " \t\r\n"
+
+
+def load_companies(filename, key="companies"):
+    # the whole feed at once, for files small enough to be loaded in memory
+    with open(filename, "rb") as json_file:
+        content = json_file.read()
+    document = orjson.loads(content) if orjson is not None else json.loads(content)
+    return document[key]
+
+
+def iter_companies(filename, key="companies", chunk_size=_CHUNK_SIZE):
+    # yields the elements of the top level array document[key] one at a time, reading the file chunk_size characters at a time
+    decoder = json.JSONDecoder()
+    with open(filename, encoding="utf-8") as json_file:
+        buffer = ""
+        eof = False
+
+        def read_more(size=chunk_size):
+            nonlocal buffer, eof
+            chunk = json_file.read(size)
+            eof = not chunk
+            buffer += chunk
+
+        # find the opening bracket of the array
+        marker = json.dumps(key)
+        while True:
+            start = buffer.find(marker)
+            if start != -1:
+                position = start + len(marker)
+                while position < len(buffer) and buffer[position] in _WHITESPACE + ":":
+                    position += 1
+                if position < len(buffer):
+                    if buffer[position] != "[":
+                        raise ValueError(f"'{key}' in {filename} is not a list")
+                    position += 1
+                    break
+            if eof:
+                raise ValueError(f"no '{key}' list in {filename}")
+            read_more()
+
+        while True:
+            # skip whitespace and the comma between two elements
+            while position < len(buffer) and buffer[position] in _WHITESPACE + ",":
+                position += 1
+            if position == len(buffer):
+                if eof:
+                    raise ValueError(f"unterminated '{key}' list in {filename}")
+                buffer, position = "", 0
+                read_more()
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the element is cut by the end of the buffer, unless there is nothing more to read. The buffer at least
+                # doubles before the element is decoded again, so a big element is decoded a logarithmic number of times
+                if eof:
+                    raise
+                buffer, position = buffer[position:], 0
+                read_more(max(chunk_size, len(buffer)))
+                continue
+            yield element
+            position = end
+
+
+def flatten_companies(companies, batch_size=BATCH_SIZE):
+    # companies is any iterable of company dicts, returns (companies, employees, companies_performance) dataframes
+    company_frames, employee_frames, performance_frames = [], [], []
+    company_records, performance_records = [], []
+    # employee dicts are not copied to add their company_id, the column is built in one go from the number of employees per company
+    employee_records, employee_company_ids, employee_counts = [], [], []
+
+    def flush():
+        # bulk conversion of the records collected so far
+        if company_records:
+            company_frames.append(pd.DataFrame.from_records(company_records))
+            company_records.clear()
+        if employee_records:
+            frame = pd.DataFrame.from_records(employee_records)
+            frame.insert(0, "company_id", np.repeat(np.array(employee_company_ids, dtype=object), employee_counts))
+            employee_frames.append(frame.infer_objects())
+            employee_records.clear()
+            employee_company_ids.clear()
+            employee_counts.clear()
+        if performance_records:
+            performance_frames.append(pd.DataFrame.from_records(performance_records))
+            performance_records.clear()
+
+    for position, company in enumerate(companies):
+        company = dict(company)
+        employees = company.pop("employees", None) or []
+        performance = company.pop("performance", None) or {}
+        company_id = company.get("id", position)
+        company_records.append({"company_id": company_id, **company})
+        if employees:
+            employee_records.extend(employees)
+            employee_company_ids.append(company_id)
+            employee_counts.append(len(employees))
+        for quarter, metrics in performance.items():
+            performance_records.append({"company_id": company_id, "quarter": quarter, **(metrics or {})})
+        if len(employee_records) >= batch_size or len(company_records) >= batch_size:
+            flush()
+    flush()
+
+    return (
+        _concat(company_frames, ["company_id"]),
+        _concat(employee_frames, ["company_id"]),
+        _concat(performance_frames, ["company_id", "quarter"]),
+    )
+
+
+def _concat(frames, columns):
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+class EmployeesView(dict):
+    # company index (position of the company in the companies frame) -> dataframe of the employees of that company
+    def __init__(self, frame, company_ids):
+        super().__init__()
+        self.frame = frame
+        self.company_ids = list(company_ids)
+        positions = frame.groupby("company_id", sort=False).indices if len(frame) else {}
+        for i, company_id in enumerate(self.company_ids):
+            super().__setitem__(i, positions.get(company_id, np.empty(0, dtype=np.intp)))
+
+    def _company_frame(self, positions):
+        return self.frame.iloc[positions].drop(columns="company_id").reset_index(drop=True)
+
+    def __getitem__(self, key):
+        return self._company_frame(super().__getitem__(key))
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def copy(self):
+        return EmployeesView(self.frame, self.company_ids)
+
+    def __reduce__(self):
+        # pickle the single frame, not the per-company dataframes
+        return (EmployeesView, (self.frame, self.company_ids))
+
+
+def company_digest(company):
+    content = orjson.dumps(company, option=orjson.OPT_SORT_KEYS) if orjson is not None else json.dumps(company, sort_keys=True).encode()
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+def diff_companies(companies, digests=None):
+    # companies: iterable of the companies of the feed, digests: {company_id: company_digest} of the ingested ones
+    # returns (digests of the feed in feed order, companies that are new or changed), or None when a company has no id
+    # (its company_id is its position, which an insertion shifts for every company after it) or an id is repeated.
+    # With digests=None only the digests of the feed are computed
+    current, changed = {}, []
+    for company in companies:
+        if "id" not in company or company["id"] in current:
+            return None
+        digest = company_digest(company)
+        current[company["id"]] = digest
+        if digests is not None and digests.get(company["id"]) != digest:
+            changed.append(company)
+    return current, changed
+
+
+def splice_companies(frames, changed_frames, order):
+    # frames / changed_frames: (companies, employees, companies_performance) of the ingested feed and of the changed
+    # companies, order: company ids of the feed in feed order. Returns the frames of the feed
+    position = {company_id: n for n, company_id in enumerate(order)}
+    replaced = set(changed_frames[0]["company_id"]) | (set(frames[0]["company_id"]) - set(position))
+    spliced = []
+    for frame, changed in zip(frames, changed_frames):
+        kept = frame[~frame["company_id"].isin(replaced)]
+        if len(kept) and len(changed):
+            # columns the changed companies leave empty take the dtype of the kept rows
+            changed = changed.dropna(axis=1, how="all")
+        combined = _concat([part for part in (kept, changed) if len(part)] or [kept], list(frame.columns))
+        combined = combined.reindex(columns=frame.columns)
+        # rows of a company stay in the order they had, companies follow the feed
+        combined = combined.iloc[np.argsort(combined["company_id"].map(position).to_numpy(), kind="stable")]
+        spliced.append(combined.reset_index(drop=True))
+    return tuple(spliced)
+
+
+def employees_frame(employees):
+    # single dataframe of every employee with its company_id, employees is an EmployeesView or a plain dict of
+    # company -> dataframe (in which case the company_id is the key of the company)
+    if hasattr(employees, "frame"):
+        return employees.frame
+    frames = [df.assign(company_id=company) for company, df in employees.items()]
+    return _concat(frames, ["company_id"])
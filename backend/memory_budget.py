@@ -0,0 +1,166 @@
+import os
+import pickle
+import re
+import sys
+import pandas as pd
+
+import csv_ingestion
+from json_ingestion import EmployeesView
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is optional, without it text columns stay python strings and spill files are pickles
+    pa = None
+
+"""
+Compact in-memory representation of the datasets of Unified_data_structure.data, and spilling of datasets to disk.
+
+compact_value converts every column of a table to the most compact dtype that holds the same values:
+    ISO date text           parsed to datetime64
+    text with few distinct  categoricals (at most CATEGORY_RATIO distinct values per row)
+    values
+    other text              Arrow backed strings (string[pyarrow]), one buffer instead of one python object per value
+    integers                downcast to the smallest integer type that holds every value (see csv_ingestion)
+    floats                  float32 only when that is lossless
+Columns mixing text with other objects are left as they are. employees is compacted through its single frame.
+
+footprint(value) is the memory held by a dataset in bytes (deep, so python strings count with their real size).
+spill(value, directory, name) writes a table to an uncompressed Arrow IPC file and returns a SpillFile, calling it pages
+the table back in: the file is memory mapped and most columns point straight into the mapping (see read_table).
+"""
+
+CATEGORY_RATIO = 0.5
+
+_ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?")
+
+
+def _is_text(values):
+    return all(isinstance(value, str) for value in values)
+
+
+def compact_series(series):
+    # series in its most compact dtype (series itself when there is nothing to gain)
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+        return series
+    if pd.api.types.is_integer_dtype(dtype):
+        return csv_ingestion.downcast_integer(series)
+    if pd.api.types.is_float_dtype(dtype):
+        return csv_ingestion.downcast_float(series)
+    if dtype != object:
+        return series
+    values = series.dropna()
+    if not len(values):
+        return series
+    distinct = pd.unique(values)
+    if not _is_text(distinct):
+        return series
+    if all(_ISO_DATE.fullmatch(value) for value in distinct):
+        dates = pd.to_datetime(series, format="ISO8601", errors="coerce")
+        if dates.notna().sum() == len(values):
+            return dates
+    if len(distinct) <= CATEGORY_RATIO * len(series):
+        return series.astype("category")
+    if pa is not None:
+        return series.astype("string[pyarrow]")
+    return series
+
+
+def compact_frame(df):
+    # copy of df with every column in its most compact dtype, df itself when no column changes
+    columns = [compact_series(df.iloc[:, i]) for i in range(df.shape[1])]
+    if all(column.dtype == df.dtypes.iloc[i] for i, column in enumerate(columns)):
+        return df
+    compacted = df.copy(deep=False)
+    for i, column in enumerate(columns):
+        compacted.isetitem(i, column)
+    return compacted
+
+
+def compact_value(value):
+    # compact version of a dataset of Unified_data_structure.data, value itself when it is already compact
+    if isinstance(value, EmployeesView):
+        frame = compact_frame(value.frame)
+        return value if frame is value.frame else EmployeesView(frame, value.company_ids)
+    if isinstance(value, pd.DataFrame):
+        return compact_frame(value)
+    return value
+
+
+def footprint(value):
+    # bytes held in memory by a dataset
+    if isinstance(value, EmployeesView):
+        return footprint(value.frame) + sum(positions.nbytes for positions in dict.values(value))
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(key) + sys.getsizeof(item) for key, item in value.items())
+    return sys.getsizeof(value)
+
+
+def spillable(value):
+    # only tables are spilled, dict datasets are a handful of values
+    return isinstance(value, (pd.DataFrame, EmployeesView))
+
+
+def _file_stem(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+
+def write_table(frame, stem):
+    # writes frame to stem + ".arrow" (uncompressed Arrow IPC file), or stem + ".pickle" when arrow cannot hold one of its
+    # columns, returns the path. The file is written next to the final one and renamed, so readers never see half of it
+    table = _arrow_table(frame) if pa is not None else None
+    path = stem + (".arrow" if table is not None else ".pickle")
+    temporary = f"{path}.{os.getpid()}.tmp"
+    if table is not None:
+        with pa.OSFile(temporary, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        with open(temporary, "wb") as table_file:
+            pickle.dump(frame, table_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+    return path
+
+
+def read_table(path):
+    # dataframe of a file written by write_table. Arrow files are memory mapped and converted without copying where pandas
+    # allows it (numbers and dates without nulls, categorical codes, string[pyarrow] columns): the columns point into the
+    # mapping, which stays open for as long as they are referenced
+    if path.endswith(".arrow"):
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        # string[pyarrow] columns are stored as large_string, object columns of text as string
+        return table.to_pandas(split_blocks=True, types_mapper={pa.large_string(): pd.StringDtype("pyarrow")}.get)
+    with open(path, "rb") as table_file:
+        return pickle.load(table_file)
+
+
+def _arrow_table(frame):
+    try:
+        return pa.Table.from_pandas(frame)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None  # object columns mixing types, pickled instead
+
+
+class SpillFile:
+    # a table spilled to disk, calling it reads the table back
+    def __init__(self, path, company_ids=None):
+        self.path = path
+        self.company_ids = company_ids  # employees is spilled as its frame, the view is rebuilt on page in
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def __call__(self):
+        frame = read_table(self.path)
+        return frame if self.company_ids is None else EmployeesView(frame, self.company_ids)
+
+
+def spill(value, directory, name):
+    # writes a table (dataframe or EmployeesView) to directory, returns the SpillFile to read it back with
+    frame = value.frame if isinstance(value, EmployeesView) else value
+    company_ids = value.company_ids if isinstance(value, EmployeesView) else None
+    os.makedirs(directory, exist_ok=True)
+    # a dataset that is paged in while it is spilled again keeps mapping the file it was read from
+    return SpillFile(write_table(frame, os.path.join(directory, _file_stem(name))), company_ids)
@@ -0,0 +1,251 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, the resident memory is read from /proc when it is not installed
+    psutil = None
+
+"""
+Instrumentation of the data api: counters and histograms in the Prometheus text format, and a sampling profiler.
+
+Every reader, parser and exporter of Unified_data_structure and every route of DataAPIServer runs inside a stage (see
+stage / instrument), which records:
+    data_api_stage_duration_seconds     histogram of the wall time of the stage
+    data_api_stage_memory_bytes         histogram of how much the resident memory of the process grew during the stage
+                                        (stages running at the same time share that growth, so it is an upper bound)
+    data_api_stage_calls_total          counter of calls, with an "outcome" label (ok / error)
+and the server records data_api_requests_total and data_api_request_duration_seconds for every route. REGISTRY.render()
+returns every metric in the Prometheus text exposition format, which the server serves on /metrics.
+Stages that run in the process pool of the server (renders) are timed from the server, around the call to the pool.
+
+profile(interval) samples the python stacks of every thread of the process while a block of code runs (e.g. one request),
+and returns the samples in the folded format of flame graph tools ("frame;frame;frame count" per line).
+"""
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MEMORY_BUCKETS = tuple(2 ** power for power in range(16, 34, 2))  # 64KB to 4GB
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name, self.documentation, self.label_names = name, documentation, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function  # computes the value when the metrics are rendered
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        if self.function is not None:
+            self.set(value=self.function())
+        return super().render()
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        self.name, self.documentation, self.label_names = name, documentation, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [counts per bucket, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        with self._lock:
+            series = self._series.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][n] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (_number(bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+def resident_memory():
+    # resident memory of the process in bytes (0 when it cannot be read)
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+REGISTRY = Registry()
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "data_api_stage_duration_seconds", "Wall time of a stage of ingestion, export or rendering", ["stage"]))
+STAGE_MEMORY = REGISTRY.register(Histogram(
+    "data_api_stage_memory_bytes", "Growth of the resident memory of the process during a stage", ["stage"], MEMORY_BUCKETS))
+STAGE_CALLS = REGISTRY.register(Counter(
+    "data_api_stage_calls_total", "Calls of a stage by outcome", ["stage", "outcome"]))
+REQUESTS = REGISTRY.register(Counter(
+    "data_api_requests_total", "Requests by route, method and status code", ["route", "method", "status"]))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "data_api_request_duration_seconds", "Wall time of a request until its response starts", ["route"]))
+REGISTRY.register(Gauge(
+    "data_api_process_resident_memory_bytes", "Resident memory of the process", function=resident_memory))
+
+
+@contextmanager
+def stage(name):
+    started, memory = time.perf_counter(), resident_memory()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        STAGE_DURATION.observe(name, value=time.perf_counter() - started)
+        STAGE_MEMORY.observe(name, value=max(resident_memory() - memory, 0))
+        STAGE_CALLS.inc(name, outcome)
+
+
+def instrument(name):
+    # decorator running the function in stage(name)
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def iter_stage(name, iterable):
+    # yields from iterable, the time spent producing the items is recorded as stage(name) (e.g. encoding a streamed json)
+    memory, busy = resident_memory(), 0.0
+    outcome = "error"
+    try:
+        iterator = iter(iterable)
+        while True:
+            produced = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                busy += time.perf_counter() - produced
+                break
+            busy += time.perf_counter() - produced
+            yield item
+        outcome = "ok"
+    finally:
+        STAGE_DURATION.observe(name, value=busy)
+        STAGE_MEMORY.observe(name, value=max(resident_memory() - memory, 0))
+        STAGE_CALLS.inc(name, outcome)
+
+
+# frames in which an idle thread waits, their samples are left out of profiles
+_IDLE = {("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select"), ("threading.py", "_wait_for_tstate_lock"),
+         ("thread.py", "_worker")}
+
+
+class Profile:
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = _Tally()
+        self.duration = 0.0
+
+    def folded(self):
+        # one "frame;frame;...;frame count" line per distinct stack, most sampled first
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+@contextmanager
+def profile(interval=0.005):
+    # samples the stacks of every thread every interval seconds while the block runs, yields the Profile
+    result = Profile(interval)
+    stop = threading.Event()
+    sampler_id = []
+
+    def sample():
+        sampler_id.append(threading.get_ident())
+        while not stop.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id[0]:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                result.samples[";".join(reversed(stack))] += 1
+
+    sampler = threading.Thread(target=sample, name="profiler", daemon=True)
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        sampler.join()
+        result.duration = time.perf_counter() - started
@@ -0,0 +1,193 @@
+import csv
+import importlib.util
+import io
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import pandas as pd
+
+try:
+    import pdfplumber
+except ImportError:  # pdfplumber is optional, tables are extracted with tabula when it is not installed
+    pdfplumber = None
+
+"""
+Extraction of every table of a pdf, with the page and the position it was found at.
+
+tabula.read_pdf(filename, pages='all') starts a new java process for every call and read_pdf used to keep only dfs[0].
+PdfTableExtractor instead:
+    - uses a backend that does not start a JVM per call:
+        "pdfplumber"  pure python (default when pdfplumber is installed), no JVM at all
+        "tabula"      tabula-java, which runs in a single JVM that stays alive inside this process when jpype is installed
+                      (tabula-py falls back to one java subprocess per call without it)
+    - extracts the pages of big documents in parallel, PAGES_PER_TASK pages per task (in a process pool for pdfplumber, in a
+      thread pool for tabula as the JVM is shared), and several documents in parallel with extract_many. Without jpype,
+      tabula extracts a document in a single call (a single java process) like it used to
+    - returns every table as an ExtractedTable: the page (1-based), the index of the table on its page, its bounding box
+      (top, left, bottom, right in pdf points) and a dataframe whose first row is the header. Cells are typed the same way
+      tabula types them (the table is read back with pd.read_csv), so a single table document gives the same dataframe as before
+measure_throughput gives the pages per second of an extractor over a corpus of pdfs.
+"""
+
+PAGES_PER_TASK = 4
+# tabula-py runs tabula-java inside this process with jpype, and starts a java process per call without it
+_TABULA_IN_PROCESS = importlib.util.find_spec("jpype") is not None
+# documents with fewer pages than this are extracted inline, a pool costs more than it saves
+PARALLEL_MIN_PAGES = 8
+
+
+class ExtractedTable:
+    def __init__(self, page, index, top, left, bottom, right, frame):
+        self.page = page
+        self.index = index
+        self.top = top
+        self.left = left
+        self.bottom = bottom
+        self.right = right
+        self.frame = frame
+
+    def metadata(self):
+        return {
+            "page": self.page, "index": self.index,
+            "top": self.top, "left": self.left, "bottom": self.bottom, "right": self.right,
+            "rows": len(self.frame), "columns": len(self.frame.columns),
+        }
+
+
+def _frame(rows):
+    # the header is the first row, cells are typed like tabula does (its csv output is read with pd.read_csv)
+    rows = [["" if cell is None else str(cell).replace("\r", " ").strip() for cell in row] for row in rows]
+    rows = [row for row in rows if any(row)]
+    if not rows:
+        return None
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return pd.read_csv(buffer)
+
+
+def count_pages(filename):
+    if pdfplumber is not None:
+        with pdfplumber.open(filename) as pdf:
+            return len(pdf.pages)
+    # without a pdf library, count the page objects (0 when they are hidden in compressed object streams)
+    with open(filename, "rb") as pdf_file:
+        return len(re.findall(rb"/Type\s*/Page(?![a-zA-Z])", pdf_file.read()))
+
+
+def _pdfplumber_pages(filename, pages):
+    tables = []
+    with pdfplumber.open(filename) as pdf:
+        for page_number in pages:
+            page = pdf.pages[page_number - 1]
+            for index, table in enumerate(page.find_tables()):
+                frame = _frame(table.extract())
+                if frame is not None:
+                    left, top, right, bottom = table.bbox
+                    tables.append(ExtractedTable(page_number, index, top, left, bottom, right, frame))
+    return tables
+
+
+def _tabula_pages(filename, pages):
+    import tabula
+    # tabula-java does not give the page of a table, so the pages of a task are read one call each: with jpype these are
+    # calls into the JVM of this process. Without it _tasks gives a single task (pages=None) for the whole document, that
+    # is a single java process, in which case the page of a table is unknown
+    results = [(page, tabula.read_pdf(filename, pages=page or "all", output_format="json", silent=True))
+               for page in (pages or [None])]
+    tables = []
+    for page, page_tables in results:
+        for index, table in enumerate(page_tables):
+            frame = _frame([[cell.get("text") for cell in row] for row in table.get("data", [])])
+            if frame is not None:
+                tables.append(ExtractedTable(page, index, table.get("top"), table.get("left"),
+                                             table.get("bottom"), table.get("right"), frame))
+    return tables
+
+
+_BACKENDS = {
+    "pdfplumber": _pdfplumber_pages,
+    "tabula": _tabula_pages,
+}
+
+
+class PdfTableExtractor:
+    def __init__(self, backend=None, workers=None):
+        if backend is None:
+            backend = "pdfplumber" if pdfplumber is not None else "tabula"
+        if backend not in _BACKENDS:
+            raise ValueError(f"unknown pdf backend '{backend}'")
+        if backend == "pdfplumber" and pdfplumber is None:
+            raise ImportError("the pdfplumber backend needs pdfplumber to be installed")
+        self.backend = backend
+        self.workers = workers or os.cpu_count()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # the pool stays alive across calls, pdfplumber pages run in processes, tabula pages in threads sharing the JVM
+        with self._lock:
+            if self._pool is None:
+                if self.backend == "pdfplumber":
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="pdf-extraction")
+            return self._pool
+
+    def _tasks(self, filename):
+        pages = count_pages(filename)
+        if pages == 0 or (self.backend == "tabula" and not _TABULA_IN_PROCESS):
+            # a java process per task would cost more than extracting the pages one after the other in a single one
+            return [None]
+        page_numbers = list(range(1, pages + 1))
+        return [page_numbers[start:start + PAGES_PER_TASK] for start in range(0, pages, PAGES_PER_TASK)]
+
+    def extract(self, filename):
+        # every table of the pdf, ordered by page and position on the page
+        return self.extract_many([filename])[filename]
+
+    def extract_many(self, filenames):
+        # filename -> tables of every pdf, the pages of every pdf are extracted in parallel
+        extract_pages = _BACKENDS[self.backend]
+        filenames = list(dict.fromkeys(filenames))
+        tasks = [(filename, pages) for filename in filenames for pages in self._tasks(filename)]
+        total_pages = sum(len(pages) if pages else 1 for _, pages in tasks)
+        if total_pages < PARALLEL_MIN_PAGES:
+            results = [extract_pages(filename, pages) for filename, pages in tasks]
+        else:
+            # the workers of the pool keep the working directory they were started in, they get absolute paths
+            pool = self._get_pool()
+            results = list(pool.map(extract_pages, [os.path.abspath(filename) for filename, _ in tasks], [pages for _, pages in tasks]))
+        tables = {filename: [] for filename in filenames}
+        for (filename, _), task_tables in zip(tasks, results):
+            tables[filename].extend(task_tables)
+        return tables
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def measure_throughput(extractor, filenames):
+    # pages per second of extractor over the corpus of pdfs in filenames
+    pages = sum(max(count_pages(filename), 1) for filename in filenames)
+    started = time.perf_counter()
+    extractor.extract_many(filenames)
+    return pages / (time.perf_counter() - started)
+
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def default_extractor(backend=None):
+    # one extractor (and one pool) per backend for the whole process
+    with _extractors_lock:
+        if backend not in _extractors:
+            _extractors[backend] = PdfTableExtractor(backend)
+        return _extractors[backend]
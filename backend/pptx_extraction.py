@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from pptx import Presentation
+from pptx.enum.shapes import MSO_SHAPE_TYPE, PP_PLACEHOLDER
+
+"""
+Generic scanner of pptx decks.
+Instead of reading a table at a fixed slide / shape index and keying in the text of the other slides by hand, every slide
+and every shape (shapes inside groups included) is walked and:
+    - every table becomes a dataframe, its first row is the header. Columns in which every cell is a number are parsed
+      to numbers (see parse_value)
+    - every text block made of "key: value" lines becomes a dict of key -> parsed value, e.g.
+          Revenue Distribution:
+          Gym: 40%                      ->  {"Gym": 40.0, "Pool": 25.0}
+          Pool: 25%
+Values are parsed with parse_value: currency amounts and thousands separators become numbers ("$10,400,000" -> 10400000,
+"1,520" -> 1520), percentages become the number of percent ("40%" -> 40.0), anything else stays text.
+
+Every table and block gets a key for Unified_data_structure.data, in snake case (see Deck.entries):
+    - a block is named after its heading line (the line ending with ":"), "Revenue Distribution:" -> "revenue_distribution"
+    - a table is named after the title of its slide, "Quarterly Metrics" -> "quarterly_metrics"
+    - without a name, the position is used: "slide3_table1", "slide3_text2"
+so a new deck does not need any code change.
+
+Decks are read slide by slide (iter_slides), and scan_decks scans several decks in parallel in a process pool.
+"""
+
+_NUMBER = re.compile(r"^(?P<sign>[-+]?)\s*(?P<currency>[$€£¥]?)\s*(?P<number>\d[\d,]*(?:\.\d+)?|\.\d+)\s*(?P<percent>%?)$")
+_TITLES = (PP_PLACEHOLDER.TITLE, PP_PLACEHOLDER.CENTER_TITLE)
+
+
+def parse_value(text):
+    # number for currency amounts, numbers with thousands separators and percentages, the stripped text otherwise
+    # (trailing punctuation like the "," of "25%," is ignored)
+    text = text.strip()
+    match = _NUMBER.match(text.rstrip(",;."))
+    if match is None:
+        return text
+    number = match.group("sign") + match.group("number").replace(",", "")
+    if match.group("percent") or "." in number:
+        return float(number)
+    return int(number)
+
+
+def _key(name):
+    return re.sub(r"[^0-9a-z]+", "_", name.lower()).strip("_")
+
+
+def _iter_shapes(shapes):
+    for shape in shapes:
+        if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+            yield from _iter_shapes(shape.shapes)
+        else:
+            yield shape
+
+
+def _is_title(shape):
+    return shape.is_placeholder and shape.placeholder_format.type in _TITLES
+
+
+def _table_frame(table):
+    rows = [[cell.text.strip() for cell in row.cells] for row in table.rows]
+    frame = pd.DataFrame(rows[1:], columns=rows[0]) if rows else pd.DataFrame()
+    for column in range(frame.shape[1]):
+        values = [parse_value(text) if text else None for text in frame.iloc[:, column]]
+        if all(value is None or not isinstance(value, str) for value in values) and any(value is not None for value in values):
+            frame.isetitem(column, pd.Series(values, index=frame.index).infer_objects())
+    return frame
+
+
+def _text_block(text_frame):
+    # (heading, dict) of a text block of "key: value" lines, None when it has none
+    heading, block = None, {}
+    for paragraph in text_frame.paragraphs:
+        line = paragraph.text.strip()
+        if not line:
+            continue
+        key, separator, value = line.partition(":")
+        if not separator or not key.strip():
+            continue
+        if value.strip():
+            block[key.strip()] = parse_value(value)
+        elif not block and heading is None:
+            heading = key.strip()
+    return (heading, block) if block else None
+
+
+class SlideContent:
+    def __init__(self, number, title):
+        self.number = number  # 1-based
+        self.title = title
+        self.tables = []  # dataframes
+        self.blocks = []  # (heading or None, dict)
+
+
+def iter_slides(filename):
+    # SlideContent of every slide of the deck, one slide at a time
+    for number, slide in enumerate(Presentation(filename).slides, start=1):
+        shapes = list(_iter_shapes(slide.shapes))
+        title = next((shape.text_frame.text.strip() for shape in shapes if _is_title(shape) and shape.has_text_frame), None)
+        content = SlideContent(number, title)
+        for shape in shapes:
+            if _is_title(shape):
+                continue
+            if shape.has_table:
+                content.tables.append(_table_frame(shape.table))
+            elif shape.has_text_frame:
+                block = _text_block(shape.text_frame)
+                if block is not None:
+                    content.blocks.append(block)
+        yield content
+
+
+class Deck:
+    def __init__(self, filename, slides):
+        self.filename = filename
+        self.slides = slides
+
+    def entries(self):
+        # key -> dataframe / dict of every table and text block of the deck, keys are unique (a repeated name gets _2, _3...)
+        entries = {}
+
+        def add(name, value):
+            key = _key(name) or "untitled"
+            n = 1
+            while key in entries:
+                n += 1
+                key = f"{_key(name) or 'untitled'}_{n}"
+            entries[key] = value
+
+        for slide in self.slides:
+            for n, frame in enumerate(slide.tables, start=1):
+                name = slide.title if slide.title and len(slide.tables) == 1 else None
+                add(name or f"slide{slide.number}_table{n}", frame)
+            for n, (heading, block) in enumerate(slide.blocks, start=1):
+                add(heading or f"slide{slide.number}_text{n}", block)
+        return entries
+
+
+def scan_deck(filename):
+    return Deck(filename, list(iter_slides(filename)))
+
+
+def scan_decks(filenames, workers=None):
+    # Deck of every file, in the same order, the decks are scanned in parallel in worker processes
+    filenames = list(filenames)
+    if len(filenames) <= 1:
+        return [scan_deck(filename) for filename in filenames]
+    workers = min(workers or os.cpu_count(), len(filenames))
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(scan_deck, filenames))
@@ -0,0 +1,264 @@
+import base64
+import json
+import threading
+from functools import reduce
+import numpy as np
+import pandas as pd
+
+import json_export
+
+"""
+Server side queries over the tables of Unified_data_structure.data (filtering, projection, sorting and cursor pagination),
+so that a client can fetch one page of a table instead of the whole dataset.
+
+Every query is answered from indexes instead of scanning the table:
+    - a hash index (value -> row positions) for equality filters on text / categorical columns
+    - a sorted index (argsort of the column) for range filters, equality filters on numbers / dates and for sorting
+Indexes are built the first time a column is used and kept until the dataset changes (see QueryEngine), so the cost of a
+query is the number of matching rows plus the size of the page, not the size of the table.
+Null values sort first and never match a filter.
+
+Pagination is keyset based: the cursor of the next page holds the sort key and the row position of the last row returned,
+so pages stay consistent when rows are appended between two requests.
+"""
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+OPERATORS = {"eq", "gt", "gte", "lt", "lte"}
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _sort_keys(series):
+    # comparable numpy array for a column: int64 nanoseconds for dates, float64 for numbers and python strings otherwise
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy(dtype="datetime64[ns]").view("int64")  # NaT is the smallest int64
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return series.to_numpy(dtype="float64", na_value=-np.inf)
+    return series.astype(object).where(series.notna(), "").astype(str).to_numpy(dtype=object)
+
+
+def _to_key(series, value):
+    # converts a value from the query string (or a cursor) to the key domain of _sort_keys
+    try:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return pd.Timestamp(value).value if not isinstance(value, int) else value
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            return float(value)
+    except (TypeError, ValueError):
+        raise QueryError(f"invalid value '{value}' for column '{series.name}'")
+    return str(value)
+
+
+def _uses_hash_index(series):
+    return not (pd.api.types.is_datetime64_any_dtype(series) or
+                (pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)))
+
+
+class _SortedColumn:
+    def __init__(self, series):
+        self.keys = _sort_keys(series)
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+        # rank of every row in the sort order
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(self.order))
+        # nulls take the smallest key, which a value can have too (e.g. "") and which every "lt" range starts from
+        nulls = series.isna().to_numpy()
+        self.nulls = nulls if nulls.any() else None
+
+    def range(self, low=None, low_inclusive=True, high=None, high_inclusive=True):
+        # row positions (in sort order) of the non null values within the bounds
+        start = 0 if low is None else np.searchsorted(self.sorted_keys, low, side="left" if low_inclusive else "right")
+        stop = len(self.sorted_keys) if high is None else np.searchsorted(self.sorted_keys, high, side="right" if high_inclusive else "left")
+        positions = self.order[start:max(start, stop)]
+        return positions if self.nulls is None else positions[~self.nulls[positions]]
+
+    def threshold(self, key, position, descending):
+        # rank that separates the rows before the cursor (key, position) from the rows after it
+        start = np.searchsorted(self.sorted_keys, key, side="left")
+        stop = np.searchsorted(self.sorted_keys, key, side="right")
+        # rows with the same key are ordered by position (stable argsort)
+        return start + np.searchsorted(self.order[start:stop], position, side="left" if descending else "right")
+
+
+class TableIndex:
+    def __init__(self, df):
+        self.df = df
+        self._lock = threading.Lock()
+        self._hash = {}
+        self._sorted = {}
+
+    def hash_index(self, column):
+        with self._lock:
+            if column not in self._hash:
+                self._hash[column] = self.df.groupby(column, sort=False, observed=True).indices
+            return self._hash[column]
+
+    def sorted_index(self, column):
+        with self._lock:
+            if column not in self._sorted:
+                self._sorted[column] = _SortedColumn(self.df[column])
+            return self._sorted[column]
+
+    def filter(self, column, conditions):
+        # sorted row positions that satisfy every (operator, value) condition on column
+        series = self.df[column]
+        equals = [value for operator, value in conditions if operator == "eq"]
+        ranges = [(operator, value) for operator, value in conditions if operator != "eq"]
+        results = []
+        if equals:
+            if _uses_hash_index(series):
+                groups = self.hash_index(column)
+                parts = [groups.get(value) for value in equals]
+            else:
+                sorted_column = self.sorted_index(column)
+                parts = [sorted_column.range(key, True, key, True) for key in (_to_key(series, value) for value in equals)]
+            parts = [part for part in parts if part is not None]
+            results.append(np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.intp))
+        if ranges:
+            sorted_column = self.sorted_index(column)
+            bounds = {"low": None, "low_inclusive": True, "high": None, "high_inclusive": True}
+            for operator, value in ranges:
+                key = _to_key(series, value)
+                if operator in ("gt", "gte"):
+                    bounds.update(low=key, low_inclusive=operator == "gte")
+                else:
+                    bounds.update(high=key, high_inclusive=operator == "lte")
+            results.append(np.sort(sorted_column.range(**bounds)))
+        return reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), results)
+
+
+class QueryEngine:
+    def __init__(self, data):
+        self.data = data
+        self._lock = threading.Lock()
+        self._indexes = {}  # dataset -> (key version of the dataset, TableIndex)
+
+    def index(self, dataset):
+        if dataset not in self.data:
+            raise KeyError(dataset)
+        version = self.data.key_version(dataset)
+        with self._lock:
+            cached = self._indexes.get(dataset)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        table = self.data[dataset]
+        # employees is queried as the single frame of every employee (with its company_id)
+        table = getattr(table, "frame", table)
+        if not isinstance(table, pd.DataFrame):
+            raise QueryError(f"'{dataset}' is not a table")
+        index = TableIndex(table)
+        with self._lock:
+            self._indexes[dataset] = (version, index)
+        return index
+
+    def forget(self, dataset):
+        # drops the indexes of dataset (they reference its dataframe, e.g. when it is spilled to disk)
+        with self._lock:
+            self._indexes.pop(dataset, None)
+
+    def query(self, dataset, filters=None, columns=None, sort=None, limit=DEFAULT_LIMIT, cursor=None):
+        """
+        filters: {column: [(operator, value), ...]}, operator is one of eq, gt, gte, lt, lte (several eq values mean "any of")
+        columns: list of columns to return (all by default)
+        sort: column to sort on, prefixed by "-" for a descending sort (row order by default)
+        limit: number of rows per page, cursor: next_cursor of the previous page
+        """
+        index = self.index(dataset)
+        df = index.df
+        columns = list(columns) if columns else list(df.columns)
+        for column in columns + list(filters or {}) + ([sort.lstrip("-")] if sort else []):
+            if column not in df.columns:
+                raise QueryError(f"'{dataset}' has no column '{column}'")
+        if not 1 <= limit <= MAX_LIMIT:
+            raise QueryError(f"limit must be between 1 and {MAX_LIMIT}")
+        for conditions in (filters or {}).values():
+            for operator, _ in conditions:
+                if operator not in OPERATORS:
+                    raise QueryError(f"unknown operator '{operator}'")
+
+        # rows matching every filter, smallest candidate sets first so that intersections stay cheap
+        matches = None
+        if filters:
+            candidates = sorted((index.filter(column, conditions) for column, conditions in filters.items()), key=len)
+            matches = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), candidates)
+
+        after = _decode_cursor(cursor, sort) if cursor else None
+        if sort:
+            positions, next_key = self._sorted_page(index, sort, matches, after, limit)
+        else:
+            positions, next_key = self._row_order_page(len(df), matches, after, limit)
+
+        page = df.iloc[positions[:limit]][columns]
+        next_cursor = None
+        if len(positions) > limit:
+            last = int(positions[limit - 1])
+            next_cursor = _encode_cursor(next_key(last), last, sort)
+        return {
+            "dataset": dataset,
+            "columns": columns,
+            "rows": json_export.records(page),
+            "next_cursor": next_cursor,
+        }
+
+    def _row_order_page(self, length, matches, after, limit):
+        start = after[1] + 1 if after else 0
+        if matches is None:
+            positions = np.arange(start, min(start + limit + 1, length))
+        else:
+            positions = matches[np.searchsorted(matches, start):][:limit + 1]
+        return positions, lambda position: None
+
+    def _sorted_page(self, index, sort, matches, after, limit):
+        descending = sort.startswith("-")
+        sorted_column = index.sorted_index(sort.lstrip("-"))
+        length = len(sorted_column.order)
+        threshold = None
+        if after:
+            key = _to_key(index.df[sort.lstrip("-")], after[0])
+            threshold = sorted_column.threshold(key, after[1], descending)
+        if matches is None:
+            # straight slice of the sort order
+            if descending:
+                start = length - threshold if threshold is not None else 0
+                positions = sorted_column.order[::-1][start:start + limit + 1]
+            else:
+                start = threshold or 0
+                positions = sorted_column.order[start:start + limit + 1]
+        else:
+            ranks = sorted_column.rank[matches]
+            if threshold is not None:
+                ranks = ranks[ranks < threshold] if descending else ranks[ranks >= threshold]
+            # only the first limit + 1 ranks are sorted (ranks are negated for a descending sort)
+            if descending:
+                ranks = -ranks
+            if len(ranks) > limit + 1:
+                ranks = np.partition(ranks, limit)[:limit + 1]
+            ranks = np.sort(ranks)
+            if descending:
+                ranks = -ranks
+            positions = sorted_column.order[ranks]
+        return positions, lambda position: _json_key(sorted_column.keys[position])
+
+
+def _json_key(key):
+    return key.item() if isinstance(key, np.generic) else key
+
+
+def _encode_cursor(key, position, sort):
+    payload = json.dumps({"k": key, "p": position, "s": sort or ""}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def _decode_cursor(cursor, sort):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        key, position, cursor_sort = payload["k"], int(payload["p"]), payload["s"]
+    except (ValueError, KeyError, TypeError):
+        raise QueryError("invalid cursor")
+    if cursor_sort != (sort or ""):
+        raise QueryError("cursor does not belong to this sort order")
+    return key, position
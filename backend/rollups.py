@@ -0,0 +1,111 @@
+import threading
+import pandas as pd
+
+"""
+Materialized rollups of the customers table.
+A rollup is the customers grouped by a list of dimensions (e.g. Location, or Activity and Month) with, for every group,
+the number of visits and the count / sum / mean of every measure (Revenue and Duration (Minutes)).
+Only counts and sums are stored, so a rollup is updated incrementally when new customer rows arrive: the new rows are
+grouped on their own and added to the stored groups, which costs O(new rows + groups) instead of a scan of every customer.
+Reading a rollup (and computing its means) costs O(groups).
+
+Rollups remember the version of "customers" they reflect (DataStore.key_version). When customers is replaced by something
+other than Unified_data_structure.append_customers, the rollups are stale and get rebuilt from scratch on their next read.
+"""
+
+MEASURES = ["Revenue", "Duration (Minutes)"]
+
+# dimensions that are not columns of the customers table but derived from them
+DERIVED_DIMENSIONS = {
+    "Month": lambda df: pd.to_datetime(df["Date"]).dt.strftime("%Y-%m"),
+}
+
+
+def _aggregate(df, dimensions):
+    # counts and sums of df grouped by dimensions
+    keys = [DERIVED_DIMENSIONS[dimension](df).rename(dimension) if dimension in DERIVED_DIMENSIONS else df[dimension]
+            for dimension in dimensions]
+    columns = {"count": pd.Series(1, index=df.index)}
+    for measure in MEASURES:
+        if measure in df:
+            values = pd.to_numeric(df[measure], errors="coerce").astype("float64")
+            columns[f"{measure}_count"] = values.notna().astype("int64")
+            columns[f"{measure}_sum"] = values.fillna(0)
+    # categorical dimensions are grouped as plain values so that groups of different batches line up
+    keys = [key.astype(object) if isinstance(key.dtype, pd.CategoricalDtype) else key for key in keys]
+    return pd.DataFrame(columns).groupby(keys, dropna=False).sum()
+
+
+class Rollup:
+    def __init__(self, dimensions):
+        self.dimensions = list(dimensions)
+        self.table = None
+
+    def build(self, df):
+        self.table = _aggregate(df, self.dimensions)
+
+    def add(self, df):
+        if len(df):
+            self.table = self.table.add(_aggregate(df, self.dimensions), fill_value=0)
+
+    def result(self):
+        table = self.table.reset_index()
+        result = table[self.dimensions + ["count"]].copy()
+        result["count"] = result["count"].astype("int64")
+        for measure in MEASURES:
+            if f"{measure}_sum" in table:
+                result[f"{measure}_sum"] = table[f"{measure}_sum"]
+                result[f"{measure}_mean"] = table[f"{measure}_sum"] / table[f"{measure}_count"].where(table[f"{measure}_count"] > 0)
+        return result
+
+
+class Rollups:
+    # every rollup of the customers table of data, by name
+    def __init__(self, data, definitions):
+        self.data = data
+        self.definitions = dict(definitions)
+        self._rollups = {}
+        self._version = None  # key version of customers the rollups reflect
+        self._lock = threading.Lock()
+
+    def define(self, name, dimensions):
+        for dimension in dimensions:
+            if dimension not in DERIVED_DIMENSIONS and dimension not in self.data["customers"]:
+                raise KeyError(f"customers has no column '{dimension}'")
+        with self._lock:
+            self.definitions[name] = list(dimensions)
+            self._rollups.pop(name, None)
+
+    def names(self):
+        return list(self.definitions)
+
+    def get(self, name):
+        # aggregated groups of the rollup (dimensions, count, <measure>_sum, <measure>_mean)
+        if name not in self.definitions:
+            raise KeyError(name)
+        with self._lock:
+            self._sync()
+            rollup = self._rollups.get(name)
+            if rollup is None:
+                rollup = Rollup(self.definitions[name])
+                rollup.build(self.data["customers"])
+                self._rollups[name] = rollup
+            return rollup.result()
+
+    def add(self, rows, previous_version, version):
+        # rows were appended to customers, which went from previous_version to version
+        with self._lock:
+            if self._version == previous_version:
+                for rollup in self._rollups.values():
+                    rollup.add(rows)
+                self._version = version
+            else:
+                # the rollups missed another change of customers, they are rebuilt on their next read
+                self._rollups.clear()
+                self._version = None
+
+    def _sync(self):
+        version = self.data.key_version("customers")
+        if self._version != version:
+            self._rollups.clear()
+            self._version = version
@@ -1,9 +1,22 @@
-from fastapi import FastAPI, HTTPException, Path
+from fastapi import FastAPI, HTTPException, Path, Request
 from typing import Dict, Any
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from unified_data_structure import Unified_data_structure
+from unified_data_structure import Unified_data_structure, render_export
+from executors import Executors, SingleFlight
+from data_store import SourceUnavailable
+from export_cache import etag_matches, key_etag
+from query_engine import QueryError, OPERATORS as QUERY_OPERATORS
+import json_export
+import columnar_export
+import metrics
+import snapshot
+from source_watcher import SourceWatcher
 import json
+import asyncio
+import functools
+import os
+import time
 
 
 class DataAPIServer:
@@ -11,8 +24,13 @@ class DataAPIServer:
     A class-based FastAPI server implementation that provides data endpoints.
     """
     
-    def __init__(self):
-        """Initialize the FastAPI application with configuration and routes."""
+    def __init__(self, executors: Executors = None):
+        """
+        Initialize the FastAPI application with configuration and routes.
+
+        Args:
+            executors (Executors): pools that blocking work is run in, configured from the environment by default
+        """
         self.app = FastAPI(
             title="Data API",
             description="A class-based API with two endpoints for retrieving data",
@@ -26,10 +44,45 @@ class DataAPIServer:
             allow_credentials=True,
             allow_methods=["GET"],  # Allow only GET methods
             allow_headers=["*"],  # Allow all headers
+            expose_headers=["ETag"],  # so that the frontend can revalidate with If-None-Match
         )
+        self.app.middleware("http")(self._instrument_request)
+        self.app.add_exception_handler(SourceUnavailable, self._source_unavailable)
         self._configure_routes()
         ''' Iniitialise unified data structure'''
-        self.unified_data_structure = Unified_data_structure()
+        # lazy so that the server starts without reading any dataset, each source is ingested on the first request that needs it
+        # parsed datasets are cached in .ingestion_cache so that a restart does not re-parse unchanged files
+        # with DATA_API_MEMORY_BUDGET_MB the datasets are compacted and the biggest ones spilled to DATA_API_SPILL_DIR
+        # until they fit in that many megabytes (see Unified_data_structure.enforce_memory_budget)
+        memory_budget = os.environ.get("DATA_API_MEMORY_BUDGET_MB")
+        # with DATA_API_SNAPSHOT_DIR the data comes from the shared snapshot published there (see snapshot), so that
+        # several workers map the same files instead of each ingesting every source. The first worker builds the
+        # snapshot when there is none yet, and every worker follows the versions published later
+        snapshot_dir = os.environ.get("DATA_API_SNAPSHOT_DIR")
+        self.snapshot = snapshot.SnapshotReader(snapshot_dir, cache_dir=".ingestion_cache") if snapshot_dir else None
+        if self.snapshot is not None:
+            # replaced by the current version of the snapshot on the first request
+            self.unified_data_structure = Unified_data_structure(data={})
+        else:
+            self.unified_data_structure = Unified_data_structure(
+                lazy=True, cache_dir=".ingestion_cache",
+                memory_budget=int(float(memory_budget) * 1024 * 1024) if memory_budget else None,
+                spill_dir=os.environ.get("DATA_API_SPILL_DIR"))
+        # with DATA_API_WATCH_INTERVAL (seconds) changes of the source files are ingested while the server runs (appended
+        # visits, edited companies, new pdf / pptx), see source_watcher. In snapshot mode the builder watches instead
+        watch_interval = os.environ.get("DATA_API_WATCH_INTERVAL")
+        self.watcher = None
+        if watch_interval and self.snapshot is None:
+            self.watcher = SourceWatcher(self.unified_data_structure, float(watch_interval))
+        self.executors = executors or Executors.from_env()
+        # "X-Profile: 1" on a request returns a sampled profile of it instead of its response, when enabled
+        self.profiling = os.environ.get("DATA_API_PROFILING", "0") == "1"
+        self.single_flight = SingleFlight()
+        self.app.add_event_handler("startup", self._start_loading)
+        self.app.add_event_handler("shutdown", self.executors.shutdown)
+        if self.watcher is not None:
+            self.app.add_event_handler("startup", self.watcher.start)
+            self.app.add_event_handler("shutdown", self.watcher.stop)
     
     def _configure_routes(self):
         """Configure the API routes and endpoints."""
@@ -47,8 +100,16 @@ class DataAPIServer:
             endpoint=self.get_data_by_type,
             methods=["GET"],
             response_model=Any, # specify type of response object later
-            summary="Get data by file type",
-            description="Retrieve data based on the specified file type."
+            summary="Get data by file type or query a dataset",
+            description="Retrieve data based on the specified file type, or filter, sort and page through a single dataset."
+        )
+        self.app.add_api_route(
+            path="/api/data/{dataset}/changes",
+            endpoint=self.get_changes,
+            methods=["GET"],
+            response_model=Any,
+            summary="Get the changes of a dataset",
+            description="Rows inserted, updated and deleted since a version of the dataset, or the whole dataset."
         )
         self.app.add_api_route(
             path="/api/data_visualisation",
@@ -58,48 +119,346 @@ class DataAPIServer:
             summary="Get data visualisations",
             description="Retrieve data visualisations"
         )
+        self.app.add_api_route(
+            path="/metrics",
+            endpoint=self.get_metrics,
+            methods=["GET"],
+            response_model=Any,
+            summary="Prometheus metrics",
+            description="Timing and memory of every stage of ingestion, export and rendering, and of every route"
+        )
+        self.app.add_api_route(
+            path="/api/memory",
+            endpoint=self.get_memory,
+            methods=["GET"],
+            response_model=Any,
+            summary="Memory footprint of the datasets",
+            description="Bytes every dataset takes in memory or on disk when it is spilled, and the memory budget"
+        )
+        self.app.add_api_route(
+            path="/api/rollups",
+            endpoint=self.get_rollups,
+            methods=["GET"],
+            response_model=Any,
+            summary="List customer rollups",
+            description="Names and dimensions of the materialized rollups of the customers"
+        )
+        self.app.add_api_route(
+            path="/api/rollups/{name}",
+            endpoint=self.get_rollup,
+            methods=["GET"],
+            response_model=Any,
+            summary="Get a customer rollup",
+            description="Count, sum and mean of Revenue and Duration (Minutes) for every group of the rollup"
+        )
     
-    async def get_data(self):
+    async def _source_unavailable(self, request: Request, error: SourceUnavailable):
+        """
+        A dataset whose source failed to load is unavailable until the source is retried (see DataStore).
+        """
+        return JSONResponse(status_code=503, content={"detail": str(error)})
+
+    async def _start_loading(self):
+        """
+        Start ingesting every source in the background, so that the server is up straight away and the first request
+        only waits for whatever is still loading.
+        """
+        self._loading = asyncio.ensure_future(self._load_data())
+
+    async def _load_data(self):
+        """
+        Ingest every source that has not been loaded yet, off the event loop. Concurrent requests share the same load.
+        Sources are loaded in parallel and a source that fails is left out (see Unified_data_structure.load_sources).
+        """
+        await self._refresh_snapshot()
+        data = self.unified_data_structure.data
+        if data.unloaded_keys():
+            await self.single_flight.do("load", lambda: self.executors.run_io(self.unified_data_structure.load_sources))
+
+    async def _load_dataset(self, dataset: str):
+        """
+        Ingest the source of a single dataset if it has not been loaded yet, off the event loop, without waiting for the
+        other sources (a query of the customers does not wait for the tables of the pdf).
+        """
+        await self._refresh_snapshot()
+        data = self.unified_data_structure.data
+        if dataset in data and not data.is_loaded(dataset):
+            await self.single_flight.do(f"load:{dataset}", lambda: self.executors.run_io(data.load, dataset))
+
+    async def _refresh_snapshot(self):
+        """
+        In snapshot mode, switch to the current version of the snapshot when a new one has been published.
+        Requests already running keep the Unified_data_structure they started with.
+        """
+        if self.snapshot is None:
+            return
+        uds = await self.single_flight.do("snapshot", lambda: self.executors.run_io(self.snapshot.refresh))
+        if uds is not None:
+            self.unified_data_structure = uds
+
+    async def _export(self, kind: str, options: Dict[str, Any] = None):
+        """
+        Return the export artifact of the given kind (and options) for the current data version.
+        Rendering runs in the cpu executor and identical concurrent requests share a single render.
+        """
+        await self._load_data()
+        uds = self.unified_data_structure
+
+        def prepare():
+            # validating the options reads the dataset they name, which may have to be loaded or paged in
+            normalized = uds.export_options(kind, **(options or {}))
+            return normalized, uds.export_cache_key(kind, **normalized)
+        try:
+            options, cache_key = await self.executors.run_io(prepare)
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        artifact = uds.export_cache.get(cache_key)
+        if artifact is not None:
+            return artifact
+
+        async def render():
+            # the render itself may run in another process, its stage here includes sending the data to the pool
+            with metrics.stage(f"export_{kind}"):
+                if uds.memory_budget is not None:
+                    # within a memory budget the render reads the datasets one at a time, paging spilled tables in only
+                    # while it writes them, which a copy of every dataset sent to another process would not do
+                    artifact = await self.executors.run_io(functools.partial(uds.render_export, kind, **options))
+                else:
+                    inputs = await self.executors.run_io(functools.partial(uds.export_inputs, kind, **options))
+                    artifact = await self.executors.run_cpu(render_export, kind, inputs, options)
+            artifact.etag = key_etag(cache_key)
+            uds.export_cache.put(cache_key, artifact)
+            return artifact
+        return await self.single_flight.do(cache_key, render)
+
+    async def _artifact_response(self, request: Request, kind: str, options: Dict[str, Any] = None):
+        """
+        Serve the cached export artifact of the given kind, or a 304 when the client already has it.
+        """
+        artifact = await self._export(kind, options)
+        headers = {
+            "ETag": artifact.etag,
+            # clients may keep the artifact but have to revalidate it with If-None-Match
+            "Cache-Control": "no-cache",
+        }
+        if etag_matches(request.headers.get("if-none-match"), artifact.etag):
+            return Response(status_code=304, headers=headers)
+        headers["Content-Disposition"] = f'attachment; filename="{artifact.filename}"'  # Suggested filename for download
+        return Response(content=artifact.body, media_type=artifact.media_type, headers=headers)
+
+    async def _instrument_request(self, request: Request, call_next):
+        """
+        Count and time every request by route. With profiling enabled (DATA_API_PROFILING=1), a request sent with
+        "X-Profile: 1" is answered with a sampled profile of the whole request (body included) in the folded stack format
+        instead of its response, the status it would have had is in the X-Profiled-Status header.
+        """
+        started = time.perf_counter()
+        if self.profiling and request.headers.get("x-profile") == "1":
+            with metrics.profile() as profile:
+                response = await call_next(request)
+                async for _ in response.body_iterator:
+                    pass
+            status = response.status_code
+            response = PlainTextResponse(profile.folded(), headers={
+                "X-Profiled-Status": str(status),
+                "X-Profile-Duration": f"{profile.duration:.6f}",
+            })
+        else:
+            response = await call_next(request)
+            status = response.status_code
+        route = request.scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        metrics.REQUESTS.inc(route, request.method, status)
+        metrics.REQUEST_DURATION.observe(route, value=time.perf_counter() - started)
+        return response
+
+    async def get_metrics(self):
+        """
+        Every metric in the Prometheus text exposition format, see metrics.
+        """
+        return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    async def get_data(self, request: Request):
         """
         Retrieve all data without any parameters.
+        The consolidated json is streamed (chunked) straight from the dataframes, nothing is written to disk.
         """
-        # This function is intentionally left empty for now
-        self.unified_data_structure.get_data()
-        file_path = "datasets/consolidated_dataset.json"
-        return FileResponse(
-            path=file_path,
+        await self._load_data()
+        etag = self.unified_data_structure.data_etag()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        headers["Content-Disposition"] = 'attachment; filename="consolidated_dataset.json"'  # Suggested filename for download
+        # starlette iterates a sync generator in its thread pool, so encoding does not block the event loop
+        return StreamingResponse(
+            self.unified_data_structure.iter_json(),
             media_type="application/json",
-            filename="consolidated_dataset.json"  # Suggested filename for download
+            headers=headers
         )
     
-    async def get_data_by_type(self, file_type: str):
+    async def get_data_by_type(self, file_type: str, request: Request):
         """
-        Retrieve data based on the specified file type.
+        Retrieve data based on the specified file type, or query a single dataset.
         
         Args:
-            file_type (str): The type of file to retrieve. For now it supports only
-            csv and json
+            file_type (str): The type of file to retrieve (xlsx, json, parquet or arrow), or the name of a dataset
+            (e.g. customers) to query, see query_dataset
+            xlsx?employees=single puts every employee in a single sheet with a company_id column
+            instead of a sheet per company
         """
         if file_type == "xlsx":
-            self.unified_data_structure.get_data_xlsx()
-            file_path = "datasets/consolidated_dataset.xlsx"
-            return FileResponse(
-                path=file_path,
-                media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                filename="consolidated_dataset.xlsx"  # Suggested filename for download
-            )
+            single = request.query_params.get("employees") == "single"
+            return await self._artifact_response(request, "xlsx_flat" if single else "xlsx")
         elif file_type == "json":
-            self.get_data()
-
-    async def get_data_visualisation(self):
-        self.unified_data_structure.visualise_data()
-        file_path = "datasets/data_visualisations.png"
-        return FileResponse(
-            path=file_path,
-            media_type="image/png",
-            filename="data_visualisations.png"  # Suggested filename for download
+            return await self.get_data(request)
+        elif file_type in ("parquet", "arrow"):
+            return await self.get_columnar(file_type, request)
+        await self._refresh_snapshot()
+        if file_type in self.unified_data_structure.get_data_keys():
+            return await self.query_dataset(file_type, request)
+        raise HTTPException(status_code=404, detail=f"unknown file type or dataset '{file_type}'")
+
+    async def get_columnar(self, file_type: str, request: Request):
+        """
+        Serve datasets in a columnar binary format. Query parameters (optional):
+            dataset=<name>             a single dataset (employees is the flattened table of every employee),
+                                       every dataset in a zip by default
+            compression=<codec>        parquet: snappy (default), zstd, gzip, brotli, lz4 or none
+                                       arrow: none (default), lz4 or zstd
+        A single dataset in arrow is streamed one record batch at a time.
+        """
+        if not columnar_export.available():
+            raise HTTPException(status_code=501, detail=f"{file_type} exports need pyarrow to be installed")
+        options = {name: request.query_params[name] for name in ("dataset", "compression") if name in request.query_params}
+        if "dataset" not in options:
+            return await self._artifact_response(request, f"{file_type}_archive", options)
+        if file_type == "parquet":
+            return await self._artifact_response(request, "parquet", options)
+
+        await self._load_data()
+        uds = self.unified_data_structure
+        try:
+            options = await self.executors.run_io(functools.partial(uds.export_options, "arrow", **options))
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        etag = f'"{uds.data.version_tag}-arrow-{options["dataset"]}-{options["compression"]}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        headers["Content-Disposition"] = f'attachment; filename="{options["dataset"]}.arrow"'
+        # iter_arrow builds the frame when it is first iterated, in starlette's thread pool rather than on the event loop
+        return StreamingResponse(
+            uds.iter_arrow(options["dataset"], options["compression"]),
+            media_type="application/vnd.apache.arrow.stream",
+            headers=headers
         )
 
+    async def query_dataset(self, dataset: str, request: Request):
+        """
+        Return one page of a dataset. Query parameters:
+            <column>=<value>           rows where column equals value (repeat the parameter for "any of")
+            <column>__gte=<value>      range filters, also __gt, __lt and __lte (e.g. Date__gte=2024-01-10)
+            columns=<a>,<b>            columns to return
+            sort=<column> / -<column>  ascending / descending sort
+            limit=<n>                  rows per page (100 by default, at most 1000)
+            cursor=<next_cursor>       next_cursor of the previous page
+        """
+        filters, options = {}, {}
+        for name, value in request.query_params.multi_items():
+            if name in ("columns", "sort", "limit", "cursor"):
+                options[name] = value
+                continue
+            column, operator = name, "eq"
+            prefix, _, suffix = name.rpartition("__")
+            if prefix and suffix in QUERY_OPERATORS:
+                column, operator = prefix, suffix
+            filters.setdefault(column, []).append((operator, value))
+        try:
+            limit = int(options["limit"]) if "limit" in options else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="limit must be an integer")
+        columns = options["columns"].split(",") if options.get("columns") else None
+
+        await self._load_dataset(dataset)
+        try:
+            # indexes are shared in memory, so queries run in the thread pool rather than in another process
+            result = await self.executors.run_io(
+                self.unified_data_structure.query, dataset, filters, columns, options.get("sort"), limit, options.get("cursor")
+            )
+        except QueryError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        return Response(content=json_export.dumps(result), media_type="application/json")
+
+    async def get_changes(self, dataset: str, request: Request):
+        """
+        Return what changed in a dataset since the version a client has. Query parameters:
+            since=<version>            the version the client has, the whole dataset is returned without it
+            token=<token>              the token that came with that version, versions of another server process (or
+                                       snapshot) are not comparable and get the whole dataset
+        The response has the current "version" and "token" of the dataset, its "key" columns, and either "changes" (list of
+        {version, inserted, updated, deleted}) or, when "full" is true, "data" (the whole dataset).
+        """
+        since = request.query_params.get("since")
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be an integer version")
+        await self._refresh_snapshot()
+        if dataset not in self.unified_data_structure.get_data_keys():
+            raise HTTPException(status_code=404, detail=f"unknown dataset '{dataset}'")
+        await self._load_dataset(dataset)
+        uds = self.unified_data_structure
+        result = await self.executors.run_io(uds.changes_since, dataset, since, request.query_params.get("token"))
+        return StreamingResponse(json_export.iter_changes(result), media_type="application/json")
+
+    async def get_data_visualisation(self, request: Request):
+        """
+        Retrieve the data visualisations. Query parameters (all optional):
+            format=png|svg|webp        png by default
+            charts=<a>,<b>             charts to draw side by side (locations, quarterly_performance, monthly_revenue,
+                                       activity_revenue), locations and quarterly_performance by default
+            width=<in>, height=<in>    size of the figure in inches
+            dpi=<n>                    resolution of png and webp images
+        Renders are cached per data version and parameters.
+        """
+        params = request.query_params
+        kind = params.get("format", "png")
+        if kind not in ("png", "svg", "webp"):
+            raise HTTPException(status_code=400, detail=f"unsupported format '{kind}'")
+        options = {name: params[name] for name in ("charts", "width", "height", "dpi") if name in params}
+        return await self._artifact_response(request, kind, options)
+
+    async def get_memory(self):
+        """
+        Memory footprint of every dataset (see Unified_data_structure.memory_report), loaded datasets are not paged in.
+        """
+        uds = self.unified_data_structure
+        report = await self.executors.run_io(uds.memory_report)
+        result = {
+            "budget_bytes": uds.memory_budget,
+            "memory_bytes": int(report["memory_bytes"].sum()),
+            "datasets": json_export.records(report),
+        }
+        return Response(content=json_export.dumps(result), media_type="application/json")
+
+    async def get_rollups(self):
+        return self.unified_data_structure.rollups.definitions
+
+    async def get_rollup(self, name: str):
+        """
+        Retrieve the groups of a rollup, which only costs O(groups) once it has been built.
+        """
+        if name not in self.unified_data_structure.rollups.definitions:
+            raise HTTPException(status_code=404, detail=f"unknown rollup '{name}'")
+        await self._load_dataset("customers")
+        groups = await self.executors.run_io(self.unified_data_structure.get_rollup, name)
+        result = {
+            "name": name,
+            "dimensions": self.unified_data_structure.rollups.definitions[name],
+            "groups": json_export.records(groups),
+        }
+        return Response(content=json_export.dumps(result), media_type="application/json")
+
     def run(self, host: str = "0.0.0.0", port: int = 8000):
         """
         Run the FastAPI application.
@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import pickle
+import shutil
+import time
+import threading
+import uuid
+from contextlib import contextmanager
+
+import memory_budget
+from source_watcher import SourceWatcher
+from json_ingestion import EmployeesView
+from unified_data_structure import Unified_data_structure
+
+try:
+    import fcntl
+except ImportError:  # no file locks on windows, workers starting together may then each build a version
+    fcntl = None
+
+"""
+Shared, memory mapped snapshots of Unified_data_structure.data, so that several uvicorn workers serve the same data
+without each of them ingesting every source and holding its own copy of every dataframe.
+
+A snapshot directory holds immutable versions and a pointer to the current one:
+    versions/<version>/manifest.json    keys of the version in order, the file of every table
+    versions/<version>/<n>.arrow        every table as an uncompressed Arrow IPC file (memory_budget.write_table)
+    versions/<version>/objects.pickle   the dict datasets and the company ids of employees
+    CURRENT                             name of the current version
+A builder ingests the sources, compacts them (see memory_budget) and publishes a new version: the version is written
+under a temporary name, renamed, and only then CURRENT is replaced (os.replace), so a reader sees either the previous
+version or the new one in full. The oldest versions beyond KEEP_VERSIONS are removed, a worker that still maps one of
+their files keeps reading it until it lets go of it.
+
+Workers attach to a version (load): every table is memory mapped and its columns point into the page cache, which every
+process mapping the same file shares, so an extra worker costs its indexes and rollups but not another copy of the data.
+SnapshotReader.refresh() checks CURRENT at most every poll_interval seconds and attaches the new version when it changed;
+the server swaps its Unified_data_structure in one assignment, requests in flight finish on the version they started with.
+The DataStore of an attached version is tagged with the version, so every worker produces the same etags for it.
+
+    python snapshot.py --snapshot-dir .snapshot              # ingest datasets/ and publish a new version
+    python snapshot.py --snapshot-dir .snapshot --watch 5    # then publish a new version whenever a source changes
+"""
+
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+OBJECTS = "objects.pickle"
+KEEP_VERSIONS = 3
+
+
+def _versions_dir(directory):
+    return os.path.join(directory, "versions")
+
+
+@contextmanager
+def _build_lock(directory):
+    # only one process builds a version at a time
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def current_version(directory):
+    # name of the current version, None when nothing has been published yet
+    try:
+        with open(os.path.join(directory, CURRENT)) as current:
+            return current.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(items, directory, keep=KEEP_VERSIONS):
+    # writes (key, value) items (e.g. DataStore.loaded_items()) as a new version and makes it the current one, returns its name
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}.{time.time_ns() % 10 ** 9:09d}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(_versions_dir(directory), exist_ok=True)
+    building = os.path.join(_versions_dir(directory), f".{version}.tmp")
+    os.makedirs(building)
+    manifest = {"version": version, "keys": [], "tables": {}}
+    objects = {"dicts": {}, "company_ids": {}}
+    for key, value in items:
+        manifest["keys"].append(key)
+        if isinstance(value, EmployeesView):
+            objects["company_ids"][key] = value.company_ids
+            value = value.frame
+        if isinstance(value, dict):
+            objects["dicts"][key] = value
+        else:
+            path = memory_budget.write_table(value, os.path.join(building, str(len(manifest["tables"]))))
+            manifest["tables"][key] = os.path.basename(path)
+    with open(os.path.join(building, OBJECTS), "wb") as objects_file:
+        pickle.dump(objects, objects_file, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(building, MANIFEST), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.rename(building, os.path.join(_versions_dir(directory), version))
+
+    pointer = os.path.join(directory, f"{CURRENT}.{os.getpid()}.tmp")
+    with open(pointer, "w") as current:
+        current.write(version)
+    os.replace(pointer, os.path.join(directory, CURRENT))
+    _prune(directory, version, keep)
+    return version
+
+
+def _prune(directory, current, keep):
+    # version names start with their creation time, so they sort from the oldest to the newest
+    versions = sorted(name for name in os.listdir(_versions_dir(directory)) if not name.startswith("."))
+    for name in versions[:-keep] if keep else versions:
+        if name != current:
+            shutil.rmtree(os.path.join(_versions_dir(directory), name), ignore_errors=True)
+
+
+def load(directory, version=None):
+    # Unified_data_structure over a version (the current one by default), its tables memory mapped
+    version = version or current_version(directory)
+    if version is None:
+        raise FileNotFoundError(f"no snapshot has been published in {directory}")
+    path = os.path.join(_versions_dir(directory), version)
+    with open(os.path.join(path, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    with open(os.path.join(path, OBJECTS), "rb") as objects_file:
+        objects = pickle.load(objects_file)
+    data = {}
+    for key in manifest["keys"]:
+        if key in manifest["tables"]:
+            value = memory_budget.read_table(os.path.join(path, manifest["tables"][key]))
+            if key in objects["company_ids"]:
+                value = EmployeesView(value, objects["company_ids"][key])
+            data[key] = value
+        else:
+            data[key] = objects["dicts"][key]
+    uds = Unified_data_structure(data=data)
+    uds.data.token = f"snapshot-{version}"
+    return uds
+
+
+def _ingest(options):
+    uds = Unified_data_structure(lazy=True, **options)
+    uds.load_sources()
+    uds.compact()
+    return uds
+
+
+def build(directory, keep=KEEP_VERSIONS, **options):
+    # ingests every source (options are passed to Unified_data_structure) and publishes the result, returns the version
+    uds = _ingest(options)
+    with _build_lock(directory):
+        return publish(uds.data.loaded_items(), directory, keep)
+
+
+def watch(directory, interval, keep=KEEP_VERSIONS, **options):
+    # publishes a version now and a new one every time a source file changes (see source_watcher), until interrupted
+    uds = _ingest(options)
+
+    def publish_changes(changes):
+        with _build_lock(directory):
+            version = publish(uds.data.loaded_items(), directory, keep)
+        print(f"published {version}: " + ", ".join(f"{name} {change}" for name, change in changes.items()))
+
+    publish_changes({"datasets": "ingested"})
+    watcher = SourceWatcher(uds, interval, on_change=publish_changes)
+    try:
+        while True:
+            watcher.poll()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def ensure(directory, **options):
+    # the current version, built first when nothing has been published yet (workers starting together build it once)
+    with _build_lock(directory):
+        version = current_version(directory)
+        if version is None:
+            version = publish(_ingest(options).data.loaded_items(), directory)
+    return version
+
+
+class SnapshotReader:
+    # attaches a worker to the current version of a snapshot directory and follows new versions
+    def __init__(self, directory, poll_interval=1.0, **options):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.options = options  # used to build the first version when there is none
+        self.version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # Unified_data_structure of the current version when it is not the one attached yet, None otherwise
+        now = time.monotonic()
+        if self.version is not None and now - self._checked < self.poll_interval:
+            return None
+        with self._lock:
+            self._checked = now
+            version = current_version(self.directory) if self.version is not None else ensure(self.directory, **self.options)
+            if version is None or version == self.version:
+                return None
+            uds = load(self.directory, version)
+            self.version = version
+            return uds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ingest the datasets and publish them as a new snapshot version")
+    parser.add_argument("--snapshot-dir", default=".snapshot")
+    parser.add_argument("--datasets-dir", default="datasets")
+    parser.add_argument("--cache-dir", default=".ingestion_cache")
+    parser.add_argument("--keep", type=int, default=KEEP_VERSIONS, help="number of versions to keep")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="keep publishing when the sources change")
+    args = parser.parse_args(argv)
+    if args.watch:
+        watch(args.snapshot_dir, args.watch, args.keep, datasets_dir=args.datasets_dir, cache_dir=args.cache_dir)
+        return 0
+    version = build(args.snapshot_dir, args.keep, datasets_dir=args.datasets_dir, cache_dir=args.cache_dir)
+    print(f"published {version} in {args.snapshot_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
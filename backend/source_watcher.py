@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+
+import csv_ingestion
+import json_ingestion
+from unified_data_structure import file_stat
+
+"""
+Picks up changes of the source files of a Unified_data_structure while it is being served, without restarting.
+SourceWatcher polls the (size, mtime) of every source file of SOURCES every interval seconds, and when one changed:
+    dataset2.csv    the visit log is append only: the rows written after the last ingested byte are parsed and added
+                    with append_customers (which also updates the rollups). When the bytes before that offset changed
+                    (the file was rewritten or truncated) the file is ingested again instead
+    dataset1.json   every company is compared with a digest of its last ingested version, only the new and changed
+                    companies are flattened and spliced into companies, employees and companies_performance
+                    (see json_ingestion.diff_companies). Companies without an id make it ingest the whole file again
+    other sources   the file is ingested again (reload_source)
+Updates are built on the side and swapped into self.data at once (DataStore.swap), so readers of a single key never wait
+and exports (which read every key through DataStore.loaded_items) see every key of a source either before or after the
+change, and caches keyed by the data version (exports, indexes, rollups) follow. Sources that have not been loaded yet are left alone, they are read as they are when they are first accessed.
+A source file that disappears keeps the data it had.
+"""
+
+# bytes before the ingested offset of the csv that are compared to tell an append from a rewrite
+_TAIL_SIZE = 4096
+
+
+def _tail_digest(path, offset):
+    with open(path, "rb") as source_file:
+        source_file.seek(max(offset - _TAIL_SIZE, 0))
+        return hashlib.blake2b(source_file.read(min(offset, _TAIL_SIZE)), digest_size=16).digest()
+
+
+class _Watched:
+    # what the watcher knows of a source file that has been ingested
+    def __init__(self, stat):
+        self.stat = stat
+        self.offset = None  # csv: bytes ingested so far
+        self.tail = None  # csv: _tail_digest at offset
+        self.digests = None  # json: company_id -> digest of the ingested companies
+
+
+class SourceWatcher:
+    def __init__(self, uds, interval=1.0, on_change=None):
+        self.uds = uds
+        self.interval = interval
+        self.on_change = on_change  # called with the changes of a poll (e.g. to publish a snapshot)
+        self.errors = {}  # source file -> error of its last update
+        self._watched = {}  # source file -> _Watched
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="source-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        # checks every source once and applies what changed, returns {source file: description of the change}
+        changes = {}
+        for name, reader, _ in self.uds.SOURCES:
+            path = os.path.join(self.uds.datasets_dir, name)
+            try:
+                change = self._check(name, reader, path)
+                self.errors.pop(name, None)
+            except Exception as error:
+                # the data of the source stays as it was, the next poll tries again from scratch
+                self.errors[name] = error
+                self._watched.pop(name, None)
+                continue
+            if change:
+                changes[name] = change
+        if changes:
+            self.uds.enforce_memory_budget()
+            if self.on_change is not None:
+                self.on_change(changes)
+        return changes
+
+    def _check(self, name, reader, path):
+        if name in self.uds.data.pending_sources():
+            self._watched.pop(name, None)
+            return None
+        try:
+            stat = file_stat(path)
+        except FileNotFoundError:
+            return None
+        watched = self._watched.get(name)
+        if watched is None:
+            watched = self._watched[name] = self._baseline(reader, path)
+        if stat == watched.stat:
+            return None
+        if reader == "read_csv":
+            return self._append(name, reader, path, watched, stat)
+        if reader == "read_json":
+            return self._replace_companies(name, reader, path, watched, stat)
+        return self._reload(name, reader, path)
+
+    def _baseline(self, reader, path):
+        # state of a source as it was ingested, when it changed since then the next check sees the difference
+        ingested = self.uds.source_stats.get(path) or file_stat(path)
+        watched = _Watched(ingested)
+        if reader == "read_csv":
+            watched.offset = ingested[0]
+            watched.tail = _tail_digest(path, watched.offset)
+        elif reader == "read_json" and file_stat(path) == ingested:
+            diff = json_ingestion.diff_companies(self._companies(path))
+            watched.digests = diff[0] if diff is not None else None
+        return watched
+
+    def _companies(self, path):
+        if os.path.getsize(path) > self.uds.JSON_INCREMENTAL_THRESHOLD:
+            return json_ingestion.iter_companies(path)
+        return json_ingestion.load_companies(path)
+
+    def _reload(self, name, reader, path):
+        self.uds.reload_source(name)
+        self._watched[name] = self._baseline(reader, path)
+        return "reloaded"
+
+    def _append(self, name, reader, path, watched, stat):
+        if stat[0] < watched.offset or _tail_digest(path, watched.offset) != watched.tail:
+            return self._reload(name, reader, path)
+        rows, end = csv_ingestion.read_appended(path, watched.offset)
+        if rows is not None and list(rows.columns) != list(self.uds.data["customers"].columns):
+            return self._reload(name, reader, path)
+        if rows is not None and len(rows):
+            self.uds.append_customers(rows)
+        watched.offset, watched.tail = end, _tail_digest(path, end)
+        # a line that is still being written keeps the size different, so it is read on a later poll
+        watched.stat = stat if end == stat[0] else (end, stat[1])
+        self.uds.source_stats[path] = watched.stat
+        return f"appended {len(rows)} rows" if rows is not None and len(rows) else None
+
+    def _replace_companies(self, name, reader, path, watched, stat):
+        diff = json_ingestion.diff_companies(self._companies(path), watched.digests) if watched.digests is not None else None
+        if diff is None:
+            return self._reload(name, reader, path)
+        digests, changed = diff
+        removed = len(set(watched.digests) - set(digests))
+        unchanged = not changed and list(digests) == list(watched.digests)
+        if not unchanged:
+            self.uds.replace_companies(path, changed, list(digests), stat)
+        watched.digests, watched.stat = digests, stat
+        return None if unchanged else f"replaced {len(changed)} companies, removed {removed}"
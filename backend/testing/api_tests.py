@@ -0,0 +1,180 @@
+import pytest
+from fastapi.testclient import TestClient
+from server import DataAPIServer
+from executors import Executors
+import pyarrow as pa
+import os
+import snapshot
+import shutil
+from unified_data_structure import Unified_data_structure
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(DataAPIServer(Executors(cpu_executor="thread")).app)
+
+@pytest.mark.parametrize("path", ["/api/data", "/api/data/xlsx", "/api/data_visualisation"])
+def test_etag_not_modified(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert etag.startswith('"')
+
+    response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get(path, headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+
+def test_xlsx_single_employees_sheet(client):
+    response = client.get("/api/data/xlsx", params={"employees": "single"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/vnd.openxmlformats")
+    assert response.headers["etag"] != client.get("/api/data/xlsx").headers["etag"]
+
+def test_visualisation_parameters(client):
+    response = client.get("/api/data_visualisation", params={"format": "webp", "charts": "activity_revenue", "dpi": 50})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert client.get("/api/data_visualisation", params={"format": "gif"}).status_code == 400
+    assert client.get("/api/data_visualisation", params={"dpi": "high"}).status_code == 400
+
+def test_arrow_stream(client):
+    response = client.get("/api/data/arrow", params={"dataset": "customers", "compression": "zstd"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    customers = pa.ipc.open_stream(response.content).read_all()
+    assert customers.num_rows == len(client.get("/api/data/json").json()["customers"])
+    assert client.get("/api/data/arrow", params={"dataset": "customers"}, headers={"If-None-Match": response.headers["etag"].replace("zstd", "none")}).status_code == 304
+
+def test_parquet_archive(client):
+    response = client.get("/api/data/parquet")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    assert client.get("/api/data/parquet", params={"dataset": "customers", "compression": "rar"}).status_code == 400
+
+def test_metrics(client):
+    client.get("/api/data/customers", params={"limit": 1})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'data_api_requests_total{route="/api/data/{file_type}",method="GET",status="200"}' in response.text
+    assert 'data_api_stage_duration_seconds_count{stage="read_csv"}' in response.text
+
+def test_profile_request(monkeypatch):
+    # profiles are opt-in
+    assert client_for_env(monkeypatch, "0").get("/api/rollups", headers={"X-Profile": "1"}).headers["content-type"] == "application/json"
+    response = client_for_env(monkeypatch, "1").get("/api/data/json", headers={"X-Profile": "1"})
+    assert response.status_code == 200
+    assert response.headers["x-profiled-status"] == "200"
+    assert response.headers["content-type"].startswith("text/plain")
+
+def client_for_env(monkeypatch, profiling):
+    monkeypatch.setenv("DATA_API_PROFILING", profiling)
+    return TestClient(DataAPIServer(Executors(cpu_executor="thread")).app)
+
+def test_data_by_type_json(client):
+    response = client.get("/api/data/json")
+    assert response.status_code == 200
+    assert "customers" in response.json()
+
+def test_data_is_streamed(client):
+    response = client.get("/api/data")
+    assert response.status_code == 200
+    assert "content-length" not in response.headers
+    assert response.json()["employees"]
+
+def test_query_dataset(client):
+    response = client.get("/api/data/customers", params={"Location": "Downtown", "columns": "Location,Revenue", "sort": "-Revenue", "limit": 3})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["rows"]) == 3
+    assert {row["Location"] for row in page["rows"]} == {"Downtown"}
+    assert page["rows"][0]["Revenue"] >= page["rows"][1]["Revenue"]
+
+    response = client.get("/api/data/customers", params={"Location": "Downtown", "columns": "Location,Revenue", "sort": "-Revenue", "limit": 3, "cursor": page["next_cursor"]})
+    assert response.status_code == 200
+    assert response.json()["rows"][0]["Revenue"] <= page["rows"][2]["Revenue"]
+
+def test_query_loads_only_its_dataset():
+    server = DataAPIServer(Executors(cpu_executor="thread"))
+    client = TestClient(server.app)
+    assert client.get("/api/data/customers", params={"limit": 1}).status_code == 200
+    assert client.get("/api/rollups/location").status_code == 200
+    # the pdf and the pptx are not extracted for a query of the customers
+    assert server.unified_data_structure.data.pending_sources() == ["dataset1.json", "dataset3.pdf", "dataset4.pptx"]
+
+def test_unavailable_source(tmp_path):
+    for name in ["dataset1.json", "dataset2.csv", "dataset4.pptx"]:
+        shutil.copy(os.path.join("datasets", name), tmp_path / name)
+    (tmp_path / "dataset3.pdf").write_bytes(b"not a pdf")
+    server = DataAPIServer(Executors(cpu_executor="thread"))
+    server.unified_data_structure = Unified_data_structure(lazy=True, datasets_dir=str(tmp_path))
+    client = TestClient(server.app)
+    assert client.get("/api/data/quarterly_performance").status_code == 503
+    assert client.get("/api/data/quarterly_performance/changes").status_code == 503
+    assert client.get("/api/data_visualisation").status_code == 200
+    assert client.get("/api/data/customers", params={"limit": 1}).status_code == 200
+
+def test_query_dataset_errors(client):
+    assert client.get("/api/data/customers", params={"columns": "missing"}).status_code == 400
+    assert client.get("/api/data/customers", params={"limit": "many"}).status_code == 400
+    assert client.get("/api/data/unknown").status_code == 404
+
+def test_rollups(client):
+    assert "location" in client.get("/api/rollups").json()
+    response = client.get("/api/rollups/location")
+    assert response.status_code == 200
+    groups = response.json()["groups"]
+    assert sum(group["count"] for group in groups) == 100
+    assert {"Location", "Revenue_sum", "Revenue_mean", "Duration (Minutes)_mean"} <= set(groups[0])
+    assert client.get("/api/rollups/unknown").status_code == 404
+
+def test_memory_report(client):
+    client.get("/api/data/customers")
+    response = client.get("/api/memory")
+    assert response.status_code == 200
+    report = response.json()
+    assert report["budget_bytes"] is None
+    customers = next(dataset for dataset in report["datasets"] if dataset["dataset"] == "customers")
+    assert customers["state"] == "in memory" and customers["memory_bytes"] > 0
+    assert report["memory_bytes"] >= customers["memory_bytes"]
+
+def test_exports_within_memory_budget(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATA_API_MEMORY_BUDGET_MB", "0.001")
+    monkeypatch.setenv("DATA_API_SPILL_DIR", str(tmp_path))
+    server = DataAPIServer(Executors(cpu_executor="process"))
+    client = TestClient(server.app)
+    assert len(client.get("/api/data").json()["customers"]) == 100
+    assert client.get("/api/data/xlsx").status_code == 200
+    # the tables were read from their spill files without being kept in memory
+    assert server.unified_data_structure.data.is_spilled("customers")
+
+def test_snapshot_shared_by_workers(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATA_API_SNAPSHOT_DIR", str(tmp_path))
+    workers = [DataAPIServer(Executors(cpu_executor="thread")) for _ in range(2)]
+    clients = [TestClient(worker.app) for worker in workers]
+    responses = [client.get("/api/data") for client in clients]
+    assert responses[0].status_code == 200
+    assert responses[0].headers["etag"] == responses[1].headers["etag"]
+    assert responses[0].content == responses[1].content
+    assert len(os.listdir(tmp_path / "versions")) == 1
+    assert clients[1].get("/api/data/customers", params={"limit": 1}).status_code == 200
+
+    snapshot.publish([("customers", workers[0].unified_data_structure.data["customers"].head(3))], str(tmp_path))
+    for worker in workers:
+        worker.snapshot.poll_interval = 0
+    for client in clients:
+        response = client.get("/api/data")
+        assert response.headers["etag"] != responses[0].headers["etag"]
+        assert len(response.json()["customers"]) == 3 and "companies" not in response.json()
+
+def test_dataset_changes(client):
+    response = client.get("/api/data/customers/changes")
+    assert response.status_code == 200
+    full = response.json()
+    assert full["full"] and len(full["data"]) == 100 and full["key"] == []
+    response = client.get("/api/data/customers/changes", params={"since": full["version"], "token": full["token"]})
+    assert response.json()["changes"] == [] and not response.json()["full"]
+    assert client.get("/api/data/customers/changes", params={"since": "latest"}).status_code == 400
+    assert client.get("/api/data/unknown/changes").status_code == 404
@@ -0,0 +1,157 @@
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fastapi.testclient import TestClient
+from unified_data_structure import Unified_data_structure
+from server import DataAPIServer
+from executors import Executors
+import synthetic_datasets
+
+"""
+Benchmark suite: wall time and peak memory of the readers, the exporters and the api endpoints on synthetic datasets.
+For every scale (see synthetic_datasets for what a scale means), the 4 sources are generated in a temporary directory and
+    - every reader of Unified_data_structure ingests its source (read_json, read_csv, read_pdf, read_pptx)
+    - get_data, get_data_xlsx and visualise_data write their files
+    - the endpoints are requested through FastAPI's in-process TestClient (the first request, /api/data, includes
+      ingesting every source)
+The peak memory of a step is the peak of the memory allocated by python and numpy in this process during that step
+(tracemalloc, so pages extracted in the worker processes of pdf_extraction are not counted), which also slows every step
+down a little, so timings are only comparable with timings taken the same way.
+
+Results are compared against a stored baseline (benchmark_baseline.json next to this file by default): a step is a
+regression when it takes more than --tolerance times its baseline time (and more than --min-seconds more) or more than
+--tolerance times its baseline peak memory (and more than --min-mb more). The exit code is 1 when there is a regression.
+
+    python benchmark.py --scales 1 10 100               # compare against the baseline
+    python benchmark.py --scales 1 10 100 --save        # record a new baseline (e.g. on a new machine)
+Baselines depend on the machine, record one on the machine the benchmark runs on.
+"""
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+ENDPOINTS = [
+    "/api/data",
+    "/api/data/xlsx",
+    "/api/data_visualisation",
+    "/api/data/customers?Location=Downtown&sort=-Revenue&limit=100",
+    "/api/rollups/location",
+    "/api/data/parquet?dataset=customers",
+]
+
+
+def measure(function):
+    # (result, {"seconds": wall time, "peak_mb": peak of the memory allocated during the call})
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, {"seconds": round(seconds, 4), "peak_mb": round(peak / 1024 / 1024, 2)}
+
+
+def run_scale(scale, directory):
+    datasets_dir = os.path.join(directory, "datasets")
+    paths = synthetic_datasets.generate(datasets_dir, scale)
+    results = {}
+
+    uds = Unified_data_structure(lazy=True, datasets_dir=datasets_dir)
+    for filename, reader in [("dataset1.json", "read_json"), ("dataset2.csv", "read_csv"),
+                             ("dataset3.pdf", "read_pdf"), ("dataset4.pptx", "read_pptx")]:
+        _, results[reader] = measure(lambda: getattr(uds, reader)(paths[filename]))
+    for exporter in ["get_data", "get_data_xlsx", "visualise_data"]:
+        _, results[exporter] = measure(getattr(uds, exporter))
+
+    # the server reads datasets/ and keeps its ingestion cache in the working directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        client = TestClient(DataAPIServer(Executors(cpu_executor="thread")).app)
+        for endpoint in ENDPOINTS:
+            response, results[f"GET {endpoint}"] = measure(lambda: client.get(endpoint))
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {endpoint} answered {response.status_code}")
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def run(scales):
+    results = {}
+    for scale in scales:
+        directory = tempfile.mkdtemp(prefix=f"benchmark-{scale}x-")
+        try:
+            results[f"{scale}x"] = run_scale(scale, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=1.5, min_seconds=0.05, min_mb=1.0):
+    # list of regressions (scale, step, metric, baseline value, value)
+    regressions = []
+    for scale, steps in results.items():
+        for step, metrics in steps.items():
+            expected = baseline.get(scale, {}).get(step)
+            if expected is None:
+                continue
+            for metric, slack in (("seconds", min_seconds), ("peak_mb", min_mb)):
+                if metrics[metric] > expected[metric] * tolerance and metrics[metric] - expected[metric] > slack:
+                    regressions.append((scale, step, metric, expected[metric], metrics[metric]))
+    return regressions
+
+
+def report(results, baseline):
+    for scale, steps in results.items():
+        print(f"\n{scale}")
+        width = max(len(step) for step in steps)
+        for step, metrics in steps.items():
+            expected = baseline.get(scale, {}).get(step)
+            versus = f"  (baseline {expected['seconds']:.3f}s, {expected['peak_mb']:.1f}MB)" if expected else ""
+            print(f"  {step:<{width}}  {metrics['seconds']:9.3f}s  {metrics['peak_mb']:9.1f}MB{versus}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the readers, exporters and endpoints on synthetic datasets")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--min-seconds", type=float, default=0.05)
+    parser.add_argument("--min-mb", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    results = run(args.scales)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    report(results, baseline)
+
+    if args.save:
+        # scales that were not run keep their previous baseline
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({**baseline, **results}, baseline_file, indent=4)
+        print(f"\nbaseline saved to {args.baseline}")
+        return 0
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds, args.min_mb)
+    for scale, step, metric, expected, value in regressions:
+        print(f"REGRESSION {scale} {step}: {metric} {value} (baseline {expected})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules that unified_data_structure depends on live in the backend directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,150 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from pptx import Presentation
+from pptx.util import Inches
+
+"""
+Generator of synthetic versions of the 4 datasets, in the same format as the fixtures in testing/datasets, at any scale.
+At scale 1 the files are about the size of the fixtures, every source grows linearly with the scale:
+    dataset1.json   2 * scale companies with 15 employees and 4 quarters of performance each
+    dataset2.csv    100 * scale customer visits
+    dataset3.pdf    scale pages, each with a table of 10 quarters (Year, Quarter, Revenue (in $), Memberships Sold,
+                    Avg Duration (Minutes)), the pdf is written by hand so that nothing else has to be installed
+    dataset4.pptx   the key highlights slide, scale "Quarterly Metrics" table slides and the revenue distribution slide
+The data is random but reproducible (seed).
+"""
+
+ROLES = ["Personal Trainer", "Group Fitness Instructor", "Receptionist", "Manager", "Physiotherapist"]
+MEMBERSHIP_TYPES = ["Basic", "Premium", "VIP"]
+ACTIVITIES = ["Gym", "Pool", "Tennis Court", "Personal Training", "Yoga Class", "Climbing Wall", "Dance Class", "Swimming Class"]
+LOCATIONS = ["Downtown", "Eastside", "Westside"]
+PDF_COLUMNS = ["Year", "Quarter", "Revenue (in $)", "Memberships Sold", "Avg Duration (Minutes)"]
+
+
+def generate(directory, scale=1, seed=0):
+    # writes dataset1.json, dataset2.csv, dataset3.pdf and dataset4.pptx in directory, returns their paths
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = {
+        "dataset1.json": os.path.join(directory, "dataset1.json"),
+        "dataset2.csv": os.path.join(directory, "dataset2.csv"),
+        "dataset3.pdf": os.path.join(directory, "dataset3.pdf"),
+        "dataset4.pptx": os.path.join(directory, "dataset4.pptx"),
+    }
+    write_companies(paths["dataset1.json"], 2 * scale, rng)
+    write_customers(paths["dataset2.csv"], 100 * scale, rng)
+    write_pdf(paths["dataset3.pdf"], [_quarters(rng, 10) for _ in range(scale)])
+    write_pptx(paths["dataset4.pptx"], scale, rng)
+    return paths
+
+
+def write_companies(path, companies, rng, employees_per_company=15):
+    data = {"companies": []}
+    for company in range(1, companies + 1):
+        employees = [{
+            "id": f"E{company:05d}{n:03d}",
+            "name": f"Employee {company}-{n}",
+            "role": ROLES[int(rng.integers(len(ROLES)))],
+            "cashmoneh": int(rng.integers(30_000, 90_000)),
+            "hired_date": str(np.datetime64("2015-01-01") + int(rng.integers(0, 3000))),
+        } for n in range(1, employees_per_company + 1)]
+        data["companies"].append({
+            "id": company,
+            "name": f"Company {company}",
+            "industry": "Sports and Leisure",
+            "revenue": int(rng.integers(1_000_000, 100_000_000)),
+            "location": LOCATIONS[company % len(LOCATIONS)],
+            "employees": employees,
+            "performance": {
+                f"2023_Q{quarter}": {"revenue": int(rng.integers(1_000_000, 30_000_000)), "profit_margin": round(float(rng.uniform(5, 20)), 1)}
+                for quarter in range(1, 5)
+            },
+        })
+    with open(path, "w") as json_file:
+        json.dump(data, json_file, indent=4)
+
+
+def write_customers(path, rows, rng):
+    pd.DataFrame({
+        "Date": (np.datetime64("2024-01-01") + rng.integers(0, 366, rows)).astype(str),
+        "Membership_ID": [f"M{n:03d}" for n in rng.integers(1, 1000, rows)],
+        "Membership_Type": rng.choice(MEMBERSHIP_TYPES, rows),
+        "Activity": rng.choice(ACTIVITIES, rows),
+        "Revenue": rng.uniform(20, 200, rows).round(2),
+        "Duration (Minutes)": rng.choice([30, 45, 60, 90, 120], rows),
+        "Location": rng.choice(LOCATIONS, rows),
+    }).to_csv(path, index=False)
+
+
+def _quarters(rng, rows):
+    return [[str(2020 + n // 4), f"Q{n % 4 + 1}", f"{int(rng.integers(1_000, 5_000)) * 1000:,}",
+             str(int(rng.integers(200, 600))), str(int(rng.integers(60, 120)))] for n in range(rows)]
+
+
+def _pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, tables, columns=PDF_COLUMNS, column_width=110, row_height=20):
+    # one page (A4 portrait) per table, drawn as a grid of lines with the text of every cell inside it
+    objects = {1: "<< /Type /Catalog /Pages 2 0 R >>", 3: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    for n, rows in enumerate(tables):
+        page, content = 4 + 2 * n, 5 + 2 * n
+        kids.append(f"{page} 0 R")
+        rows = [columns] + rows
+        left, top = 30, 800
+        right, bottom = left + column_width * len(columns), top - row_height * len(rows)
+        commands = ["0.5 w"]
+        for row in range(len(rows) + 1):
+            commands.append(f"{left} {top - row * row_height} m {right} {top - row * row_height} l S")
+        for column in range(len(columns) + 1):
+            commands.append(f"{left + column * column_width} {top} m {left + column * column_width} {bottom} l S")
+        for row, cells in enumerate(rows):
+            for column, cell in enumerate(cells):
+                x, y = left + column * column_width + 4, top - (row + 1) * row_height + 6
+                commands.append(f"BT /F1 8 Tf {x} {y} Td ({_pdf_text(cell)}) Tj ET")
+        stream = "\n".join(commands)
+        objects[page] = f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {content} 0 R >>"
+        objects[content] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    body = b"%PDF-1.4\n"
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(body)
+        body += f"{number} 0 obj\n{objects[number]}\nendobj\n".encode("latin-1")
+    xref = len(body)
+    body += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    body += "".join(f"{offsets[number]:010d} 00000 n \n" for number in sorted(objects)).encode()
+    body += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as pdf_file:
+        pdf_file.write(body)
+
+
+def write_pptx(path, table_slides, rng):
+    pptx = Presentation()
+    title_only, blank = pptx.slide_layouts[5], pptx.slide_layouts[6]
+
+    def text_slide(lines):
+        slide = pptx.slides.add_slide(blank)
+        text_frame = slide.shapes.add_textbox(Inches(1), Inches(1), Inches(8), Inches(4)).text_frame
+        text_frame.text = lines[0]
+        for line in lines[1:]:
+            text_frame.add_paragraph().text = line
+
+    text_slide(["Key Highlights:", f"Total Revenue: ${int(rng.integers(1_000, 20_000)) * 1000:,}",
+                f"Total Memberships Sold: {int(rng.integers(500, 5000)):,}", f"Top Location: {LOCATIONS[0]}"])
+    for _ in range(table_slides):
+        slide = pptx.slides.add_slide(title_only)
+        slide.shapes.title.text = "Quarterly Metrics"
+        rows = [["Quarter"] + PDF_COLUMNS[2:]] + [row[1:] for row in _quarters(rng, 4)]
+        table = slide.shapes.add_table(len(rows), len(rows[0]), Inches(0.5), Inches(1.5), Inches(9), Inches(3)).table
+        for r, row in enumerate(rows):
+            for c, text in enumerate(row):
+                table.cell(r, c).text = text
+    shares = rng.dirichlet(np.ones(4)) * 100
+    text_slide(["Revenue Distribution:"] + [f"{activity}: {share:.0f}%" for activity, share in zip(ACTIVITIES[:4], shares)])
+    pptx.save(path)
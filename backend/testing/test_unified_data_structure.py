@@ -1,9 +1,27 @@
 import os
 import pandas as pd
-import tabula
-from pptx import Presentation
-import json
-import matplotlib.pyplot as plt
+import io
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from data_store import DataStore
+from ingestion_cache import IngestionCache
+from export_cache import ExportArtifact, ExportCache, key_etag
+import json_export
+import xlsx_export
+import columnar_export
+import visualisation
+import metrics
+import memory_budget
+import json_ingestion
+import csv_ingestion
+import pdf_extraction
+import pptx_extraction
+import query_engine
+from query_engine import QueryEngine
+from rollups import Rollups
+from change_log import Change, ChangeLog, diff_rows
 
 """
 This class represents the unified data structure that we will ingest the 4 datasets and provide useful visualisations of this dataset.
@@ -15,172 +33,611 @@ The unified dataset is of the following structure:
         value could be either a pandas dataframe or another dictionary
 Data ingestion (How I am to unify the 4 datasets):
     From the first dataset, I am to create 3 entries
-        First is a list of companies as pandas dataframe (has no emplyee data here)
+        First is a list of companies as pandas dataframe (has no emplyee data here), with a company_id column
         key = "companies", value = df
         Second is a dictionary in which
             the key is the index of the company (as an integer) in the first list and the value is the list of employees of that company
             as a pandas dataframe
+            all the employees are actually stored in a single dataframe with a company_id column (data["employees"].frame),
+            the dictionary is a grouped view over it (see json_ingestion.EmployeesView)
         key = "employees", value = dict
-        Third is a list of the companies performance. Since there are not that many values for company performance, Since the key set for each performance dictionary,
-        we will store it a pandas dataframe
+        Third is a list of the companies performance, one row per company and quarter (company_id, quarter, revenue, profit_margin)
         key="company_performance", value = df
     From second dataset, it looks to be a list of information about customers who come to Sports and Leisure
-        It will just be a list of customers as pandas data frame
+        It will just be a list of customers as pandas data frame, with parsed dates and categoricals (see csv_ingestion)
         key = "customers", value = df
     From third dataset, is a single table which would be represesnted as a pandas dataframe as well
         key = "quarterly_performance", value = df
+        any other table of the pdf is kept as well, key = "quarterly_performance_<n>" (n = 2, 3...), value = df
+        and where every table was found (page, position on the page, shape), key = "pdf_tables", value = df
     From fourth dataset, there will be 3 dictionaries each providing the relavant data summaries
-        key = "quarterly_metrics", value = dict
+        key = "quarterly_metrics", value = df
         key = "key_highlights", value = dict
         key = "revenue_distribution", value = dict
+        the deck is scanned generically (see pptx_extraction), amounts and percentages are numbers
+        read_pptx_decks ingests any number of other decks, their keys are prefixed with the name of the deck
+Lazy loading:
+    Every key of self.data is registered together with the reader that populates it (see SOURCES). With lazy=True nothing
+    is read in __init__, a source is only ingested the first time one of its keys is accessed and the result is kept in self.data.
+    This means get_data_keys() never reads a file, and a request that only needs "customers" never extracts the tables of the pdf.
+    With lazy=False (the default) every source is ingested in __init__ like before.
+    load_sources() ingests every pending source concurrently with per source timeouts. A source that fails does not stop the
+    others (its error ends up in self.load_errors), and the exports only include the datasets that could be loaded.
+    A failed source is only tried again once its file changed or LOAD_RETRY_SECONDS later, until then accessing its keys
+    raises data_store.SourceUnavailable (the server answers 503) and the charts leave it out.
+Ingestion cache:
+    When a cache_dir is given, what every reader produces for a source file is saved in an IngestionCache keyed by the
+    file's fingerprint (path, size, mtime and content hash). Restarting with unchanged datasets then loads the parsed
+    dataframes from the cache instead of re-parsing them (and read_pdf does not extract any table).
+    INGESTION_CACHE_VERSION has to be bumped whenever a reader changes what it produces, so that old entries are not reused.
+Exports:
+    get_data, get_data_xlsx and visualise_data write the consolidated json, xlsx and png to the datasets directory.
+    export(kind) produces the same artifacts in memory and caches them per version of self.data (see DataStore.version),
+    so serving them again is free until the data changes.
+    The consolidated json is streamed instead (see iter_json and json_export), its etag comes from the data version.
+    The xlsx is written row by row in constant memory (see xlsx_export), "xlsx_flat" puts every employee in a single sheet.
+    The module level render_export renders an artifact from a copy of self.data, which is what the server runs in its process pool.
+    Every dataset can also be exported as parquet or as an Arrow IPC stream, on its own or all of them in a zip (see
+    columnar_export), so that downstream jobs load dataframes without parsing json.
+    The visualisations can be rendered as png, svg or webp with a choice of charts, size and dpi (see visualisation), they
+    are drawn on their own matplotlib figures so renders can run concurrently.
+Instrumentation:
+    readers, parsers, the ingestion cache and every export run in metrics stages (timing and memory, see metrics), which
+    the server exposes on /metrics.
+Changes of the source files:
+    every reader swaps what it ingested from a file into self.data at once (DataStore.swap) and remembers the size and
+    mtime the file had (source_stats), the csv only up to that size. reload_source(name) ingests a file again,
+    replace_companies re-ingests only some companies of the json and append_customers adds new visits, which is what
+    source_watcher.SourceWatcher uses to follow the files while the server runs.
+Memory budget:
+    compact() converts every dataset held in memory to its most compact dtypes (categoricals, downcast numbers, Arrow
+    backed strings, parsed dates, see memory_budget) and memory_report() lists the memory footprint of every dataset.
+    With a memory_budget (bytes), load_sources compacts what it loads, and the biggest tables are spilled to memory mapped
+    Arrow files in spill_dir until the datasets held in memory fit in the budget. A spilled dataset keeps its key and
+    version, accessing it pages it back in (spilling others to make room), exports read it without keeping it.
+Queries:
+    query(dataset, ...) returns a page of a table filtered, projected and sorted with indexes, see query_engine.
+Change log:
+    every dataset has a version (DataStore.key_version) and the row level changes made by append_customers and
+    replace_companies are kept in a bounded change log, changes_since(dataset, version) returns them (or the whole
+    dataset when the log does not go back that far), see change_log.
+Rollups:
+    grouped counts, sums and means of Revenue and Duration (Minutes) over the dimensions in ROLLUPS (see rollups).
+    append_customers(rows) adds new visits to customers and updates the rollups incrementally.
 """
 class Unified_data_structure:
-    def __init__(self):
-        self.data = {}
-        self.read_json("datasets/dataset1.json")
-        self.read_csv("datasets/dataset2.csv")
-        self.read_pdf("datasets/dataset3.pdf")
-        self.read_pptx("datasets/dataset4.pptx")        
-
-    def read_json(self, filename):
-        json_data = pd.read_json(filename) #returns a pnadas dataframe
-        header_employees = [key for key, list in json_data["companies"][0]["employees"][0].items()]
-        employees = {}
-        company_performance = {}
-        # populate employees dictionary
-        for i in range(len(json_data['companies'])):
-            employees[i] = pd.DataFrame(json_data["companies"][i]["employees"], columns=header_employees)
-            company_performance[i] = json_data["companies"][i]["performance"]
-            del json_data["companies"][i]["employees"]
-            del json_data["companies"][i]["performance"]
-
-        header_companies = [key for key, ___ in json_data["companies"][0].items()]
-        companies = pd.DataFrame(json_data["companies"].to_list(), columns=header_companies)
-
-        header_company_performance = [key for key, ___ in company_performance[0].items()]
-        company_performance = pd.DataFrame(company_performance.values(), columns=header_company_performance)
-
-        self.data["companies"] = companies
-        self.data["employees"] = employees
-        self.data["companies_performance"] = company_performance
-        
-    def read_csv(self, filename):
-        csv_data = pd.read_csv(filename)
-        self.data['customers'] = csv_data
-    
+    # (file in the datasets directory, reader that ingests it, keys the reader populates in self.data)
+    SOURCES = [
+        ("dataset1.json", "read_json", ["companies", "employees", "companies_performance"]),
+        ("dataset2.csv", "read_csv", ["customers"]),
+        ("dataset3.pdf", "read_pdf", ["quarterly_performance", "pdf_tables"]),
+        ("dataset4.pptx", "read_pptx", ["revenue_distribution", "key_highlights", "quarterly_metrics"]),
+    ]
+
+    INGESTION_CACHE_VERSION = 6
+
+    # seconds after which load_sources stops waiting for a source, e.g. {"dataset3.pdf": 60}
+    SOURCE_TIMEOUTS = {}
+
+    # rollups of the customers table maintained by self.rollups: name -> dimensions (Month is derived from Date)
+    ROLLUPS = {
+        "location": ["Location"],
+        "activity": ["Activity"],
+        "membership_type": ["Membership_Type"],
+        "month": ["Month"],
+    }
+
+    # columns that identify the rows of a dataset in the change log, datasets without them only get rows appended
+    KEY_COLUMNS = {
+        "companies": ["company_id"],
+        "employees": ["company_id", "id"],
+        "companies_performance": ["company_id", "quarter"],
+    }
+    # rows of changes kept per dataset by the change log, clients further behind get the whole dataset
+    CHANGE_LOG_ROWS = 100_000
+
+    # dataset1.json files bigger than this are parsed one company at a time
+    JSON_INCREMENTAL_THRESHOLD = 64 * 1024 * 1024
+    # dataset2.csv files bigger than this are read in chunks, each chunk taking about CSV_CHUNK_MEMORY_BUDGET bytes to parse
+    CSV_CHUNKED_THRESHOLD = 256 * 1024 * 1024
+    CSV_CHUNK_MEMORY_BUDGET = 64 * 1024 * 1024
+
+    # backend of pdf_extraction used by read_pdf, None picks pdfplumber when it is installed and tabula otherwise
+    PDF_BACKEND = None
+
+    # a source that failed to load is tried again by load_sources when its file changes, or after this many seconds
+    LOAD_RETRY_SECONDS = 300
+
+    # number of rendered artifacts kept in memory (every chart size / dpi / format is an artifact of its own)
+    EXPORT_CACHE_ENTRIES = 64
+    EXPORT_CACHE_BYTES = 256 * 1024 * 1024
+
+    # kind of export -> (writer, media type, suggested filename)
+    EXPORTS = {
+        "json": ("_write_json", "application/json", "consolidated_dataset.json"),
+        "xlsx": ("_write_xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "consolidated_dataset.xlsx"),
+        # every employee in a single sheet instead of a sheet per company
+        "xlsx_flat": ("_write_xlsx_flat", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "consolidated_dataset.xlsx"),
+        "png": ("_write_png", "image/png", "data_visualisations.png"),
+        "svg": ("_write_svg", "image/svg+xml", "data_visualisations.svg"),
+        "webp": ("_write_webp", "image/webp", "data_visualisations.webp"),
+        # a single dataset (option dataset) or every dataset in a zip, see columnar_export (needs pyarrow)
+        "parquet": ("_write_parquet", "application/vnd.apache.parquet", "{dataset}.parquet"),
+        "arrow": ("_write_arrow", "application/vnd.apache.arrow.stream", "{dataset}.arrow"),
+        "parquet_archive": ("_write_parquet_archive", "application/zip", "consolidated_dataset.parquet.zip"),
+        "arrow_archive": ("_write_arrow_archive", "application/zip", "consolidated_dataset.arrow.zip"),
+    }
+
+    def __init__(self, lazy=False, datasets_dir="datasets", cache_dir=None, cache_max_bytes=512 * 1024 * 1024, data=None,
+                 memory_budget=None, spill_dir=None):
+        self.datasets_dir = datasets_dir
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir  # a temporary directory is created on the first spill when None
+        self._spill_files = {}  # key -> memory_budget.SpillFile it was last spilled to
+        self._budget_lock = threading.RLock()
+        self.cache = IngestionCache(cache_dir, cache_max_bytes) if cache_dir else None
+        self.export_cache = ExportCache(self.EXPORT_CACHE_ENTRIES, self.EXPORT_CACHE_BYTES)
+        if data is not None:
+            # already ingested data (e.g. a copy sent to a worker process), no source is read
+            self.data = DataStore(data)
+        else:
+            self.data = DataStore()
+            self.data.retry_interval = self.LOAD_RETRY_SECONDS
+            for filename, reader, keys in self.SOURCES:
+                self.register_source(filename, reader, keys)
+        # source file -> (size, mtime) it had when it was last ingested, and the keys that were ingested from it
+        self.source_stats = {}
+        self.source_keys = {}
+        self.query_engine = QueryEngine(self.data)
+        self.rollups = Rollups(self.data, self.ROLLUPS)
+        self.change_log = ChangeLog(self.CHANGE_LOG_ROWS)
+        self.load_errors = {}
+        if not lazy:
+            self.load_sources()
+
+    def register_source(self, filename, reader, keys):
+        # the keys are only ingested by the reader when one of them is first accessed in self.data
+        path = os.path.join(self.datasets_dir, filename)
+        reader = getattr(self, reader)
+        # a source that fails is retried when its file changes, or LOAD_RETRY_SECONDS later
+        self.data.register(filename, keys, lambda: reader(path), fingerprint=lambda: self._source_stat(filename))
+
+    def load_sources(self, timeouts=None, max_workers=None):
+        # ingests every source that is not loaded yet, all of them at the same time in a thread pool (the readers are
+        # independent, and a big pdf is extracted in the process pool of pdf_extraction)
+        # timeouts is a number of seconds for every source or a dict of source file -> seconds (SOURCE_TIMEOUTS by default)
+        # a source that fails or times out does not stop the others, its error is kept in self.load_errors and its keys
+        # stay registered. A failed source is only tried again once its file changed or LOAD_RETRY_SECONDS after the failure
+        # (until then accessing its keys raises data_store.SourceUnavailable), so that a broken file is not parsed again
+        # on every call. Returns the errors of this call
+        pending = [name for name in self.data.pending_sources() if self.data.can_load(name)]
+        if not pending:
+            return {}
+        if timeouts is None:
+            timeouts = self.SOURCE_TIMEOUTS
+        errors = {}
+        pool = ThreadPoolExecutor(max_workers=max_workers or len(pending), thread_name_prefix="ingestion")
+        try:
+            started = time.monotonic()
+            futures = {name: pool.submit(self.data.load_source, name) for name in pending}
+            for name, future in futures.items():
+                timeout = timeouts.get(name) if isinstance(timeouts, dict) else timeouts
+                remaining = None if timeout is None else max(0, started + timeout - time.monotonic())
+                try:
+                    future.result(timeout=remaining)
+                    self.load_errors.pop(name, None)
+                except FutureTimeoutError:
+                    errors[name] = TimeoutError(f"{name} was not loaded within {timeout} seconds")
+                except Exception as error:
+                    errors[name] = error
+        finally:
+            # a source that timed out keeps loading in the background and fills its keys when it is done
+            pool.shutdown(wait=False)
+        self.load_errors.update(errors)
+        if self.memory_budget is not None:
+            self.compact()
+            self.enforce_memory_budget()
+        return errors
+
+    def _source_stat(self, name):
+        try:
+            return file_stat(os.path.join(self.datasets_dir, name))
+        except OSError:
+            return None
+
+    def _cache_namespace(self, parse):
+        namespace = f"{parse.__name__}:v{self.INGESTION_CACHE_VERSION}"
+        if parse.__name__ == "_parse_pdf":
+            # the tables (and their types) depend on the backend that extracted them
+            namespace += f":{pdf_extraction.default_extractor(self.PDF_BACKEND).backend}"
+        return namespace
+
+    def _ingest(self, filename, parse, *args, stat=None):
+        # parse returns the entries of self.data produced from filename, they are taken from the ingestion cache when possible
+        # they replace what was ingested from filename before in one swap (keys it does not produce anymore are removed)
+        # stat is the (size, mtime) of the file the entries are parsed from, taken now by default
+        stat = stat or file_stat(filename)
+        namespace = self._cache_namespace(parse)
+        entries = None
+        if self.cache:
+            with metrics.stage("ingestion_cache_get"):
+                entries = self.cache.get(namespace, filename)
+            if file_stat(filename) != stat:
+                entries = None  # the cached entries are those of what the file became since stat
+        if entries is None:
+            with metrics.stage(parse.__name__.lstrip("_")):
+                entries = parse(filename, *args)
+            # a file that changed while it was parsed would be cached under the fingerprint of its new content
+            if self.cache and file_stat(filename) == stat:
+                with metrics.stage("ingestion_cache_put"):
+                    self.cache.put(namespace, filename, entries)
+        self.source_stats[filename] = stat
+        stale = [key for key in self.source_keys.get(filename, []) if key not in entries]
+        self.data.swap(entries, remove=stale)
+        self.source_keys[filename] = list(entries)
+
+    @metrics.instrument("read_json")
+    def read_json(self, filename, incremental=None):
+        # incremental=None picks the incremental parser for files bigger than JSON_INCREMENTAL_THRESHOLD
+        self._ingest(filename, self._parse_json, incremental)
+
+    @metrics.instrument("read_csv")
+    def read_csv(self, filename, chunksize=None):
+        # chunksize=None reads files bigger than CSV_CHUNKED_THRESHOLD in chunks that fit in CSV_CHUNK_MEMORY_BUDGET
+        # only the complete lines the file has now are read, rows appended later are ingested by source_watcher from the
+        # end of the last one (the size recorded in source_stats)
+        stat = file_stat(filename)
+        end = csv_ingestion.complete_size(filename, stat[0])
+        self._ingest(filename, self._parse_csv, chunksize, end, stat=stat)
+        self.source_stats[filename] = (end, stat[1])
+
+    @metrics.instrument("read_pdf")
     def read_pdf(self, filename):
-        # use tabula
-        # read and injest data from pdf
-        dfs = tabula.read_pdf(filename, pages='all')
-        # from checking what dfs returns, I see that it is a list with a single element
-        # where dfs[0] is a pandas dataframe
-        self.data['quarterly_performance'] = dfs[0]
+        self._ingest(filename, self._parse_pdf)
         return None
-    
+
+    @metrics.instrument("read_pptx")
     def read_pptx(self, filename):
-        # convert to pdf then read pdf
-        # will convert all the pptx files to pdf in specified dir
-        # in this dataset we have a table in slide 2
-        pptx = Presentation(filename)
-        # after exploring the pptx object in python shell i found where table in slide 2 is stored
-        table = pptx.slides[1].shapes[1].table
-        # convert this table to a pandas dataframe
-        data = []
-        for row in table.rows:
-            row_data = [cell.text.strip() for cell in row.cells]
-            data.append(row_data)
-        
-        # Convert to Pandas DataFrame
-        headers = data[0]  # first row does contain headers
-        rows = data[1:]  # Remaining rows are data
-        quarterly_metrics = pd.DataFrame(rows, columns=headers)
-        
-        # as for the information in slide 1 and 3, I think its best if we manually keyed in the information as the information is not in a tabular format and is short
-        # if there are too many datapoints then, my approach for that is to parse through the text in slide 1 and 3
-        key_highlights = {
-            "Total Revenue" : "$10,400,000",
-            "Total Memberships Sold" : "1520",
-            "Top Location" : "Downtown"
-        }
+        self._ingest(filename, self._parse_pptx)
+
+    @metrics.instrument("read_pptx_decks")
+    def read_pptx_decks(self, filenames):
+        # ingests a batch of decks, the decks that are not in the ingestion cache are scanned in parallel
+        # keys are prefixed with the name of their deck, e.g. "q3_report_key_highlights" for q3_report.pptx
+        namespace = self._cache_namespace(self._parse_pptx)
+        decks = {filename: self.cache.get(namespace, filename) if self.cache else None for filename in filenames}
+        missing = [filename for filename, entries in decks.items() if entries is None]
+        for filename, deck in zip(missing, pptx_extraction.scan_decks(missing)):
+            decks[filename] = deck.entries()
+            if self.cache:
+                self.cache.put(namespace, filename, decks[filename])
+        for filename, entries in decks.items():
+            prefix = os.path.splitext(os.path.basename(filename))[0]
+            for key, value in entries.items():
+                self.data[f"{prefix}_{key}"] = value
 
-        revenue_distribution = {
-            "Gym": "40%",
-            "Pool": "25%,",
-            "Tennis Court": "15%",
-            "Personal Training": "20%"
+    def _parse_json(self, filename, incremental=None):
+        # companies, employees and performance are flattened into single frames keyed by company_id (see json_ingestion)
+        # the incremental parser is used for big files so that the feed is never fully loaded as python objects
+        if incremental is None:
+            incremental = os.path.getsize(filename) > self.JSON_INCREMENTAL_THRESHOLD
+        companies = json_ingestion.iter_companies(filename) if incremental else json_ingestion.load_companies(filename)
+        companies, employees, company_performance = json_ingestion.flatten_companies(companies)
+
+        return {
+            "companies": companies,
+            # employees stays a dictionary of company index -> dataframe, as a grouped view over the single employees frame
+            "employees": json_ingestion.EmployeesView(employees, companies["company_id"]),
+            "companies_performance": company_performance,
         }
-        self.data["revenue_distribution"] = revenue_distribution
-        self.data["key_highlights" ] = key_highlights
-        self.data["quarterly_metrics"] = quarterly_metrics
 
+    def _parse_csv(self, filename, chunksize=None, end=None):
+        # customers are read with an explicit schema (dates, categoricals, downcast numerics), see csv_ingestion
+        if chunksize is None and os.path.getsize(filename) > self.CSV_CHUNKED_THRESHOLD:
+            chunksize = csv_ingestion.chunksize_for_budget(filename, self.CSV_CHUNK_MEMORY_BUDGET)
+        csv_data = csv_ingestion.read_customers(filename, chunksize, end)
+        return {"customers": csv_data}
+
+    def _parse_pdf(self, filename):
+        # every table of every page is extracted by a long lived extractor (no JVM started per call, see pdf_extraction)
+        tables = pdf_extraction.default_extractor(self.PDF_BACKEND).extract(filename)
+        # the first table is quarterly_performance, the other ones are kept as quarterly_performance_2, _3...
+        entries = {"quarterly_performance": tables[0].frame if tables else pd.DataFrame()}
+        for n, table in enumerate(tables[1:], start=2):
+            entries[f"quarterly_performance_{n}"] = table.frame
+        # where every table was found: page, index on the page, bounding box and shape
+        keys = list(entries)
+        entries["pdf_tables"] = pd.DataFrame([dict(key=key, **table.metadata()) for key, table in zip(keys, tables)],
+                                             columns=["key", "page", "index", "top", "left", "bottom", "right", "rows", "columns"])
+        return entries
+
+    def _parse_pptx(self, filename):
+        # every table and every "key: value" text block of every slide, with numbers, currencies and percentages parsed
+        # (see pptx_extraction). In dataset4.pptx these are quarterly_metrics (the table of slide 2), key_highlights
+        # (slide 1) and revenue_distribution (slide 3)
+        return pptx_extraction.scan_deck(filename).entries()
+
+    @metrics.instrument("get_data")
     def get_data(self):
         # return entire self.data as JSON. Does not return anything, just creates a file called 'consolidated_dataset.json'
-        datasets = {}
-        # convert our entire database to be JSON seriliazable. Minding that our data structure has got nested dictionaries where some values
-        # are also dataframes
-        # i am handling null values by replacing them with the string "null" for now
-
-        datasets["employees"] = {}
-        for key, df in self.data["employees"].items():
-            datasets["employees"][key] = df.fillna("null").to_dict(orient='records')
-        
-        for key, df in self.data.items():
-            if key not in datasets:
-                if isinstance(df, pd.DataFrame):
-                    # values is pandas dataframe
-                    datasets[key] = df.fillna("null").to_dict(orient='records')
-                else:
-                    datasets[key] = df
-
-        # Save the JSON data to a file
-        with open('datasets/consolidated_dataset.json', 'w') as json_file:
-            json.dump(datasets, json_file, indent=4)
-
-    def get_data_xlsx(self):
-        # Does not return anything, just creates a file called 'consolidated_dataset.json'
-        # We are converting the self.data to an xlsx file 
-        # in which each dataset would have its own excel sheet
-        with pd.ExcelWriter('datasets/consolidated_dataset.xlsx', engine='xlsxwriter') as writer:
-        # Iterate through the dictionary and write each DataFrame to a separate sheet
-            for sheet_name, df in self.data.items():
-                if sheet_name == "employees":
-                    # warning this could make the 
-                    for i in self.data["employees"]:
-                        self.data["employees"][i].to_excel(writer, sheet_name=f"Employees for Company {i}", index=False)
-                    continue
-                if isinstance(df, pd.DataFrame):
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-                elif isinstance(df, dict):
-                    # If data is a dictionary, convert it to a DataFrame first
-                    dict_df = pd.DataFrame([df])
-                    dict_df.to_excel(writer, sheet_name=sheet_name, index=False)
-            
+        self.load_sources()
+        with open(os.path.join(self.datasets_dir, 'consolidated_dataset.json'), 'wb') as json_file:
+            self._write_json(json_file)
+
+    def _write_json(self, output):
+        for chunk in self.iter_json():
+            output.write(chunk)
+
+    def iter_json(self):
+        # yields the consolidated json in chunks of bytes, see json_export for how nulls and dataframes are encoded
+        # only the datasets that are loaded are included, call load_sources() first
+        keys = ["employees"] + [key for key in self.data if key != "employees"]
+        return metrics.iter_stage("encode_json", json_export.iter_json(self.data.loaded_items(keys)))
+
+    def data_etag(self):
+        # strong etag for anything generated from self.data, it only changes when the data changes
+        return f'"{self.data.version_tag}"'
+
+    @metrics.instrument("get_data_xlsx")
+    def get_data_xlsx(self, single_employees_sheet=False):
+        # Does not return anything, just creates a file called 'consolidated_dataset.xlsx'
+        # (the server uses export("xlsx") instead, which renders into its own buffer)
+        self.load_sources()
+        self._write_xlsx(os.path.join(self.datasets_dir, 'consolidated_dataset.xlsx'), single_employees_sheet)
+
+    def _write_xlsx(self, output, single_employees_sheet=False):
+        # We are converting the self.data to an xlsx file (output is a path or a binary file object)
+        # in which each dataset would have its own excel sheet, rows are streamed in xlsxwriter's constant memory mode
+        xlsx_export.write_workbook(output, self.data.loaded_items(), single_employees_sheet)
+
+    def _write_xlsx_flat(self, output):
+        # same workbook with every employee in a single "employees" sheet (with a company_id column)
+        self._write_xlsx(output, single_employees_sheet=True)
+
+    def columnar_frame(self, dataset):
+        # the dataframe a dataset is exported as in parquet / arrow (employees is flattened, dicts are a single row)
+        return columnar_export.frame(dataset, self.data[dataset])
+
+    def iter_arrow(self, dataset, compression=None):
+        # yields a dataset as an Arrow IPC stream, one record batch at a time. The dataset is only read (loaded, paged in,
+        # employees flattened) once the first chunk is asked for
+        yield from columnar_export.iter_arrow(self.columnar_frame(dataset), compression)
+
+    def _write_parquet(self, output, dataset, compression=None):
+        columnar_export.write_parquet(output, self.columnar_frame(dataset), compression)
+
+    def _write_arrow(self, output, dataset, compression=None):
+        columnar_export.write_arrow(output, self.columnar_frame(dataset), compression)
+
+    def _write_parquet_archive(self, output, compression=None):
+        columnar_export.write_archive(output, self.data.loaded_items(), "parquet", compression)
+
+    def _write_arrow_archive(self, output, compression=None):
+        columnar_export.write_archive(output, self.data.loaded_items(), "arrow", compression)
+
+    @metrics.instrument("visualise_data")
     def visualise_data(self):
-        # here is a visalisation of top revenue earners by activity amongst basic membership types
-        # basic filtering and ordering of data is allowed as most values in the self.data dictionary are pandas dataframe
         # it is saved to a png file in datasets directory
+        self.load_sources()
+        self._write_png(os.path.join(self.datasets_dir, 'data_visualisations.png'))
+
+    def _write_png(self, output, **options):
+        # here is a visalisation of the customers per location and of the quarterly revenue (see visualisation.CHARTS
+        # for the charts that can be picked with options, and visualisation.chart_options for the size and dpi)
+        visualisation.render(output, self, "png", **options)
+
+    def _write_svg(self, output, **options):
+        visualisation.render(output, self, "svg", **options)
+
+    def _write_webp(self, output, **options):
+        visualisation.render(output, self, "webp", **options)
+
+    def export_options(self, kind, **options):
+        # options of an export with their defaults filled in, so that equivalent requests share a cache entry
+        # raises ValueError for invalid options
+        if kind in visualisation.FORMATS:
+            return visualisation.chart_options(**options)
+        if kind in ("parquet", "arrow", "parquet_archive", "arrow_archive"):
+            format = kind.split("_")[0]
+            normalized = {"compression": columnar_export.normalize_compression(format, options.pop("compression", None))}
+            if kind in ("parquet", "arrow"):
+                dataset = options.pop("dataset", None)
+                # spilled datasets are tables, they are not paged in to be checked
+                if dataset not in self.data or not (self.data.is_spilled(dataset) or isinstance(self.data[dataset], (pd.DataFrame, dict))):
+                    raise ValueError(f"'{dataset}' is not a dataset that can be exported as {format}")
+                normalized["dataset"] = dataset
+            if options:
+                raise ValueError(f"unknown options for the {kind} export: {', '.join(options)}")
+            return normalized
+        if options:
+            raise ValueError(f"the {kind} export takes no options")
+        return {}
+
+    def export_inputs(self, kind, **options):
+        # what render_export needs to render an export in another process: for the charts the rollups and datasets they
+        # read (the rollups come from self.rollups), for the other exports a plain copy of every loaded dataset
+        if kind in visualisation.FORMATS:
+            return visualisation.ChartInputs(self, self.export_options(kind, **options)["charts"])
+        return dict(self.data.loaded_items())
+
+    def export_cache_key(self, kind, **options):
+        # loading a lazy source does not change the version but it does change the version tag
+        # (a source that failed to load can be loaded later)
+        return (kind, self.data.version_tag) + tuple(sorted(self.export_options(kind, **options).items()))
 
-        fig, axes = plt.subplots(1, 2, figsize=(12, 6))  # 1 row, 2 columns
+    def export(self, kind, **options):
+        # returns the ExportArtifact of the given kind (see EXPORTS) for the current version of self.data
+        # an artifact is only generated once per data version and options, after that it comes from self.export_cache
+        self.load_sources()
+        cache_key = self.export_cache_key(kind, **options)
+        artifact = self.export_cache.get(cache_key)
+        if artifact is None:
+            artifact = self.render_export(kind, **options)
+            artifact.etag = key_etag(cache_key)
+            self.export_cache.put(cache_key, artifact)
+        return artifact
 
-        # first visualisation is a graph plot of revenue earned from customers against the amount of time spent in the facility
-        value_counts = dict(self.data["customers"]["Location"].value_counts())
-        axes[0].bar(value_counts.keys(), value_counts.values())
-        axes[0].set_title('Overview of customers in each location')
-        axes[0].set_xlabel('Location')
-        axes[0].set_ylabel('Number of customers')
-        
+    def render_export(self, kind, **options):
+        # generates the artifact without looking at the export cache
+        writer, media_type, filename = self.EXPORTS[kind]
+        output = io.BytesIO()
+        options = self.export_options(kind, **options)
+        with metrics.stage(f"render_{kind}"):
+            getattr(self, writer)(output, **options)
+        return ExportArtifact(output.getvalue(), media_type, filename.format(**options))
 
-        # second visualisation is quarterly revenue against time
-        x = range(len(self.data["quarterly_performance"]))
-        y = self.data["quarterly_performance"]["Revenue (in $)"]
-        axes[1].plot(x, y)
-        axes[1].set_title('Quarterly Performance')
-        axes[1].set_xlabel('Time')
-        axes[1].set_ylabel('Revenue')
+    def query(self, dataset, filters=None, columns=None, sort=None, limit=None, cursor=None):
+        # one page of a table of self.data, answered from the indexes of self.query_engine (see query_engine.QueryEngine.query)
+        limit = limit or query_engine.DEFAULT_LIMIT
+        result = self.query_engine.query(dataset, filters, columns, sort, limit, cursor)
+        result["version"] = self.data.key_version(dataset)
+        return result
 
-        plt.tight_layout()
-        plt.savefig('datasets/data_visualisations.png', dpi=300, bbox_inches='tight')
-        plt.close()
+    def append_customers(self, rows):
+        # rows (dataframe or list of dicts with the columns of dataset2.csv) are new visits, they are added to customers
+        # and to the rollups incrementally
+        rows = csv_ingestion.compact(pd.DataFrame(rows))
+        customers = self.data["customers"]
+        previous_version = self.data.key_version("customers")
+        self.data["customers"] = csv_ingestion.concat_chunks([customers, rows[customers.columns]], customers.columns)
+        version = self.data.key_version("customers")
+        self.rollups.add(rows, previous_version, version)
+        self.change_log.record("customers", previous_version, Change(version, inserted=rows[customers.columns]))
+        return rows
+
+    def changes_since(self, dataset, since=None, token=None):
+        # what changed in dataset after version since: {"dataset", "token", "version", "key", "full", and "changes" (list
+        # of change_log.Change) or "data" (the whole dataset, when since is None, when the changes are not in the log
+        # anymore or when token is not the token of self.data, i.e. since is a version of another process or snapshot)}
+        for _ in range(3):
+            # the version has to be the one of the data that is returned
+            version = self.data.key_version(dataset)
+            value = self.data[dataset]
+            if self.data.key_version(dataset) == version:
+                break
+        changes = None
+        if since is not None and token in (None, self.data.token):
+            changes = self.change_log.since(dataset, since, version)
+        result = {"dataset": dataset, "token": self.data.token, "version": version, "key": self.KEY_COLUMNS.get(dataset, []),
+                  "full": changes is None}
+        if changes is None:
+            result["data"] = json_ingestion.employees_frame(value) if isinstance(value, json_ingestion.EmployeesView) else value
+        else:
+            result["changes"] = changes
+        return result
+
+    def get_rollup(self, name):
+        # dataframe of the groups of a rollup, see rollups.Rollups.get
+        return self.rollups.get(name)
+
+    def compact(self, keys=None):
+        # converts the datasets held in memory (all of them or keys) to their most compact dtypes, returns the keys that changed
+        changed = []
+        with metrics.stage("compact"):
+            for key, value in self.data.resident_items():
+                if keys is not None and key not in keys:
+                    continue
+                compacted = memory_budget.compact_value(value)
+                # skipped when the key was written (e.g. by append_customers) while it was being compacted
+                if compacted is not value and self.data.replace_if(key, value, compacted):
+                    changed.append(key)
+        return changed
+
+    def memory_report(self):
+        # one row per dataset: state (in memory, spilled or not loaded), bytes held in memory and size of its spill file
+        rows = []
+        for key in self.data.keys():
+            if self.data.is_spilled(key):
+                rows.append((key, "spilled", 0, self._spill_files[key].size))
+            elif self.data.is_loaded(key):
+                rows.append((key, "in memory", memory_budget.footprint(self.data[key]), 0))
+            else:
+                rows.append((key, "not loaded", 0, 0))
+        return pd.DataFrame(rows, columns=["dataset", "state", "memory_bytes", "spilled_bytes"])
+
+    def enforce_memory_budget(self, reserve=0):
+        # spills the biggest tables held in memory until they take at most memory_budget - reserve bytes, returns the
+        # spilled keys. A single table bigger than the budget still stays in memory while it is being used
+        if self.memory_budget is None:
+            return []
+        spilled = []
+        with self._budget_lock:
+            resident = dict(self.data.resident_items())
+            sizes = {key: memory_budget.footprint(value) for key, value in resident.items()}
+            total = sum(sizes.values()) + reserve
+            for key in sorted(sizes, key=sizes.get, reverse=True):
+                if total <= self.memory_budget:
+                    break
+                if memory_budget.spillable(resident[key]) and self._spill(key, resident[key]):
+                    total -= sizes[key]
+                    spilled.append(key)
+        return spilled
+
+    def _spill(self, key, value):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="data_api_spill_")
+        with metrics.stage("spill"):
+            spill_file = memory_budget.spill(value, self.spill_dir, key)
+        self._spill_files[key] = spill_file
+        if not self.data.spill(key, lambda: self._page_in(spill_file), value):
+            return False  # replaced in the meantime
+        # the indexes of the query engine hold the dataframe
+        self.query_engine.forget(key)
+        return True
+
+    def _page_in(self, spill_file):
+        with metrics.stage("page_in"):
+            value = spill_file()
+        # room is made before the value is kept in memory again
+        self.enforce_memory_budget(reserve=memory_budget.footprint(value))
+        return value
+
+    def reload_source(self, name):
+        # ingests the source file name of SOURCES (e.g. "dataset3.pdf") again, its keys are swapped in at once
+        for filename, reader, _ in self.SOURCES:
+            if filename == name:
+                return getattr(self, reader)(os.path.join(self.datasets_dir, filename))
+        raise KeyError(f"unknown source '{name}'")
+
+    def replace_companies(self, filename, changed, order, stat=None):
+        # re-ingests only the changed companies of filename (dataset1.json): changed is the list of company dicts that
+        # are new or changed, order the company ids of the whole feed (see json_ingestion.diff_companies)
+        keys = ["companies", "employees", "companies_performance"]
+        with metrics.stage("replace_companies"):
+            previous_versions = [self.data.key_version(key) for key in keys]
+            frames = (self.data["companies"], json_ingestion.employees_frame(self.data["employees"]), self.data["companies_performance"])
+            changed_frames = json_ingestion.flatten_companies(changed)
+            companies, employees, company_performance = json_ingestion.splice_companies(frames, changed_frames, order)
+            self.source_stats[filename] = stat or file_stat(filename)
+            self.data.swap({
+                "companies": companies,
+                "employees": json_ingestion.EmployeesView(employees, companies["company_id"]),
+                "companies_performance": company_performance,
+            })
+            # row level changes of the companies that were replaced or removed
+            affected = set(changed_frames[0]["company_id"]) | (set(frames[0]["company_id"]) - set(order))
+            for key, previous_version, old, new in zip(keys, previous_versions, frames, (companies, employees, company_performance)):
+                change = diff_rows(old[old["company_id"].isin(affected)], new[new["company_id"].isin(affected)], self.KEY_COLUMNS[key])
+                if change is not None:
+                    change.version = self.data.key_version(key)
+                    self.change_log.record(key, previous_version, change)
 
     def get_data_keys(self):
-        return self.data.keys()
\ No newline at end of file
+        return self.data.keys()
+
+
+def file_stat(filename):
+    # (size, mtime) of a file, what source_watcher compares to tell that it changed
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def render_export(kind, inputs, options=None):
+    # renders an export from its Unified_data_structure.export_inputs, so that it can run in another process
+    if isinstance(inputs, visualisation.ChartInputs):
+        _, media_type, filename = Unified_data_structure.EXPORTS[kind]
+        output = io.BytesIO()
+        with metrics.stage(f"render_{kind}"):
+            visualisation.render(output, inputs, kind, **(options or {}))
+        return ExportArtifact(output.getvalue(), media_type, filename)
+    return Unified_data_structure(data=inputs).render_export(kind, **(options or {}))
\ No newline at end of file
@@ -3,11 +3,45 @@ import pandas as pd
 import json
 import os
 from test_unified_data_structure import Unified_data_structure
+from ingestion_cache import IngestionCache
+from data_store import DataStore, SourceUnavailable
+from export_cache import ExportArtifact, ExportCache
+from executors import Executors, SingleFlight
+import json_ingestion
+import pdf_extraction
+import pptx_extraction
+import xlsx_export
+import visualisation
+import columnar_export
+import synthetic_datasets
+import benchmark
+import metrics
+import memory_budget
+import json_export
+import snapshot
+from source_watcher import SourceWatcher
+from change_log import Change, ChangeLog
+import pyarrow as pa
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import zipfile
+import io
+import re
+import threading
+from query_engine import QueryError
+import pickle
+import asyncio
+import shutil
+import time
 
 @pytest.fixture
 def uds():
     return Unified_data_structure()
 
+@pytest.fixture
+def lazy_uds():
+    return Unified_data_structure(lazy=True)
+
 def test_init(uds):
     assert isinstance(uds.data, dict)
     assert len(uds.data) > 0
@@ -34,6 +68,35 @@ def test_read_pptx(uds):
     assert "quarterly_metrics" in uds.data
     assert isinstance(uds.data["quarterly_metrics"], pd.DataFrame)
 
+def test_read_pptx_parses_every_slide(uds):
+    assert uds.data["revenue_distribution"] == {"Gym": 40.0, "Pool": 25.0, "Tennis Court": 15.0, "Personal Training": 20.0}
+    assert uds.data["key_highlights"] == {"Total Revenue": 10400000, "Total Memberships Sold": 1520, "Top Location": "Downtown"}
+    metrics = uds.data["quarterly_metrics"]
+    assert list(metrics["Quarter"]) == ["Q1", "Q2", "Q3", "Q4"]
+    assert metrics["Revenue (in $)"].tolist() == [2300000, 2500000, 2700000, 2900000]
+
+def test_pptx_parse_value():
+    assert pptx_extraction.parse_value("$10,400,000") == 10400000
+    assert pptx_extraction.parse_value("25%,") == 25.0
+    assert pptx_extraction.parse_value("-1.5") == -1.5
+    assert pptx_extraction.parse_value(" Downtown ") == "Downtown"
+
+def test_read_pptx_decks(tmp_path, monkeypatch):
+    decks = []
+    for name in ["q1_report", "q2_report"]:
+        decks.append(str(tmp_path / f"{name}.pptx"))
+        shutil.copy("datasets/dataset4.pptx", decks[-1])
+    uds = Unified_data_structure(lazy=True, cache_dir=tmp_path / "cache")
+    uds.read_pptx_decks(decks)
+    for name in ["q1_report", "q2_report"]:
+        assert uds.data[f"{name}_revenue_distribution"]["Gym"] == 40.0
+        pd.testing.assert_frame_equal(uds.data[f"{name}_quarterly_metrics"], uds.data["quarterly_metrics"])
+    # a second batch comes from the ingestion cache
+    monkeypatch.setattr("pptx_extraction.scan_decks", lambda filenames: [] if not filenames else 1 / 0)
+    again = Unified_data_structure(lazy=True, cache_dir=tmp_path / "cache", data={})
+    again.read_pptx_decks(decks)
+    assert again.data["q2_report_key_highlights"] == uds.data["key_highlights"]
+
 def test_get_data(uds, tmp_path):
     uds.get_data()
     json_file = 'datasets/consolidated_dataset.json'
@@ -48,7 +111,792 @@ def test_get_data_xlsx(uds):
     xlsx_file = 'datasets/consolidated_dataset.xlsx'
     assert os.path.exists(xlsx_file)
 
+def _sheet_names(body):
+    with zipfile.ZipFile(io.BytesIO(body)) as workbook:
+        return re.findall(r'<sheet name="([^"]*)"', workbook.read("xl/workbook.xml").decode())
+
+def test_xlsx_single_employees_sheet(uds):
+    sheets = _sheet_names(uds.export("xlsx_flat").body)
+    assert "employees" in sheets
+    assert not any(sheet.startswith("Employees for Company") for sheet in sheets)
+    assert len([sheet for sheet in _sheet_names(uds.export("xlsx").body) if sheet.startswith("Employees for Company")]) == len(uds.data["employees"])
+
+def test_xlsx_export_splits_long_tables(monkeypatch):
+    monkeypatch.setattr(xlsx_export, "MAX_ROWS", 3)
+    output = io.BytesIO()
+    items = [("a very long dataset name that excel would reject", pd.DataFrame({"x": range(5)})), ("empty", pd.DataFrame({"x": []}))]
+    xlsx_export.write_workbook(output, items, batch_size=2)
+    # 2 rows per sheet under the header
+    assert _sheet_names(output.getvalue()) == ["a very long dataset name that e", "a very long dataset name th (2)", "a very long dataset name th (3)", "empty"]
+
 def test_visualise_data(uds):
     uds.visualise_data()
     png_file = 'datasets/data_visualisations.png'
     assert os.path.exists(png_file)
+
+def test_parquet_export(uds):
+    artifact = uds.export("parquet", dataset="customers", compression="zstd")
+    assert artifact.filename == "customers.parquet"
+    customers = pd.read_parquet(io.BytesIO(artifact.body))
+    # pandas reads the Arrow backed strings back as python backed ones
+    pd.testing.assert_frame_equal(customers.astype({"Membership_ID": "string[pyarrow]"}), uds.data["customers"])
+    with pytest.raises(ValueError):
+        uds.export("parquet", dataset="customers", compression="rar")
+    with pytest.raises(ValueError):
+        uds.export("arrow", dataset="unknown")
+
+def test_arrow_stream_of_employees(uds):
+    stream = b"".join(columnar_export.iter_arrow(uds.columnar_frame("employees"), "lz4", batch_size=7))
+    employees = pa.ipc.open_stream(stream).read_all().to_pandas()
+    pd.testing.assert_frame_equal(employees, uds.data["employees"].frame)
+
+def test_arrow_stream_shares_column_buffers():
+    frame = pd.DataFrame({"value": np.arange(100000)})
+    values = frame["value"].to_numpy()
+    chunks = list(columnar_export.iter_arrow(frame))
+    # the buffer of the column is yielded as it is (one slice per batch), not copied
+    views = [chunk for chunk in chunks if isinstance(chunk, memoryview)]
+    assert sum(view.nbytes for view in views) == values.nbytes
+    assert np.frombuffer(views[0], np.int64).ctypes.data == values.ctypes.data
+    assert pa.ipc.open_stream(b"".join(chunks)).read_all().column("value").to_numpy().tolist() == values.tolist()
+
+def test_iter_arrow_reads_dataset_lazily(lazy_uds):
+    stream = lazy_uds.iter_arrow("employees")
+    assert not lazy_uds.data.is_loaded("employees")
+    table = pa.ipc.open_stream(b"".join(stream)).read_all()
+    assert table.num_rows == len(lazy_uds.data["employees"].frame)
+
+def test_columnar_archive(uds):
+    artifact = uds.export("arrow_archive")
+    with zipfile.ZipFile(io.BytesIO(artifact.body)) as archive:
+        names = archive.namelist()
+        key_highlights = pa.ipc.open_stream(archive.read("key_highlights.arrow")).read_all().to_pylist()
+    assert "employees.arrow" in names and "customers.arrow" in names
+    assert key_highlights == [uds.data["key_highlights"]]
+
+def test_visualisation_options_and_cache(uds):
+    svg = uds.export("svg", charts="locations,monthly_revenue", width=6, height=3)
+    assert svg.media_type == "image/svg+xml"
+    assert svg.body.lstrip().startswith(b"<?xml")
+    # equivalent options share the cached render
+    assert uds.export("svg", charts=["locations", "monthly_revenue"], width="6", height=3.0) is svg
+    assert uds.export("png", dpi=50) is not uds.export("png", dpi=60)
+    with pytest.raises(ValueError):
+        uds.export("png", charts="pie")
+    # a 24000 x 24000 canvas is refused before anything is drawn
+    with pytest.raises(ValueError):
+        visualisation.chart_options(width=40, height=40, dpi=600)
+
+def test_export_cache_byte_budget():
+    cache = ExportCache(max_entries=10, max_bytes=10)
+    for key in "abc":
+        cache.put(key, ExportArtifact(b"1234", "text/plain", key))
+    # the least recently used artifact made room
+    assert cache.get("a") is None and cache.get("b") is not None and cache.get("c") is not None
+    cache.put("big", ExportArtifact(b"x" * 11, "text/plain", "big"))
+    assert cache.get("big") is None and cache.get("b") is not None
+
+def test_visualisation_renders_concurrently(uds):
+    expected = uds.render_export("png", dpi=40).body
+    with ThreadPoolExecutor(4) as pool:
+        bodies = list(pool.map(lambda _: uds.render_export("png", dpi=40).body, range(8)))
+    assert all(body == expected for body in bodies)
+
+def test_visualisation_downsample():
+    y = np.sin(np.linspace(0, 100, 100_000))
+    y[54_321] = 5
+    x, sampled = visualisation.downsample(np.arange(len(y)), y, max_points=300)
+    assert len(sampled) <= 300
+    assert sampled.max() == 5 and sampled.min() == y.min()
+    assert x[0] == 0
+
+def test_synthetic_datasets(tmp_path):
+    synthetic_datasets.generate(tmp_path, scale=3)
+    uds = Unified_data_structure(datasets_dir=tmp_path)
+    assert uds.load_errors == {}
+    assert len(uds.data["companies"]) == 6
+    assert len(uds.data["customers"]) == 300
+    assert list(uds.data["pdf_tables"]["page"]) == [1, 2, 3]
+    assert "quarterly_metrics_3" in uds.data
+
+def test_benchmark_compare():
+    baseline = {"1x": {"read_csv": {"seconds": 1.0, "peak_mb": 10.0}, "read_pdf": {"seconds": 0.01, "peak_mb": 1.0}}}
+    results = {"1x": {"read_csv": {"seconds": 2.0, "peak_mb": 10.5}, "read_pdf": {"seconds": 0.03, "peak_mb": 1.0}}}
+    # read_pdf is 3 times slower but by less than min_seconds
+    assert benchmark.compare(results, baseline) == [("1x", "read_csv", "seconds", 1.0, 2.0)]
+
+def test_metrics_stages(lazy_uds):
+    calls = metrics.STAGE_CALLS.value("parse_csv", "ok")
+    lazy_uds.data["customers"]
+    assert metrics.STAGE_CALLS.value("parse_csv", "ok") == calls + 1
+    with pytest.raises(ZeroDivisionError):
+        with metrics.stage("test_failing_stage"):
+            1 / 0
+    assert metrics.STAGE_CALLS.value("test_failing_stage", "error") == 1
+    rendered = metrics.REGISTRY.render()
+    assert '# TYPE data_api_stage_duration_seconds histogram' in rendered
+    assert 'data_api_stage_duration_seconds_bucket{stage="parse_csv",le="+Inf"}' in rendered
+
+def test_metrics_histogram_buckets():
+    histogram = metrics.Histogram("test_seconds", "test", ["stage"], buckets=(1, 2))
+    for value in (0.5, 1.5, 3):
+        histogram.observe("a", value=value)
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{stage="a",le="1"} 1',
+        'test_seconds_bucket{stage="a",le="2"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+def test_metrics_profile():
+    def busy_loop():
+        deadline = time.perf_counter() + 0.2
+        while time.perf_counter() < deadline:
+            pass
+    with metrics.profile(interval=0.001) as profile:
+        busy_loop()
+    assert profile.samples
+    assert "busy_loop" in profile.folded().splitlines()[0]
+
+def test_lazy_get_data_keys(lazy_uds):
+    assert len(lazy_uds.get_data_keys()) == 9
+    assert "quarterly_performance" in lazy_uds.get_data_keys()
+    assert len(lazy_uds.data.unloaded_keys()) == 9
+
+def test_lazy_loads_only_accessed_source(lazy_uds):
+    customers = lazy_uds.data["customers"]
+    assert isinstance(customers, pd.DataFrame)
+    assert lazy_uds.data.is_loaded("customers")
+    assert not lazy_uds.data.is_loaded("quarterly_performance")
+    assert not lazy_uds.data.is_loaded("companies")
+    # loaded values are cached
+    assert lazy_uds.data["customers"] is customers
+
+def test_lazy_loads_every_key_of_a_source(lazy_uds):
+    assert isinstance(lazy_uds.data["employees"], dict)
+    assert lazy_uds.data.is_loaded("companies")
+    assert lazy_uds.data.is_loaded("companies_performance")
+
+def test_ingestion_cache_warm_restart(tmp_path, monkeypatch):
+    cold = Unified_data_structure(lazy=True, cache_dir=tmp_path)
+    expected = cold.data["quarterly_performance"]
+
+    # on a warm restart the pdf must come from the cache instead of being extracted again
+    def fail(*args, **kwargs):
+        raise AssertionError("the pdf should not be extracted on a warm restart")
+    monkeypatch.setattr("pdf_extraction.PdfTableExtractor.extract_many", fail)
+    warm = Unified_data_structure(lazy=True, cache_dir=tmp_path)
+    pd.testing.assert_frame_equal(warm.data["quarterly_performance"], expected)
+
+def test_read_pdf_keeps_every_table_with_its_position(uds):
+    tables = uds.data["pdf_tables"]
+    assert list(tables["key"]) == ["quarterly_performance"]
+    assert tables.loc[0, "page"] == 1
+    assert tables.loc[0, "top"] < tables.loc[0, "bottom"]
+    assert tables.loc[0, "rows"] == len(uds.data["quarterly_performance"])
+
+def test_pdf_extraction_matches_tabula_types():
+    table = pdf_extraction.PdfTableExtractor().extract("datasets/dataset3.pdf")[0]
+    frame = table.frame
+    # same columns and types as tabula.read_pdf gave for the single table of the pdf
+    assert list(frame.columns[:4]) == ["Year", "Quarter", "Revenue (in $)", "Memberships Sold"]
+    assert frame["Year"].dtype == "int64"
+    assert frame["Memberships Sold"].dtype == "int64"
+    assert frame.loc[0, "Revenue (in $)"] == "2,100,000"
+
+def test_pdf_extraction_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf_extraction, "PARALLEL_MIN_PAGES", 1)
+    copy = str(tmp_path / "copy.pdf")
+    shutil.copy("datasets/dataset3.pdf", copy)
+    extractor = pdf_extraction.PdfTableExtractor(workers=2)
+    try:
+        expected = extractor.extract("datasets/dataset3.pdf")
+        tables = extractor.extract_many(["datasets/dataset3.pdf", copy])
+        assert pdf_extraction.measure_throughput(extractor, ["datasets/dataset3.pdf", copy]) > 0
+    finally:
+        extractor.close()
+    for filename in ["datasets/dataset3.pdf", copy]:
+        assert len(tables[filename]) == 1
+        pd.testing.assert_frame_equal(tables[filename][0].frame, expected[0].frame)
+        assert tables[filename][0].metadata() == expected[0].metadata()
+
+def test_pdf_extraction_pool_resolves_relative_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf_extraction, "PARALLEL_MIN_PAGES", 1)
+    synthetic_datasets.write_pdf(tmp_path / "dataset3.pdf", [[["2024", "Q1", "1,000", "10", "60"]]] * 3)
+    extractor = pdf_extraction.PdfTableExtractor(workers=1)
+    try:
+        # the pool is started from the testing directory, the relative path is then resolved from tmp_path
+        extractor.extract("datasets/dataset3.pdf")
+        monkeypatch.chdir(tmp_path)
+        assert [table.page for table in extractor.extract("dataset3.pdf")] == [1, 2, 3]
+    finally:
+        extractor.close()
+
+def test_ingestion_cache_misses_on_changed_file(tmp_path):
+    source = tmp_path / "source.csv"
+    source.write_text("a,b\n1,2\n")
+    cache = IngestionCache(tmp_path / "cache")
+    cache.put("csv", source, {"rows": 1})
+    assert cache.get("csv", source) == {"rows": 1}
+    source.write_text("a,b\n1,2\n3,4\n")
+    assert cache.get("csv", source) is None
+    # only the hash of the last version of a file is kept
+    assert len(cache._content_hashes) == 1
+
+def test_pdf_cache_namespace_depends_on_backend(uds, monkeypatch):
+    namespaces = set()
+    for backend in ["pdfplumber", "tabula"]:
+        monkeypatch.setattr(uds, "PDF_BACKEND", backend)
+        namespaces.add(uds._cache_namespace(uds._parse_pdf))
+    assert len(namespaces) == 2
+
+def test_ingestion_cache_eviction(tmp_path):
+    cache = IngestionCache(tmp_path / "cache", max_bytes=3000)
+    for i in range(5):
+        source = tmp_path / f"source{i}.txt"
+        source.write_text(str(i))
+        cache.put("txt", source, b"x" * 1000)
+    entries = [name for name in os.listdir(tmp_path / "cache") if name.endswith(".pkl")]
+    assert len(entries) <= 2
+    assert cache.get("txt", tmp_path / "source4.txt") == b"x" * 1000
+
+def test_export_is_cached_per_data_version(uds):
+    artifact = uds.export("json")
+    assert uds.export("json") is artifact
+    assert json.loads(artifact.body)["customers"]
+    uds.data["key_highlights"] = {"Top Location": "Eastside"}
+    changed = uds.export("json")
+    assert changed is not artifact
+    assert changed.etag != artifact.etag
+
+def test_export_etag_survives_eviction(uds):
+    etags = {}
+    for kind in ("xlsx", "svg", "parquet_archive"):
+        etags[kind] = uds.export(kind).etag
+    # rendered again after the cache lost them: other bytes (timestamps) but the same etag
+    uds.export_cache.clear()
+    for kind, etag in etags.items():
+        assert uds.export(kind).etag == etag
+    assert len(set(etags.values())) == 3
+
+def test_iter_json_streams_every_dataset(uds):
+    chunks = list(uds.iter_json())
+    assert len(chunks) > len(uds.get_data_keys())
+    data = json.loads(b"".join(chunks))
+    assert list(data) == ["employees"] + [key for key in uds.get_data_keys() if key != "employees"]
+    # typed columns (dates, categoricals) are written the same way as in the source csv
+    assert data["customers"] == pd.read_csv("datasets/dataset2.csv").to_dict(orient="records")
+    assert data["employees"]["0"] == uds.data["employees"][0].fillna("null").to_dict(orient="records")
+    assert data["key_highlights"] == uds.data["key_highlights"]
+
+def test_iter_json_batches_large_frames(uds):
+    uds.data["customers"] = pd.concat([uds.data["customers"]] * 30, ignore_index=True)
+    data = json.loads(b"".join(uds.iter_json()))
+    assert len(data["customers"]) == len(uds.data["customers"])
+
+def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def main():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(*[single_flight.do("key", compute) for _ in range(10)])
+        assert single_flight.in_flight() == 0
+        return results
+
+    assert asyncio.run(main()) == [1] * 10
+    assert len(calls) == 1
+
+def test_render_export_in_process_pool(uds):
+    executors = Executors(cpu_workers=1, cpu_executor="process")
+    try:
+        from test_unified_data_structure import render_export
+        artifact = executors.cpu_pool.submit(render_export, "xlsx", uds.data.copy()).result()
+        # a chart is rendered from the rollups and datasets it reads
+        options = uds.export_options("png", dpi=40)
+        inputs = uds.export_inputs("png", **options)
+        assert set(inputs.rollups) == {"location"} and set(inputs.data) == {"quarterly_performance"}
+        png = executors.cpu_pool.submit(render_export, "png", inputs, options).result()
+    finally:
+        executors.shutdown()
+    assert artifact.body.startswith(b"PK")
+    assert artifact.filename == "consolidated_dataset.xlsx"
+    assert png.body == uds.render_export("png", dpi=40).body
+
+def test_read_json_single_frames(uds):
+    employees = uds.data["employees"]
+    assert len(employees) == len(uds.data["companies"])
+    assert "company_id" in employees.frame
+    assert len(employees.frame) == sum(len(df) for df in employees.values())
+    assert list(uds.data["companies_performance"].columns[:2]) == ["company_id", "quarter"]
+    with open("datasets/dataset1.json") as f:
+        raw = json.load(f)
+    assert list(employees[1]["id"]) == [employee["id"] for employee in raw["companies"][1]["employees"]]
+    assert "company_id" not in employees[0]
+
+def test_iter_companies_matches_full_load():
+    expected = json_ingestion.load_companies("datasets/dataset1.json")
+    # tiny chunks so that companies are cut across reads
+    assert list(json_ingestion.iter_companies("datasets/dataset1.json", chunk_size=7)) == expected
+
+def test_iter_companies_decodes_big_company_few_times(tmp_path, monkeypatch):
+    company = {"id": 1, "employees": [{"id": n, "name": f"employee {n}"} for n in range(5000)]}
+    path = tmp_path / "feed.json"
+    path.write_text(json.dumps({"companies": [company, {"id": 2, "employees": []}]}))
+    attempts = []
+    class CountingDecoder(json.JSONDecoder):
+        def raw_decode(self, s, idx=0):
+            attempts.append(idx)
+            return super().raw_decode(s, idx)
+    monkeypatch.setattr(json_ingestion.json, "JSONDecoder", CountingDecoder)
+    # the company is about 150KB, decoding it again after every 64 bytes read would take thousands of attempts
+    assert list(json_ingestion.iter_companies(path, chunk_size=64)) == [company, {"id": 2, "employees": []}]
+    assert len(attempts) < 30
+
+def test_read_json_incremental(lazy_uds):
+    lazy_uds.read_json("datasets/dataset1.json", incremental=True)
+    incremental = lazy_uds.data["employees"].frame
+    lazy_uds.read_json("datasets/dataset1.json", incremental=False)
+    pd.testing.assert_frame_equal(incremental, lazy_uds.data["employees"].frame)
+
+def test_employees_view_pickles_single_frame(uds):
+    view = pickle.loads(pickle.dumps(uds.data["employees"]))
+    assert isinstance(view, json_ingestion.EmployeesView)
+    pd.testing.assert_frame_equal(view[1], uds.data["employees"][1])
+
+def test_read_csv_schema(uds):
+    customers = uds.data["customers"]
+    assert pd.api.types.is_datetime64_any_dtype(customers["Date"])
+    for column in ["Membership_Type", "Activity", "Location"]:
+        assert isinstance(customers[column].dtype, pd.CategoricalDtype)
+    # one id per visit, a categorical would not save anything
+    assert customers["Membership_ID"].dtype == "string[pyarrow]"
+    assert customers["Duration (Minutes)"].dtype == "int8"
+    # revenue in cents is not exactly representable in float32
+    assert customers["Revenue"].dtype == "float64"
+    raw = pd.read_csv("datasets/dataset2.csv")
+    assert customers["Revenue"].tolist() == raw["Revenue"].tolist()
+    assert customers.memory_usage(deep=True).sum() < raw.memory_usage(deep=True).sum()
+
+def test_read_csv_chunked(uds, lazy_uds):
+    lazy_uds.read_csv("datasets/dataset2.csv", chunksize=7)
+    chunked = lazy_uds.data["customers"]
+    assert isinstance(chunked["Location"].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(
+        chunked.astype({"Membership_Type": object, "Activity": object, "Location": object}),
+        uds.data["customers"].astype({"Membership_Type": object, "Activity": object, "Location": object}),
+    )
+
+def _all_pages(uds, dataset, **query):
+    rows, cursor = [], None
+    while True:
+        page = uds.query(dataset, cursor=cursor, **query)
+        rows += page["rows"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return rows
+
+def test_query_filter_sort_and_paginate(uds):
+    customers = uds.data["customers"]
+    rows = _all_pages(uds, "customers", filters={"Location": [("eq", "Downtown")], "Date": [("gte", "2024-01-10")]},
+                      columns=["Membership_ID", "Revenue"], sort="-Revenue", limit=4)
+    expected = customers[(customers["Location"] == "Downtown") & (customers["Date"] >= "2024-01-10")]
+    expected = expected.sort_values("Revenue", ascending=False, kind="stable")
+    assert [row["Membership_ID"] for row in rows] == expected["Membership_ID"].tolist()
+    assert list(rows[0]) == ["Membership_ID", "Revenue"]
+
+def test_query_sorted_without_filters(uds):
+    rows = _all_pages(uds, "customers", sort="Date", limit=7)
+    expected = uds.data["customers"].sort_values("Date", kind="stable")
+    assert [row["Membership_ID"] for row in rows] == expected["Membership_ID"].tolist()
+
+def test_query_employees_by_company(uds):
+    rows = _all_pages(uds, "employees", filters={"company_id": [("eq", "2")]}, limit=10)
+    assert len(rows) == len(uds.data["employees"][1])
+    assert {row["company_id"] for row in rows} == {2}
+
+def test_query_range_skips_nulls(uds):
+    # RecreaLife has no revenue
+    rows = _all_pages(uds, "companies", filters={"revenue": [("lt", "100000000")]})
+    assert [row["name"] for row in rows] == ["FitPro"]
+    rows = _all_pages(uds, "companies", filters={"revenue": [("lte", "-inf")]})
+    assert rows == []
+
+def test_query_errors(uds):
+    with pytest.raises(QueryError):
+        uds.query("customers", columns=["missing"])
+    with pytest.raises(QueryError):
+        uds.query("key_highlights")
+
+def test_rollup_matches_groupby(uds):
+    rollup = uds.get_rollup("activity").set_index("Activity")
+    expected = uds.data["customers"].groupby("Activity", observed=True)["Revenue"].agg(["count", "sum", "mean"])
+    expected.index = expected.index.astype(object)
+    rollup = rollup.loc[expected.index]
+    assert rollup["count"].to_dict() == expected["count"].to_dict()
+    pd.testing.assert_series_equal(rollup["Revenue_sum"], expected["sum"], check_names=False)
+    pd.testing.assert_series_equal(rollup["Revenue_mean"], expected["mean"], check_names=False)
+    assert set(uds.get_rollup("month")["Month"]) == {"2024-01"}
+
+def test_rollup_incremental_append(uds):
+    before = uds.get_rollup("location").set_index("Location")
+    rollup = uds.rollups._rollups["location"]
+    uds.append_customers([
+        {"Date": "2024-02-01", "Membership_ID": "M101", "Membership_Type": "Basic", "Activity": "Gym", "Revenue": 10.0, "Duration (Minutes)": 30, "Location": "Downtown"},
+        {"Date": "2024-02-02", "Membership_ID": "M102", "Membership_Type": "VIP", "Activity": "Pool", "Revenue": 20.0, "Duration (Minutes)": 60, "Location": "Uptown"},
+    ])
+    after = uds.get_rollup("location").set_index("Location")
+    # updated in place rather than rebuilt
+    assert uds.rollups._rollups["location"] is rollup
+    assert after.loc["Downtown", "count"] == before.loc["Downtown", "count"] + 1
+    assert after.loc["Downtown", "Revenue_sum"] == pytest.approx(before.loc["Downtown", "Revenue_sum"] + 10.0)
+    assert after.loc["Uptown", "count"] == 1
+    assert len(uds.data["customers"]) == 102
+    assert set(uds.get_rollup("month")["Month"]) == {"2024-01", "2024-02"}
+
+@pytest.fixture
+def datasets_copy(tmp_path):
+    for name in ["dataset1.json", "dataset2.csv", "dataset3.pdf", "dataset4.pptx"]:
+        shutil.copy(os.path.join("datasets", name), tmp_path / name)
+    return tmp_path
+
+def test_load_sources_isolates_errors(datasets_copy):
+    (datasets_copy / "dataset4.pptx").write_bytes(b"not a pptx")
+    uds = Unified_data_structure(datasets_dir=str(datasets_copy))
+    assert list(uds.load_errors) == ["dataset4.pptx"]
+    assert isinstance(uds.data["customers"], pd.DataFrame)
+    assert isinstance(uds.data["quarterly_performance"], pd.DataFrame)
+    assert not uds.data.is_loaded("key_highlights")
+    # the datasets that could be loaded are still exported
+    data = json.loads(b"".join(uds.iter_json()))
+    assert "customers" in data and "key_highlights" not in data
+
+def test_failed_source_retried_when_changed(datasets_copy):
+    calls = []
+
+    class CountingReaders(Unified_data_structure):
+        def read_pptx(self, filename):
+            calls.append(filename)
+            super().read_pptx(filename)
+
+    path = datasets_copy / "dataset4.pptx"
+    path.write_bytes(b"not a pptx")
+    uds = CountingReaders(datasets_dir=str(datasets_copy))
+    assert len(calls) == 1 and "dataset4.pptx" in uds.load_errors
+    # the broken file is not parsed again until it changes
+    for _ in range(3):
+        assert uds.load_sources() == {}
+    assert len(calls) == 1
+    shutil.copy(os.path.join("datasets", "dataset4.pptx"), path)
+    _touch(path)
+    assert uds.load_sources() == {}
+    assert len(calls) == 2 and uds.load_errors == {} and uds.data.is_loaded("key_highlights")
+
+def test_failed_source_unavailable_on_access(datasets_copy):
+    calls = []
+
+    class CountingReaders(Unified_data_structure):
+        def read_pdf(self, filename):
+            calls.append(filename)
+            return super().read_pdf(filename)
+
+    (datasets_copy / "dataset3.pdf").write_bytes(b"not a pdf")
+    uds = CountingReaders(datasets_dir=str(datasets_copy))
+    for _ in range(3):
+        with pytest.raises(SourceUnavailable):
+            uds.data["quarterly_performance"]
+    assert len(calls) == 1
+    # the charts that can be drawn still are
+    svg = uds.export("svg", charts="locations,quarterly_performance")
+    assert b"quarterly_performance is not available" in svg.body
+    assert len(calls) == 1
+
+def test_load_sources_in_parallel_with_timeouts(datasets_copy):
+    class SlowReaders(Unified_data_structure):
+        def read_json(self, filename, incremental=None):
+            time.sleep(0.5)
+            super().read_json(filename, incremental)
+
+        def read_csv(self, filename, chunksize=None):
+            time.sleep(0.5)
+            super().read_csv(filename, chunksize)
+
+        def read_pptx(self, filename):
+            time.sleep(6)
+            super().read_pptx(filename)
+
+    uds = SlowReaders(lazy=True, datasets_dir=str(datasets_copy))
+    started = time.monotonic()
+    errors = uds.load_sources(timeouts={"dataset4.pptx": 1})
+    assert time.monotonic() - started < 5
+    assert list(errors) == ["dataset4.pptx"]
+    assert isinstance(errors["dataset4.pptx"], TimeoutError)
+    assert uds.data.is_loaded("companies") and uds.data.is_loaded("customers")
+
+def test_compact_frame_dtypes():
+    df = pd.DataFrame({
+        "city": ["Downtown", "Eastside"] * 50,
+        "name": [f"Customer {n}" for n in range(100)],
+        "joined": [f"2024-01-{n % 28 + 1:02d}" for n in range(100)],
+        "visits": np.arange(100, dtype="int64"),
+        "share": np.full(100, 0.5),
+        "mixed": ["a", 1] * 50,
+    })
+    compacted = memory_budget.compact_frame(df)
+    assert isinstance(compacted["city"].dtype, pd.CategoricalDtype)
+    assert compacted["name"].dtype == "string[pyarrow]"
+    assert pd.api.types.is_datetime64_any_dtype(compacted["joined"])
+    assert compacted["visits"].dtype == np.int8
+    assert compacted["share"].dtype == np.float32
+    assert compacted["mixed"].dtype == object
+    assert memory_budget.footprint(compacted) < memory_budget.footprint(df)
+    # compacting again changes nothing
+    assert memory_budget.compact_frame(compacted) is compacted
+
+def test_compact_keeps_exported_values(uds):
+    expected = json.loads(b"".join(uds.iter_json()))
+    changed = uds.compact()
+    assert "companies" in changed and "employees" in changed
+    assert uds.data["employees"][0]["hired_date"].dtype.kind == "M"
+    assert json.loads(b"".join(uds.iter_json()))["employees"] == expected["employees"]
+    assert uds.compact() == []
+
+def test_compact_keeps_rows_appended_meanwhile(uds, monkeypatch):
+    uds.data["customers"] = uds.data["customers"].astype({"Location": object})
+    compact_value = memory_budget.compact_value
+    def append_then_compact(value):
+        # a visit is appended while customers is being compacted
+        if value is uds.data["customers"]:
+            uds.append_customers([{"Date": "2024-02-01", "Membership_ID": "M101", "Membership_Type": "Basic", "Activity": "Gym",
+                                   "Revenue": 10.0, "Duration (Minutes)": 30, "Location": "Downtown"}])
+        return compact_value(value)
+    monkeypatch.setattr(memory_budget, "compact_value", append_then_compact)
+    changed = uds.compact()
+    assert "customers" not in changed and "companies" in changed
+    assert len(uds.data["customers"]) == 101
+    assert uds.data["customers"]["Membership_ID"].iloc[-1] == "M101"
+    monkeypatch.setattr(memory_budget, "compact_value", compact_value)
+    assert "customers" in uds.compact()
+    assert len(uds.data["customers"]) == 101
+
+def test_loaded_items_sees_a_swap_whole():
+    store = DataStore({"companies": "old companies", "employees": "old employees"})
+    swapping, proceed = threading.Event(), threading.Event()
+    class SlowEntries(dict):
+        def items(self):
+            # stops the swap between its two keys
+            items = list(super().items())
+            yield items[0]
+            swapping.set()
+            proceed.wait(5)
+            yield from items[1:]
+    with ThreadPoolExecutor(2) as pool:
+        swap = pool.submit(store.swap, SlowEntries(companies="new companies", employees="new employees"))
+        assert swapping.wait(5)
+        items = pool.submit(lambda: dict(store.loaded_items()))
+        # the snapshot waits for the swap to finish
+        with pytest.raises(TimeoutError):
+            items.result(0.2)
+        proceed.set()
+        swap.result()
+        assert items.result(5) == {"companies": "new companies", "employees": "new employees"}
+
+def test_memory_budget_spills_and_pages_in(tmp_path):
+    uds = Unified_data_structure(memory_budget=1, spill_dir=str(tmp_path))
+    report = uds.memory_report().set_index("dataset")
+    # every table is spilled, dictionaries stay in memory
+    assert report.loc["customers", "state"] == "spilled" and report.loc["customers", "spilled_bytes"] > 0
+    assert report.loc["key_highlights", "state"] == "in memory"
+    version = uds.data.key_version("customers")
+    customers = uds.data["customers"]
+    assert uds.data.key_version("customers") == version
+    assert isinstance(customers["Location"].dtype, pd.CategoricalDtype)
+    assert len(customers) == len(Unified_data_structure().data["customers"])
+    # paging in spills the other tables but keeps the one being used
+    assert not uds.data.is_spilled("customers") and uds.data.is_spilled("companies")
+    assert uds.query("employees", sort="cashmoneh", limit=2)["rows"]
+    data = json.loads(b"".join(uds.iter_json()))
+    assert set(data) == set(uds.data.keys())
+
+def test_loaded_items_page_in_one_at_a_time(uds):
+    reads = []
+    for key in ("customers", "companies"):
+        value = uds.data[key]
+        uds.data.spill(key, lambda key=key, value=value: reads.append(key) or value, value)
+    items = uds.data.loaded_items(["customers", "companies"])
+    # the items are those of the call, a spilled table is read when it is reached
+    uds.data["companies"] = pd.DataFrame()
+    assert next(items)[0] == "customers" and reads == ["customers"]
+    key, companies = next(items)
+    assert key == "companies" and len(companies) == 2 and reads == ["customers", "companies"]
+
+def test_memory_budget_keeps_what_fits(tmp_path):
+    uds = Unified_data_structure(memory_budget=1024 * 1024 * 1024, spill_dir=str(tmp_path))
+    assert (uds.memory_report()["state"] == "in memory").all()
+    assert not os.listdir(tmp_path)
+
+def test_snapshot_publish_and_load(uds, tmp_path):
+    uds.compact()
+    version = snapshot.publish(uds.data.loaded_items(), str(tmp_path))
+    assert snapshot.current_version(str(tmp_path)) == version
+    attached = snapshot.load(str(tmp_path))
+    assert list(attached.data.keys()) == list(uds.data.keys())
+    assert b"".join(attached.iter_json()) == b"".join(uds.iter_json())
+    # the columns of the tables point into the memory mapped files
+    duration = attached.data["customers"]["Duration (Minutes)"].to_numpy()
+    assert not duration.flags.owndata and not duration.flags.writeable
+    assert attached.data["employees"][0].equals(uds.data["employees"][0])
+    # every process attached to the same version produces the same etags
+    assert snapshot.load(str(tmp_path)).data_etag() == attached.data_etag()
+
+def test_snapshot_reader_follows_versions(uds, tmp_path):
+    reader = snapshot.SnapshotReader(str(tmp_path), poll_interval=0, datasets_dir="datasets")
+    first = reader.refresh()
+    assert first is not None and reader.version == snapshot.current_version(str(tmp_path))
+    assert reader.refresh() is None
+    for _ in range(snapshot.KEEP_VERSIONS + 1):
+        latest = snapshot.publish(uds.data.loaded_items(), str(tmp_path))
+    assert reader.refresh().data.token == f"snapshot-{latest}"
+    assert len(os.listdir(tmp_path / "versions")) == snapshot.KEEP_VERSIONS
+    # the first version was removed but what is attached to it can still be read
+    assert len(first.data["customers"]) == len(uds.data["customers"])
+
+def _touch(path):
+    # a new mtime even when the file is rewritten within the resolution of the clock
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+def test_watcher_appends_csv_rows(datasets_copy):
+    uds = Unified_data_structure(datasets_dir=str(datasets_copy))
+    watcher = SourceWatcher(uds)
+    assert watcher.poll() == {}
+    path = datasets_copy / "dataset2.csv"
+    with open(path, "a") as csv_file:
+        csv_file.write("2024-02-10,M900,VIP,Pool,50.0,60,Downtown\n2024-02-11,M901,Basic,Gym,20.5,30,Westside\n2024-02-12,M9")
+    assert watcher.poll() == {"dataset2.csv": "appended 2 rows"}
+    customers = uds.data["customers"]
+    assert len(customers) == 102 and customers["Membership_ID"].iloc[-1] == "M901"
+    assert uds.get_rollup("location")["count"].sum() == 102
+    # the line that was being written is read once it is complete
+    with open(path, "a") as csv_file:
+        csv_file.write("02,VIP,Yoga Class,80.0,45,Eastside\n")
+    assert watcher.poll() == {"dataset2.csv": "appended 1 rows"}
+    assert uds.data["customers"]["Membership_ID"].iloc[-1] == "M902"
+    assert watcher.poll() == {}
+    # a rewritten log is ingested again
+    shutil.copy(os.path.join("datasets", "dataset2.csv"), path)
+    assert watcher.poll() == {"dataset2.csv": "reloaded"}
+    assert len(uds.data["customers"]) == 100
+
+def test_watcher_finishes_line_cut_by_first_read(datasets_copy):
+    path = datasets_copy / "dataset2.csv"
+    with open(path, "a") as csv_file:
+        csv_file.write("2024-02-01,M900,VIP,Gym,1")
+    uds = Unified_data_structure(datasets_dir=str(datasets_copy))
+    watcher = SourceWatcher(uds)
+    customers = uds.data["customers"]
+    assert len(customers) == 100 and pd.api.types.is_integer_dtype(customers["Duration (Minutes)"])
+    with open(path, "a") as csv_file:
+        csv_file.write("0.0,60,Downtown\n")
+    assert watcher.poll() == {"dataset2.csv": "appended 1 rows"}
+    customers = uds.data["customers"]
+    assert len(customers) == 101 and pd.api.types.is_integer_dtype(customers["Duration (Minutes)"])
+    assert customers.iloc[-1][["Membership_ID", "Revenue", "Location"]].tolist() == ["M900", 10.0, "Downtown"]
+
+def test_watcher_replaces_changed_companies(datasets_copy):
+    uds = Unified_data_structure(datasets_dir=str(datasets_copy))
+    watcher = SourceWatcher(uds)
+    watcher.poll()
+    path = datasets_copy / "dataset1.json"
+    feed = json.loads(path.read_text())
+    feed["companies"][1]["name"] = "Renamed"
+    feed["companies"][1]["employees"] = feed["companies"][1]["employees"][:1]
+    feed["companies"].insert(0, {**feed["companies"][0], "id": 99, "name": "New"})
+    path.write_text(json.dumps(feed))
+    _touch(path)
+    version = uds.data.version
+    assert watcher.poll() == {"dataset1.json": "replaced 2 companies, removed 0"}
+    assert uds.data.version == version + 1
+    expected = Unified_data_structure(datasets_dir=str(datasets_copy))
+    names = uds.data["companies"]["name"].tolist()
+    assert names[0] == "New" and names[2] == "Renamed"
+    pd.testing.assert_frame_equal(uds.data["companies"], expected.data["companies"])
+    pd.testing.assert_frame_equal(uds.data["employees"].frame, expected.data["employees"].frame)
+    pd.testing.assert_frame_equal(uds.data["companies_performance"], expected.data["companies_performance"])
+    assert len(uds.data["employees"][2]) == 1
+
+def test_watcher_reloads_changed_pdf(datasets_copy):
+    uds = Unified_data_structure(datasets_dir=str(datasets_copy))
+    watcher = SourceWatcher(uds)
+    watcher.poll()
+    path = datasets_copy / "dataset3.pdf"
+    rng = np.random.default_rng(0)
+    synthetic_datasets.write_pdf(str(path), [synthetic_datasets._quarters(rng, 4), synthetic_datasets._quarters(rng, 3)])
+    _touch(path)
+    assert watcher.poll() == {"dataset3.pdf": "reloaded"}
+    assert len(uds.data["quarterly_performance"]) == 4 and len(uds.data["quarterly_performance_2"]) == 3
+    # keys the new version of the file does not produce are removed
+    synthetic_datasets.write_pdf(str(path), [synthetic_datasets._quarters(rng, 5)])
+    _touch(path)
+    assert watcher.poll() == {"dataset3.pdf": "reloaded"}
+    assert "quarterly_performance_2" not in uds.data and len(uds.data["quarterly_performance"]) == 5
+
+def test_change_log_is_bounded():
+    log = ChangeLog(max_rows=3)
+    rows = pd.DataFrame({"a": [1, 2]})
+    log.record("customers", 0, Change(1, inserted=rows))
+    log.record("customers", 1, Change(2, inserted=rows))
+    # the first change was dropped to stay within 3 rows
+    assert log.since("customers", 0, 2) is None
+    assert [change.version for change in log.since("customers", 1, 2)] == [2]
+    assert log.since("customers", 2, 2) == []
+    # a version the log did not record means the dataset was replaced
+    assert log.since("customers", 1, 3) is None
+    log.record("customers", 3, Change(4, inserted=rows))
+    assert log.since("customers", 1, 4) is None and len(log.since("customers", 3, 4)) == 1
+
+def test_changes_since_appended_customers(uds):
+    full = uds.changes_since("customers")
+    assert full["full"] and len(full["data"]) == 100
+    version, token = full["version"], full["token"]
+    uds.append_customers([{"Date": "2024-02-10", "Membership_ID": "M900", "Membership_Type": "VIP", "Activity": "Pool",
+                           "Revenue": 50.0, "Duration (Minutes)": 60, "Location": "Downtown"}])
+    uds.append_customers([{"Date": "2024-02-11", "Membership_ID": "M901", "Membership_Type": "Basic", "Activity": "Gym",
+                           "Revenue": 20.5, "Duration (Minutes)": 30, "Location": "Westside"}])
+    delta = uds.changes_since("customers", version, token)
+    assert not delta["full"] and delta["version"] == uds.data.key_version("customers")
+    assert [change.inserted["Membership_ID"].tolist() for change in delta["changes"]] == [["M900"], ["M901"]]
+    assert uds.changes_since("customers", delta["version"], token)["changes"] == []
+    # versions of another process are not comparable
+    assert uds.changes_since("customers", version, "another-token")["full"]
+    encoded = json.loads(b"".join(json_export.iter_changes(delta)))
+    assert encoded["changes"][1]["inserted"][0]["Date"] == "2024-02-11"
+    # a change that is not row level makes clients fetch everything
+    uds.data["customers"] = uds.data["customers"].head(10)
+    assert uds.changes_since("customers", delta["version"], token)["full"]
+
+def test_changes_since_replaced_companies(datasets_copy):
+    uds = Unified_data_structure(datasets_dir=str(datasets_copy))
+    watcher = SourceWatcher(uds)
+    watcher.poll()
+    versions = {key: uds.data.key_version(key) for key in ["companies", "employees", "companies_performance"]}
+    path = datasets_copy / "dataset1.json"
+    feed = json.loads(path.read_text())
+    feed["companies"][1]["name"] = "Renamed"
+    removed_employee = feed["companies"][1]["employees"].pop()
+    path.write_text(json.dumps(feed))
+    _touch(path)
+    watcher.poll()
+    [companies] = uds.changes_since("companies", versions["companies"])["changes"]
+    assert companies.updated["name"].tolist() == ["Renamed"] and companies.inserted.empty and companies.deleted.empty
+    [employees] = uds.changes_since("employees", versions["employees"])["changes"]
+    assert employees.deleted.to_dict("records") == [{"company_id": feed["companies"][1]["id"], "id": removed_employee["id"]}]
+    assert employees.updated.empty
+    # the performance of the company was swapped in again unchanged
+    [performance] = uds.changes_since("companies_performance", versions["companies_performance"])["changes"]
+    assert performance.rows == 0
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from data_store import SourceUnavailable
+
+"""
+Rendering of the data visualisations.
+Every chart is drawn on its own matplotlib Figure (object oriented api, Agg / svg canvases) instead of the global pyplot
+state machine, so renders share no state and can run concurrently in threads or processes.
+
+A render is described by its options (see chart_options):
+    charts    the charts to draw side by side, names from CHARTS (DEFAULT_CHARTS by default)
+    width     width of the image in inches (height too), DEFAULT_WIDTH and DEFAULT_HEIGHT by default
+    dpi       dots per inch of raster formats, DEFAULT_DPI by default (the image is at most MAX_PIXELS pixels)
+and the format is one of FORMATS. Unified_data_structure caches the rendered bytes per data version and options, so the
+same chart is only rendered once per version of the data.
+Line series with more than MAX_POINTS points are downsampled before they are plotted (see downsample).
+The charts only read rollups and a few datasets (CHART_INPUTS), ChartInputs holds just those so that a render in another
+process does not need a copy of every dataset. A chart whose source could not be loaded (SourceUnavailable) is left empty
+with a note instead of failing the whole render.
+"""
+
+FORMATS = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "webp": "image/webp",
+}
+
+DEFAULT_CHARTS = ["locations", "quarterly_performance"]
+DEFAULT_WIDTH = 12
+DEFAULT_HEIGHT = 6
+DEFAULT_DPI = 300
+MAX_DPI = 600
+MAX_INCHES = 40
+# largest raster canvas (width * dpi by height * dpi), Agg holds 4 bytes per pixel while it draws
+MAX_PIXELS = 32 * 1024 * 1024
+MAX_POINTS = 2000
+
+
+def downsample(x, y, max_points=MAX_POINTS):
+    # keeps the first, the minimum and the maximum point of every bucket so that peaks survive, at most max_points points
+    x, y = np.asarray(x), np.asarray(y, dtype="float64")
+    if len(y) <= max_points:
+        return x, y
+    buckets = max(max_points // 3, 1)
+    edges = np.linspace(0, len(y), buckets + 1).astype(np.intp)
+    keep = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        if stop > start:
+            values = y[start:stop]
+            keep.extend((start, start + np.nanargmin(values), start + np.nanargmax(values)) if not np.isnan(values).all() else (start,))
+    keep = np.unique(keep)
+    return x[keep], y[keep]
+
+
+def _numbers(series):
+    # "2,100,000" -> 2100000.0 for amounts extracted as text
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64")
+    return pd.to_numeric(series.astype(str).str.replace(r"[,$€£%\s]", "", regex=True), errors="coerce")
+
+
+def _plot_locations(ax, uds):
+    # number of customers per location, from the location rollup instead of a scan of the customers
+    location = uds.get_rollup("location").sort_values("count", ascending=False, kind="stable")
+    ax.bar(location["Location"].astype(str), location["count"])
+    ax.set_title('Overview of customers in each location')
+    ax.set_xlabel('Location')
+    ax.set_ylabel('Number of customers')
+
+
+def _plot_quarterly_performance(ax, uds):
+    performance = uds.data["quarterly_performance"]
+    x, y = downsample(np.arange(len(performance)), _numbers(performance["Revenue (in $)"]))
+    ax.plot(x, y)
+    ax.set_title('Quarterly Performance')
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Revenue')
+
+
+def _plot_monthly_revenue(ax, uds):
+    month = uds.get_rollup("month").sort_values("Month")
+    x, y = downsample(np.arange(len(month)), month["Revenue_sum"])
+    ax.plot(x, y)
+    ticks = x[::max(len(x) // 12, 1)]
+    ax.set_xticks(ticks, month["Month"].to_numpy()[ticks], rotation=45)
+    ax.set_title('Revenue per month')
+    ax.set_xlabel('Month')
+    ax.set_ylabel('Revenue')
+
+
+def _plot_activity_revenue(ax, uds):
+    activity = uds.get_rollup("activity").sort_values("Revenue_sum", ascending=False, kind="stable")
+    ax.bar(activity["Activity"].astype(str), activity["Revenue_sum"])
+    ax.set_title('Revenue per activity')
+    ax.set_xlabel('Activity')
+    ax.set_ylabel('Revenue')
+
+
+# name -> function drawing the chart on a matplotlib Axes from a Unified_data_structure
+CHARTS = {
+    "locations": _plot_locations,
+    "quarterly_performance": _plot_quarterly_performance,
+    "monthly_revenue": _plot_monthly_revenue,
+    "activity_revenue": _plot_activity_revenue,
+}
+
+
+# rollups and datasets every chart reads
+CHART_INPUTS = {
+    "locations": (["location"], []),
+    "quarterly_performance": ([], ["quarterly_performance"]),
+    "monthly_revenue": (["month"], []),
+    "activity_revenue": (["activity"], []),
+}
+
+
+class _Available(dict):
+    # values that could be read, reading one that could not raises the SourceUnavailable it failed with
+    def __init__(self, read, names):
+        super().__init__()
+        self.errors = {}
+        for name in names:
+            try:
+                self[name] = read(name)
+            except SourceUnavailable as error:
+                self.errors[name] = error
+
+    def __missing__(self, name):
+        if name in self.errors:
+            raise self.errors[name]
+        raise KeyError(name)
+
+
+class ChartInputs:
+    # the rollups and datasets some charts read from a Unified_data_structure, which render draws from the same way. It is
+    # small enough to be sent to another process instead of a copy of every dataset
+    def __init__(self, uds, charts):
+        rollups = {name for chart in charts for name in CHART_INPUTS[chart][0]}
+        datasets = {key for chart in charts for key in CHART_INPUTS[chart][1]}
+        self.rollups = _Available(uds.get_rollup, rollups)
+        self.data = _Available(uds.data.__getitem__, datasets)
+
+    def get_rollup(self, name):
+        return self.rollups[name]
+
+
+def chart_options(charts=None, width=None, height=None, dpi=None):
+    # validated options of a render with the defaults filled in, raises ValueError for invalid ones
+    if isinstance(charts, str):
+        charts = [chart.strip() for chart in charts.split(",") if chart.strip()]
+    charts = tuple(charts or DEFAULT_CHARTS)
+    for chart in charts:
+        if chart not in CHARTS:
+            raise ValueError(f"unknown chart '{chart}', expected one of {', '.join(CHARTS)}")
+    width = float(width) if width is not None else DEFAULT_WIDTH
+    height = float(height) if height is not None else DEFAULT_HEIGHT
+    dpi = int(dpi) if dpi is not None else DEFAULT_DPI
+    if not (0 < width <= MAX_INCHES and 0 < height <= MAX_INCHES):
+        raise ValueError(f"width and height must be between 0 and {MAX_INCHES} inches")
+    if not 0 < dpi <= MAX_DPI:
+        raise ValueError(f"dpi must be between 1 and {MAX_DPI}")
+    if width * dpi * height * dpi > MAX_PIXELS:
+        raise ValueError(f"the image would be larger than {MAX_PIXELS} pixels, lower its size or dpi")
+    return {"charts": charts, "width": width, "height": height, "dpi": dpi}
+
+
+def render(output, uds, format="png", charts=None, width=None, height=None, dpi=None):
+    # draws the charts of uds side by side and saves the figure to output (a path or a binary file object)
+    options = chart_options(charts, width, height, dpi)
+    figure = Figure(figsize=(options["width"], options["height"]))
+    axes = figure.subplots(1, len(options["charts"]), squeeze=False)[0]
+    for ax, chart in zip(axes, options["charts"]):
+        try:
+            CHARTS[chart](ax, uds)
+        except SourceUnavailable as error:
+            # the other charts are still drawn
+            ax.clear()
+            ax.set_axis_off()
+            ax.text(0.5, 0.5, f"{chart} is not available\n({error.source} could not be loaded)", ha="center", va="center")
+    figure.tight_layout()
+    figure.savefig(output, format=format, dpi=options["dpi"], bbox_inches='tight')
@@ -0,0 +1,88 @@
+import re
+import pandas as pd
+import xlsxwriter
+
+import json_ingestion
+
+"""
+Streaming xlsx writer for the consolidated workbook.
+pandas' to_excel builds every cell of a sheet in memory before anything is written. write_workbook instead uses
+xlsxwriter's constant_memory mode: rows are written in order, BATCH_SIZE rows of a dataframe at a time, and every finished
+row is flushed to a temporary file straight away, so memory stays bounded no matter how many rows the tables have.
+The workbook itself goes to output, a path or a binary file object (e.g. a per request io.BytesIO).
+
+Layout, same as the previous pandas export:
+    - one sheet per dataset, a dataframe is written as a header row and its rows, a dict as a row of keys and a row of values
+    - employees: one sheet per company ("Employees for Company <i>"), or with single_employees_sheet=True a single
+      "employees" sheet of every employee with its company_id
+Sheet names are made valid for excel (at most 31 characters, no []:*?/\\) and unique. A table with more rows than an
+excel sheet can hold continues on sheets named "<name> (2)", "<name> (3)"...
+"""
+
+BATCH_SIZE = 10_000
+MAX_ROWS = 1_048_576
+_MAX_SHEET_NAME = 31
+_INVALID_SHEET_CHARACTERS = re.compile(r"[\[\]:*?/\\]")
+
+
+class _SheetNames:
+    def __init__(self):
+        self._used = set()
+
+    def next(self, name, n=1):
+        name = _INVALID_SHEET_CHARACTERS.sub("_", str(name)) or "sheet"
+        while True:
+            suffix = f" ({n})" if n > 1 else ""
+            candidate = name[:_MAX_SHEET_NAME - len(suffix)] + suffix
+            if candidate.lower() not in self._used:
+                self._used.add(candidate.lower())
+                return candidate
+            n += 1
+
+
+def _rows(df, batch_size):
+    # rows of df as python values, with None for missing values (written as empty cells)
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size].astype(object)
+        yield from batch.where(batch.notna(), None).itertuples(index=False, name=None)
+
+
+def _write_frame(workbook, names, name, df, header_format, batch_size):
+    header = [str(column) for column in df.columns]
+    worksheet, row = None, MAX_ROWS
+    sheets = 0
+    for values in _rows(df, batch_size):
+        if row == MAX_ROWS:
+            sheets += 1
+            worksheet = workbook.add_worksheet(names.next(name, sheets))
+            worksheet.write_row(0, 0, header, header_format)
+            row = 1
+        worksheet.write_row(row, 0, values)
+        row += 1
+    if worksheet is None:
+        workbook.add_worksheet(names.next(name)).write_row(0, 0, header, header_format)
+
+
+def write_workbook(output, items, single_employees_sheet=False, batch_size=BATCH_SIZE):
+    # items are the (key, value) of Unified_data_structure.data
+    workbook = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd",
+        "strings_to_urls": False,
+    })
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+    names = _SheetNames()
+    try:
+        for key, value in items:
+            if key == "employees":
+                if single_employees_sheet:
+                    _write_frame(workbook, names, "employees", json_ingestion.employees_frame(value), header_format, batch_size)
+                else:
+                    for company in value:
+                        _write_frame(workbook, names, f"Employees for Company {company}", value[company], header_format, batch_size)
+            elif isinstance(value, pd.DataFrame):
+                _write_frame(workbook, names, key, value, header_format, batch_size)
+            elif isinstance(value, dict):
+                _write_frame(workbook, names, key, pd.DataFrame([value]), header_format, batch_size)
+    finally:
+        workbook.close()